@@ -5,34 +5,72 @@ Please see readme for rough breakdown of individual contributions.
 """
 
 import numpy as np
-import pandas as pd
 import os
-import matplotlib.pyplot as plt
-import dearpygui.dearpygui as dpg
-from newportxps import NewportXPS
 import time
 
 from ctypes import *
 import sys
 import time
+import threading
+import queue
+import json
+import io
+import re
+import importlib.util
+import inspect
+from collections import namedtuple, deque
+from contextlib import contextmanager
+
+from SPR_livefeed import LiveFeed, DEFAULT_NAME
+
+def lazy_import(name):
+    """
+    Returns the module without executing it, it is loaded on first attribute access. pandas and Dear PyGui
+    take most of the startup time and headless runs may never need them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'")
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+pd = lazy_import('pandas')
+dpg = lazy_import('dearpygui.dearpygui')
 
 class CommandError(Exception):
     '''The function in the usbdll.dll was not sucessfully evaluated'''
 
 class Newport_XPS:
-    def __init__(self, group):
-        self.xps = NewportXPS('192.168.254.254', username='Administrator', password='Administrator',timeout=1)
-        print(self.xps.status_report())
+    simulated = False   # True for the SPR_simulator classes, stored with every file
 
-        for gname, info in self.xps.groups.items():
-            print(gname, info)
+    def __init__(self, group, verbose=True, host='192.168.254.254'):
+        """
+        :param verbose: print the controller status report and the groups and stages
+        :param host: IP address of the controller
+        """
+        self.host = host
+        self.xps = self._connect()
+        if verbose:
+            print(self.xps.status_report())
+
+            for gname, info in self.xps.groups.items():
+                print(gname, info)
 
-        for sname, info in self.xps.stages.items():
-            print(sname, self.xps.get_stage_position(sname), info)
+            for sname, info in self.xps.stages.items():
+                print(sname, self.xps.get_stage_position(sname), info)
 
         self.xps.kill_group(group)
         self.xps.initialize_group(group)
 
+    def _connect(self):
+        from newportxps import NewportXPS
+        return NewportXPS(self.host, username='Administrator', password='Administrator',timeout=1)
+
     def home_group(self, group):
         self.xps.home_group(group)
 
@@ -41,33 +79,487 @@ class Newport_XPS:
 
         return
 
+    def set_velocity(self, velo, accl, group_name="XY"):
+        for axis in ("X", "Y"):
+            self.xps.set_velocity(stage=f"{group_name}.{axis}", velo=velo, accl=accl)
+        self.velocity = (velo, accl)
+
+    def position(self, group_name):
+        # both arms move together, so the X stage stands for the group
+        return self.xps.get_stage_position(f"{group_name}.X")
+
+    def start_move_abs(self, group_name, pos):
+        """
+        Starts a move on a second controller socket and returns the thread running it, so the position
+        can still be read on the main socket while the group travels.
+        """
+        def move():
+            xps = self.xps._xps
+            socket_id = xps.TCP_ConnectToServer(self.xps.host, self.xps.port, self.xps.timeout)
+            try:
+                err, ret = xps.GroupMoveAbsolute(socket_id, group_name, [pos, pos])
+                if err != 0:
+                    print(f'XPS move to {pos} failed with error {err}')
+            finally:
+                xps.TCP_CloseSocket(socket_id)
+
+        thread = threading.Thread(target=move, name='XPS move', daemon=True)
+        thread.start()
+        return thread
+
+class LatencyHistogram:
+    """
+    Per-command histogram of query round-trip times, log spaced from 0.1 ms to 10 s. Commands are keyed by
+    their header, so e.g. every PM:DS:GET? range shares one histogram and memory stays flat over long runs.
+    """
+    edges_ms = np.logspace(-1, 4, 26)
+
+    def __init__(self):
+        self.counts = {}
+        self.totals = {}
+
+    @staticmethod
+    def header(query):
+        """
+        :return: the command of a query without its arguments, the text before the first space or quote
+        """
+        return re.split(r'[\s"]', query.strip(), maxsplit=1)[0].upper()
+
+    def record(self, command, seconds):
+        """
+        :param command: query text, only its header is kept
+        """
+        command = self.header(command)
+        if command not in self.counts:
+            self.counts[command] = np.zeros(len(self.edges_ms)+1, dtype=np.int64)
+            self.totals[command] = 0.0
+        self.counts[command][np.searchsorted(self.edges_ms, seconds*1000)] += 1
+        self.totals[command] += seconds
+
+    def percentile(self, command, q):
+        """
+        Upper bin edge (ms) below which q percent of the recorded replies arrived
+        """
+        counts = self.counts[command]
+        idx = np.searchsorted(np.cumsum(counts), q/100*counts.sum())
+        return float(self.edges_ms[min(idx, len(self.edges_ms)-1)])
+
+    def report(self):
+        lines = []
+        for command, counts in self.counts.items():
+            n = int(counts.sum())
+            lines.append(f"{command}: n={n}, mean={1000*self.totals[command]/n:.2f} ms, "
+                          f"p50<={self.percentile(command, 50):.2f} ms, p99<={self.percentile(command, 99):.2f} ms")
+        return '\n'.join(lines)
+
+class PhaseTimer:
+    """
+    Collects the duration of named acquisition phases (motion, read, store, ...) for benchmarking.
+    Usage inside a loop:
+        lap = phase_timer.start()
+        xps1.move_abs(...)
+        lap('motion')
+    """
+    def __init__(self):
+        self.samples = {}
+
+    def reset(self):
+        self.samples = {}
+
+    def record(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def start(self):
+        return _Lap(self)
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+        :return: {phase: {'n', 'total_s', 'p50_ms', ...}}
+        """
+        summary = {}
+        for name, samples in self.samples.items():
+            samples = np.array(samples)
+            summary[name] = {'n': len(samples), 'total_s': float(samples.sum())}
+            for q, value in zip(percentiles, np.percentile(samples, percentiles)):
+                summary[name][f'p{q}_ms'] = float(1000*value)
+        return summary
+
+class _Lap:
+    __slots__ = ('timer', 'first', 'last')
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.first = self.last = time.perf_counter()
+
+    def __call__(self, name):
+        now = time.perf_counter()
+        self.timer.record(name, now-self.last)
+        self.last = now
+
+    def total(self, name):
+        seconds = time.perf_counter()-self.first
+        self.timer.record(name, seconds)
+        return seconds
+
+def move_time(distance, velo, accl):
+    """
+    Travel time in seconds of a trapezoidal (or, for short moves, triangular) velocity profile
+    """
+    distance = abs(distance)
+    if distance*accl < velo**2:
+        return 2*np.sqrt(distance/accl)
+    return velo/accl + distance/velo
+
+class DurationModel:
+    """
+    Predicts job durations from recorded timings. Every finished job appends one line to a JSON lines
+    history file, and the step time of stop-and-go scans is fitted as
+        t_step = c0 + c1*move_time(step, velocity, accl) + c2*buffer_time
+    by least squares, pulled towards the hand-measured 0.72 s/step while there is little history.
+    Jobs describe themselves with a features dict, see scan_features.
+    """
+    default_step = 0.72         # seconds, 145 s for 201 steps of 0.1 deg at 5 deg/s
+    default_overhead = 5.0      # seconds per scan besides the initial move
+    default_fly_overhead = 60.0 # seconds for arming and reading the data store
+    unknown_start = 30.0        # seconds of initial positioning when the arm position is not known
+    prior_weight = 2.0
+
+    def __init__(self, history_file=None):
+        """
+        :param history_file: JSON lines file, None keeps the history in memory only
+        """
+        self.history_file = history_file
+        self.history = []
+        if history_file is not None and os.path.exists(history_file):
+            with open(history_file) as f:
+                self.history = [json.loads(line) for line in f if line.strip()]
+
+        self.last_angle = None  # relative angle of the arms, updated by the acquisition code
+        self._steps = []
+        self._job_start_angle = None
+        self._fit()
+
+    def record_step(self, seconds):
+        self._steps.append(seconds)
+
+    def job_started(self, element):
+        self._steps = []
+        self._job_start_angle = self.last_angle
+
+    def job_finished(self, element, seconds):
+        features = getattr(element, 'features', None)
+        if features is None:
+            return
+        row = dict(features, job_s=seconds, start_from=self._job_start_angle, time=time.time())
+        if self._steps:
+            row['step_s'] = float(np.mean(self._steps))
+            row['n_measured'] = len(self._steps)
+        self._steps = []
+
+        self.history.append(row)
+        if self.history_file is not None:
+            with open(self.history_file, 'a') as f:
+                f.write(json.dumps(row)+'\n')
+        self._fit()
+
+    def _initial_move(self, features, start_angle):
+        first = self.scan_ends(features, start_angle)[0]
+        if start_angle is None or first is None:
+            return self.unknown_start
+        return move_time(first-start_angle, features['velocity'], features['accl'])
+
+    @staticmethod
+    def scan_ends(features, start_angle):
+        """
+        First and last angle of a job. With direction 'nearest' the scan starts at the end closer to start_angle.
+        """
+        start, end = features.get('start'), features.get('end')
+        if (features.get('direction') == 'nearest' and start_angle is not None and start is not None
+                and end is not None and abs(start_angle-end) < abs(start_angle-start)):
+            return [end, start]
+        return [start, end]
+
+    def _fit(self):
+        prior = np.array([self.default_step-move_time(0.1, 5, 4), 1.0, 0.0])
+        rows = [row for row in self.history if row['kind'] in ('step', 'adaptive', 'average') and 'step_s' in row]
+
+        design = [np.sqrt(self.prior_weight)*np.eye(3)]
+        target = [np.sqrt(self.prior_weight)*prior]
+        if rows:
+            weight = np.sqrt([row['n_measured'] for row in rows])
+            design.append(weight[:, None]*np.array([[1.0, move_time(row['step'], row['velocity'], row['accl']),
+                                                     row['buff_size']*row['interval_ms']/1000] for row in rows]))
+            target.append(weight*np.array([row['step_s'] for row in rows]))
+        self.coefficients = np.linalg.lstsq(np.vstack(design), np.concatenate(target), rcond=None)[0]
+
+        overheads = [row['job_s']-row['n_measured']*row['step_s']-self._initial_move(row, row['start_from'])
+                     for row in rows if row['start_from'] is not None and row['kind'] != 'average']
+        self.overhead = float(np.median(overheads)) if overheads else self.default_overhead
+
+        fly = [row['job_s']-row['span']*row['dwell']/row['step']-self._initial_move(row, row['start_from'])
+               for row in self.history if row['kind'] == 'fly' and row['start_from'] is not None]
+        self.fly_overhead = float(np.median(fly)) if fly else self.default_fly_overhead
+
+        # settled points take as long as the noise needs, use what they took so far
+        settled = [row['step_s'] for row in self.history if row['kind'] == 'settled' and 'step_s' in row]
+        self.settled_step = float(np.median(settled)) if settled else None
+
+    def step_time(self, features):
+        x = [1.0, move_time(features['step'], features['velocity'], features['accl']),
+             features['buff_size']*features['interval_ms']/1000]
+        return max(float(np.dot(self.coefficients, x)), 0.0)
+
+    def predict(self, features, start_angle=None):
+        """
+        :param start_angle: arm position when the job starts, None if unknown
+        :return: duration in minutes
+        """
+        if features['kind'] == 'wait':
+            return features['seconds']/60
+        initial = self._initial_move(features, start_angle)
+        if features['kind'] == 'kinetics':
+            return (initial + features['seconds'] + self.overhead)/60
+        if features['kind'] == 'track':
+            # locating scan, then short steps across the bracket
+            bracket = dict(features, step=features['width']/max(features['bracket_points']-1, 1))
+            return (initial + features['n_points']*self.step_time(features) + 2*self.overhead
+                    + features['cycles']*features['bracket_points']*self.step_time(bracket))/60
+        if features['kind'] == 'fly':
+            return (initial + features['span']*features['dwell']/features['step'] + self.fly_overhead)/60
+        if features['kind'] == 'average':
+            # every repeat but the last returns to the start, the longest the job can take
+            scan = features['n_points']*self.step_time(features) + self.overhead
+            back = move_time(features['span'], features['velocity'], features['accl'])
+            return (initial + features['repeats']*scan + (features['repeats']-1)*back)/60
+        if features['kind'] == 'settled':
+            step = self.settled_step if self.settled_step is not None else self.step_time(features)+features['max_time']/2
+            return (initial + features['n_points']*step + self.overhead)/60
+        return (initial + features['n_points']*self.step_time(features) + self.overhead)/60
+
+    @staticmethod
+    def end_angle(features, start_angle):
+        """
+        Arm position after the job, None if it cannot be known in advance
+        """
+        if features['kind'] == 'wait':
+            return start_angle
+        return DurationModel.scan_ends(features, start_angle)[1]
+
+    def update_durations(self, jobs, start=0):
+        """
+        Refreshes the duration of each queued job with the latest timings, each job starts where the
+        previous one left the arms
+        :param start: first job to refresh, the ones before only give the arm position
+        :return: change of the summed durations
+        """
+        angle = self.last_angle
+        change = 0.0
+        for index, element in enumerate(jobs):
+            if element.features is None:
+                angle = None
+                continue
+            if index >= start:
+                duration = self.predict(element.features, angle)
+                change += duration-element.duration
+                element.duration = duration
+            angle = self.end_angle(element.features, angle)
+        return change
+
 class Newport_2936:
-    def __init__(self,interval_ms=1,buff_size=1000,wavelength=633):
-        try:
-            self.LIBNAME = r"C:\Program Files\Newport\Newport USB Driver\Bin\usbdll.dll"
-            self.lib = windll.LoadLibrary(self.LIBNAME)
-            self.product_id = 0xCEC7
-        except WindowsError as e:
-            print(e.strerror)
-            sys.exit(1)
+    simulated = False   # True for the SPR_simulator classes, stored with every file
+    # 'poll' returns as soon as the terminated reply has arrived, 'fixed' is the old 100 ms sleep
+    response_mode = 'poll'
+    response_timeout = 2.0  # seconds
+    poll_interval = (0.0005, 0.02)  # first and longest wait between reads, in seconds
+    # for firmware which drops the terminator: a single line reply then also ends once the reads have backed off
+    # to the longest poll interval without more data. Off by default, an empty read between the pieces of a
+    # reply would cut it short and the rest would be read as the next reply.
+    unterminated_replies = False
+    max_ds_size = 250000  # data store capacity
+    bulk_read_size = 65536  # bytes per driver read for data store transfers
+    # replies which never change while connected, asked once
+    constant_queries = ('*IDN?', 'PM:MIN:LAMBDA?', 'PM:MAX:LAMBDA?')
+    # settings whose last written value is remembered, writing the same value again is skipped
+    tracked_settings = ('PM:LAMBDA', 'PM:FILT', 'PM:DS:BUF', 'PM:DS:INT', 'PM:DS:SIZE')
+    max_command_length = 256  # characters per newp_usb_send_ascii when batching
+
+    def __init__(self,interval_ms=1,buff_size=1000,wavelength=633,device_id=None):
+        """
+        :param device_id: USB device id of the meter when several are connected, default the first one listed
+        """
+        self.latency = LatencyHistogram()
+        self._constants = {}
+        self._settings = {}
+        self._pending = None
 
+        self._load_library()
         self.open_device_all_products_all_devices()
         self.open_device_with_product_id()
         # here instrument[0] is the device id, [1] is the model number and [2] is the serial number
         self.instrument = self.get_instrument_list()
         [self.device_id, self.model_number, self.serial_number] = self.instrument
+        if device_id is not None:
+            self.device_id = device_id
 
         self.wavelength=wavelength
         self.set_wavelength(self.wavelength)
         self.interval_ms=interval_ms
         self.buff_size=buff_size
 
+        self.configure_ring_buffer()
+
+    def _load_library(self):
+        try:
+            self.LIBNAME = r"C:\Program Files\Newport\Newport USB Driver\Bin\usbdll.dll"
+            self.lib = windll.LoadLibrary(self.LIBNAME)
+            self.product_id = 0xCEC7
+        except WindowsError as e:
+            print(e.strerror)
+            sys.exit(1)
+
+    def configure_ring_buffer(self):
+        """
+        Continuous ring buffer used by read_buffer for the step scan
+        """
         reading_freq=int(self.interval_ms * 10)
 
-        self.write('PM:DS:BUF ' + str(1))  # set to act as ring buffer, where oldest values are overwritten  once buffer fills. Means average is always average of most recent period of time.
-        self.write('PM:DS:INT ' + str(reading_freq))  # measurement mode of 'CW continuous' puts measurements in the buffer at rate of 0.1ms, so here we take every nth reading
-        self.write('PM:DS:SIZE ' + str(self.buff_size))
-        self.write('PM:DS:EN 1') # triggers start of data collection
+        with self.batch():
+            self.write('PM:DS:EN 0')
+            self.write('PM:DS:BUF ' + str(1))  # set to act as ring buffer, where oldest values are overwritten  once buffer fills. Means average is always average of most recent period of time.
+            self.write('PM:DS:INT ' + str(reading_freq))  # measurement mode of 'CW continuous' puts measurements in the buffer at rate of 0.1ms, so here we take every nth reading
+            self.write('PM:DS:SIZE ' + str(self.buff_size))
+            self.write('PM:DS:EN 1') # triggers start of data collection
+
+    def start_capture(self, n_samples, interval_ms=None):
+        """
+        Arms the data store as a one-shot buffer which stops once n_samples readings are stored.
+        Call configure_ring_buffer afterwards to go back to step scan mode.
+        :param interval_ms: time between readings, default self.interval_ms
+        :return: host time (time.perf_counter) at which collection started
+        """
+        n_samples = min(int(n_samples), self.max_ds_size)
+        interval_ms = self.interval_ms if interval_ms is None else interval_ms
+        with self.batch():
+            self.write('PM:DS:EN 0')
+            self.write('PM:DS:CL')
+            self.write('PM:DS:BUF 0')  # fixed buffer, stops when full
+            self.write('PM:DS:INT ' + str(int(round(interval_ms * 10))))
+            self.write('PM:DS:SIZE ' + str(n_samples))
+            self.write('PM:DS:EN 1')
+        return time.perf_counter()
+
+    def read_data_store(self, chunk=None):
+        """
+        Downloads every value currently held in the data store
+        :param chunk: values per PM:DS:GET? query, None for a single transfer
+        :return: numpy array of power readings, oldest first
+        """
+        self.write('PM:DS:EN 0')
+        count = int(self.ask('PM:DS:COUNT?'))
+        return self._get_data_store(1, count, chunk)
+
+    def read_new(self, already_read):
+        """
+        Values stored after the first already_read, to follow a capture while it runs
+        :return: numpy array, empty if there is nothing new
+        """
+        count = int(self.ask('PM:DS:COUNT?'))
+        if count <= already_read:
+            return np.empty(0)
+        return self._get_data_store(already_read+1, count)
+
+    def read_samples(self, n=None):
+        """
+        Newest n values of the running data store (default: the whole ring buffer) in one transfer,
+        for statistics on the host instead of PM:STAT
+        :return: numpy array of power readings, oldest first
+        """
+        n = self.buff_size if n is None else int(n)
+        return self._parse_data_store(self.ask(f'PM:DS:GET? "-{n}"', terminator='End of Data\r\n',
+                                               read_size=self.bulk_read_size))
+
+    def _get_data_store(self, first, last, chunk=None):
+        """
+        Values first to last (1-based, inclusive) of the data store
+        """
+        chunk = max(last-first+1, 1) if chunk is None else chunk
+        parts = [np.empty(0)]
+        for start in range(first, last+1, chunk):
+            end = min(start+chunk-1, last)
+            parts.append(self._parse_data_store(self.ask(f'PM:DS:GET? "{start}-{end}"', terminator='End of Data\r\n',
+                                                         read_size=self.bulk_read_size)))
+        return np.concatenate(parts)
+
+    @staticmethod
+    def _parse_data_store(answer):
+        """
+        Values of a PM:DS:GET? reply, parsed by numpy in one pass rather than one float() per line
+        """
+        header_end = answer.find('End of Header')
+        if header_end >= 0:
+            body = answer[header_end+len('End of Header'):]
+        else:
+            # no header marker, the values start at the first line beginning with a number
+            first_value = re.search(r'^\s*[-+]?(\d|\.\d)', answer, re.MULTILINE)
+            body = answer[first_value.start():] if first_value else ''
+        data_end = body.find('End of Data')
+        if data_end >= 0:
+            body = body[:data_end]
+        return np.fromstring(body, sep=' ')
+
+    def read_settled(self, target_rse=2e-4, max_time=2.0, block=20, n_blocks=4, min_samples=40, poll=0.02):
+        """
+        Measurement for a point just after a move. The data store is re-armed, so no sample taken while the
+        arms were moving is used, and the new samples are read as they arrive. The reading counts as settled
+        once the means of n_blocks consecutive blocks agree pairwise within three standard errors (fewer can
+        agree by chance while the arms still ring), everything before those blocks is discarded. Averaging
+        then goes on only until the standard error of the mean is below target_rse (relative to the mean)
+        or max_time has passed, so quiet points finish early.
+        Call configure_ring_buffer afterwards to go back to read_buffer.
+        :param block: samples per settling block
+        :return: [mean, standard deviation, samples averaged, seconds until settled (nan if it never settled)]
+        """
+        n_max = min(int(max_time*1000/self.interval_ms)+1, self.max_ds_size)
+        started = self.start_capture(n_max)
+        samples = np.empty(0)
+        settled_at = None
+        while True:
+            time.sleep(poll)
+            samples = np.concatenate([samples, self.read_new(len(samples))])
+            if settled_at is None:
+                settled_at = self._settled_index(samples, block, n_blocks)
+
+            if settled_at is not None and len(samples)-settled_at >= min_samples:
+                settled = samples[settled_at:]
+                if np.std(settled, ddof=1)/np.sqrt(len(settled)) <= target_rse*abs(np.mean(settled)):
+                    break
+            if len(samples) >= n_max or time.perf_counter()-started > max_time:
+                break
+
+        if settled_at is None:
+            # never settled, the second half is the best there is
+            settled, settle_time = samples[len(samples)//2:], np.nan
+        else:
+            settled, settle_time = samples[settled_at:], settled_at*self.interval_ms/1000
+        std = np.std(settled, ddof=1) if len(settled) > 1 else np.nan
+        return [float(np.mean(settled)), float(std), len(settled), settle_time]
+
+    @staticmethod
+    def _settled_index(samples, block, n_blocks):
+        """
+        :return: index of the first sample of the first run of n_blocks blocks with equal means, None if there is none yet
+        """
+        available = len(samples)//block
+        if available < n_blocks:
+            return None
+        blocks = samples[:available*block].reshape(available, block)
+        means = blocks.mean(axis=1)
+        variances = blocks.var(axis=1, ddof=1)/block
+        agree = np.abs(np.diff(means)) <= 3*np.sqrt(variances[1:]+variances[:-1])
+        # runs of n_blocks-1 agreeing neighbours
+        runs = np.convolve(agree, np.ones(n_blocks-1, dtype=int), mode='valid') == n_blocks-1
+        first = np.flatnonzero(runs)
+        return int(first[0])*block if len(first) else None
 
     def open_device_all_products_all_devices(self):
         status = self.lib.newp_usb_init_system()  # SHhuld return a=0 if a device is connected
@@ -127,17 +619,28 @@ class Newport_2936:
         except CommandError as e:
             print(e)
 
-    def ask(self, query_string):
+    def ask(self, query_string, terminator='\r\n', read_size=1024):
         """
         Write a query and read the response from the device
         :rtype : String
         :param query_string: Check Manual for commands, ex '*IDN?'
+        :param terminator: end of a complete reply, multi-line replies have their own
+        :param read_size: bytes per driver read, larger for long replies
         :return: :raise CommandError:
         """
+        key = query_string.strip().upper()
+        if key in self._constants:
+            return self._constants[key]
+        if self._pending:
+            # commands batched so far have to reach the device before the query
+            pending, self._pending = self._pending, []
+            self._send_batch(pending)
+
         status = -1
         query = create_string_buffer(query_string.encode('ascii'))
         leng = c_ulong(sizeof(query))
         cdevice_id = c_long(self.device_id)
+        sent = time.perf_counter()
         status = self.lib.newp_usb_send_ascii(
             self.device_id, byref(query), leng)
         if status != 0:
@@ -146,9 +649,25 @@ class Newport_2936:
         else:
             pass
 
-        time.sleep(0.1)
-        response = create_string_buffer(1024)
-        leng = c_ulong(1024)
+        if self.response_mode == 'fixed':
+            time.sleep(0.1)
+            answer = self._read_ascii(cdevice_id, read_size)
+        else:
+            answer = self._poll_ascii(cdevice_id, sent + self.response_timeout, terminator, read_size)
+
+        self.latency.record(query_string, time.perf_counter() - sent)
+        answer = answer.rstrip('\r\n')
+        if key in self.constant_queries:
+            self._constants[key] = answer
+        return answer
+
+    def _read_ascii(self, cdevice_id, read_size=1024):
+        """
+        Single read of whatever the device has ready
+        :raise CommandError:
+        """
+        response = create_string_buffer(read_size)
+        leng = c_ulong(read_size)
         read_bytes = c_ulong()
         status = self.lib.newp_usb_get_ascii(
             cdevice_id, byref(response), leng, byref(read_bytes))
@@ -156,17 +675,115 @@ class Newport_2936:
         if status != 0:
             raise CommandError(
                 'Connection error or Something apperars to be wrong with your query string')
-        else:
-            answer = response.value[0:read_bytes.value].decode('ascii')
-            answer = answer.rstrip('\r\n')
-        return answer
+        return response.value[0:read_bytes.value].decode('ascii')
+
+    def _poll_ascii(self, cdevice_id, deadline, terminator='\r\n', read_size=1024):
+        """
+        Reads until the reply is terminated, backing off between empty reads.
+        Reads follow each other without waiting while data keeps arriving, and the pieces are only joined
+        at the end, so long data store replies cost one pass over the text. An empty read does not end a
+        reply, the rest may still be on its way, see unterminated_replies.
+        The driver reports an error while nothing is ready yet, so errors are only raised at the deadline.
+        :raise CommandError:
+        """
+        chunks = []
+        tail = ''
+        first_wait, longest_wait = self.poll_interval
+        wait = first_wait
+        waited = False  # slept since the last data
+        while True:
+            chunk = ''
+            try:
+                chunk = self._read_ascii(cdevice_id, read_size)
+                if chunk:
+                    chunks.append(chunk)
+                    tail = (tail+chunk)[-len(terminator):]
+                if tail == terminator:
+                    return ''.join(chunks)
+                if (self.unterminated_replies and terminator == '\r\n' and chunks and not chunk
+                        and waited and wait >= longest_wait):
+                    return ''.join(chunks)
+            except CommandError:
+                pass
+
+            if time.perf_counter() > deadline:
+                raise CommandError(
+                    f'No complete reply within {self.response_timeout} s, received {"".join(chunks)!r}')
+            if chunk:
+                # a long reply is still arriving, the timeout counts from the last data
+                deadline = max(deadline, time.perf_counter()+self.response_timeout)
+                wait = first_wait
+                waited = False
+                continue
+            time.sleep(wait)
+            waited = True
+            wait = min(wait*2, longest_wait)
 
     def write(self, command_string):
         """
-        Write a string to the device
-        :param command_string: Name of the string to be sent. Check Manual for commands
+        Write a string to the device. Settings the device already has (see tracked_settings) are skipped,
+        and inside batch() the commands are collected and sent together.
+        :param command_string: Name of the string to be sent, several separated by ';'. Check Manual for commands
         :raise CommandError:
         """
+        commands = [command.strip() for command in command_string.split(';') if command.strip()]
+        commands = [command for command in commands if not self._unchanged(command)]
+        if not commands:
+            return
+        if self._pending is not None:
+            self._pending.extend(commands)
+        else:
+            self._send_batch(commands)
+
+    @contextmanager
+    def batch(self):
+        """
+        Commands written inside the block go to the device in as few newp_usb_send_ascii calls as possible,
+        joined with ';'. A query inside the block sends what was collected before it first.
+        """
+        outer = self._pending is not None
+        if not outer:
+            self._pending = []
+        try:
+            yield self
+        finally:
+            if not outer:
+                pending, self._pending = self._pending, None
+                self._send_batch(pending)
+
+    def forget_settings(self):
+        """
+        Write every setting again next time, e.g. after the meter was reset or changed from its front panel
+        """
+        self._settings.clear()
+
+    def _unchanged(self, command):
+        """
+        True if command sets a tracked setting to the value it already has. Otherwise the value is remembered.
+        """
+        header, _, argument = command.partition(' ')
+        header = header.upper()
+        if header not in self.tracked_settings:
+            return False
+        if self._settings.get(header) == argument.strip():
+            return True
+        self._settings[header] = argument.strip()
+        return False
+
+    def _send_batch(self, commands):
+        batch = []
+        for command in commands:
+            if batch and len(';'.join(batch+[command])) > self.max_command_length:
+                self._send(';'.join(batch))
+                batch = []
+            batch.append(command)
+        if batch:
+            self._send(';'.join(batch))
+
+    def _send(self, command_string):
+        """
+        One newp_usb_send_ascii call
+        """
         command = create_string_buffer(bytes(command_string, 'ascii'))
         length = c_ulong(sizeof(command))
         cdevice_id = c_long(self.device_id)
@@ -179,6 +796,8 @@ class Newport_2936:
             else:
                 pass
         except CommandError as e:
+            # the device state is unknown now
+            self.forget_settings()
             print(e)
 
     def set_wavelength(self, wavelength):
@@ -190,8 +809,10 @@ class Newport_2936:
             print('Warning: Wavelength has to be an integer. Converting to integer')
             wavelength = int(wavelength)
 
+        # the limits are constant_queries, only the first call asks the device
         if wavelength >= int(self.ask('PM:MIN:Lambda?')) and wavelength <= int(self.ask('PM:MAX:Lambda?')):
             self.write('PM:Lambda ' + str(wavelength))
+            self.wavelength = wavelength
         else:
             print('Wavelenth out of range, use the current lambda')
 
@@ -211,7 +832,7 @@ class Newport_2936:
                 self.write('PM:FILT 1')  # Analog filtering
             elif filter_type == 2:
                 self.write('PM:FILT 2')  # Digital filtering
-            elif filter_type == 1:
+            elif filter_type == 3:
                 self.write('PM:FILT 3')  # Analog and Digital filtering
 
         else:  # if the user gives a float or string
@@ -250,15 +871,23 @@ class Newport_2936:
         :return:[wave,power_mean,power_std]
         """
         self.set_filtering()  # make sure their is no filtering
-        data = []
         num_of_points = (ewave - swave) / (1 * interval) + 1
+        wave = np.linspace(swave, ewave, int(num_of_points)).astype('int')
+        power_mean = np.empty(len(wave))
+        power_std = np.empty(len(wave))
 
-        for i in np.linspace(swave, ewave, int(num_of_points)).astype('int'):
-            data.extend(self.read_buffer())
-        data = [float(x) for x in data]
-        wave = data[0::3]
-        power_mean = data[1::3]
-        power_std = data[2::3]
+        previous = [self.buff_size, self.interval_ms, self.wavelength]
+        self.buff_size, self.interval_ms = buff_size, interval_ms
+        self.configure_ring_buffer()
+        try:
+            for idx, wavelength in enumerate(wave):
+                self.set_wavelength(int(wavelength))
+                time.sleep(buff_size*interval_ms/1000)  # refill the ring buffer at the new wavelength
+                [power_mean[idx], power_std[idx]] = self.read_buffer()
+        finally:
+            self.buff_size, self.interval_ms, self.wavelength = previous
+            self.set_wavelength(self.wavelength)
+            self.configure_ring_buffer()
         return [wave, power_mean, power_std]
 
     def sweep_instant_power(self, swave, ewave, interval):
@@ -270,10 +899,9 @@ class Newport_2936:
         :return:[wave,power]
         :return:
         """
-        self.set_filtering(self.device_id)  # make sure there is no filtering
+        self.set_filtering()  # make sure there is no filtering
         data = []
         num_of_points = (ewave - swave) / (1 * interval) + 1
-        import numpy as np
 
         for i in np.linspace(swave, ewave, int(num_of_points)).astype(int):
             data.extend(self.read_instant_power(i))
@@ -283,58 +911,1413 @@ class Newport_2936:
         return [wave, power]
 
     def plotter_instantpower(self, data):
+        import matplotlib.pyplot as plt
         plt.close('All')
         plt.plot(data[0], data[1], '-ro')
         plt.show()
 
     def plotter(self, data):
+        import matplotlib.pyplot as plt
         plt.close('All')
         plt.errorbar(data[0], data[1], data[2], fmt='ro')
         plt.show()
 
     def plotter_spectra(self, dark_data, light_data):
+        import matplotlib.pyplot as plt
         plt.close('All')
         plt.errorbar(dark_data[0], dark_data[1], dark_data[2], fmt='ro')
         plt.errorbar(light_data[0], light_data[1], light_data[2], fmt='go')
         plt.show()
 
+class ColumnBuffer:
+    """
+    Float columns preallocated for the expected number of rows and filled in place.
+    Only the first n rows are valid. Arrays handed out by columns() are views, so the plot and
+    the writer share the data without copying; a DataFrame is only built when saving.
+    """
+    __slots__ = ('data', 'n')
+    column_names = []
+
+    def __init__(self, n_points):
+        self.data = np.full((len(self.column_names), max(int(n_points), 1)), np.nan)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, *values):
+        if self.n == self.data.shape[1]:
+            self._grow()
+        self.data[:, self.n] = values
+        self.n += 1
+
+    def _grow(self):
+        # only needed when more rows arrive than planned (e.g. refinement passes)
+        new = np.full((self.data.shape[0], 2*self.data.shape[1]), np.nan)
+        new[:, :self.n] = self.data[:, :self.n]
+        self.data = new
+
+    def columns(self):
+        """
+        :return: list of views of the filled part, one per column
+        """
+        return list(self.data[:, :self.n])
+
+    def to_dataframe(self):
+        return pd.DataFrame(dict(zip(self.column_names, self.columns())))
+
+    def to_csv(self, filename):
+        self.to_dataframe().to_csv(filename, mode='a', header=True)
+
+class ScanResult(ColumnBuffer):
+    """
+    One angular scan: [angle, power, std_power]
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power"]
+
+class SettledResult(ColumnBuffer):
+    """
+    Scan measured with Newport_2936.read_settled, with the samples averaged and the settling time of each point
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power","Samples","Settle_time"]
+
+class RobustResult(ColumnBuffer):
+    """
+    Scan with the statistics of each point computed on the host from the raw readings, see robust_stats.
+    Samples counts all readings of the point, Rejected those left out of Power and Std_power.
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power","Median","Robust_std","Samples","Rejected"]
+
+class TrackResult(ColumnBuffer):
+    """
+    Points of a dip-tracking run, with the cycle they belong to and its start (epoch seconds)
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power","Cycle","Cycle_time"]
+
+class AdaptiveResult(ColumnBuffer):
+    """
+    Adaptive scan, with the refinement pass each point was measured in
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power","Pass"]
+
+class AveragedResult(ColumnBuffer):
+    """
+    Average of repeated scans: per angle the mean power, the SD of the repeats, the standard error of the mean
+    and the number of repeats averaged
+    """
+    __slots__ = ()
+    column_names = ["Angle","Power","Std_power","SE","Repeats"]
+
+class RunningAverage:
+    """
+    Per-angle mean and variance of repeated scans on a fixed angle grid, updated in place with Welford's
+    algorithm as each repeat finishes. Neither the repeats nor sums of squares are kept, the arrays are
+    allocated once for the grid.
+    """
+    def __init__(self, angles):
+        self.angles = np.asarray(angles, dtype=float)
+        self.count = np.zeros(len(self.angles), dtype=int)
+        self.mean = np.zeros(len(self.angles))
+        self.m2 = np.zeros(len(self.angles))
+        self.repeats = 0
+        self._spacing = (self.angles[-1]-self.angles[0])/max(len(self.angles)-1, 1) or 1.0
+
+    def add(self, angle, power):
+        """
+        Adds one repeat, each angle goes to the nearest grid point and NaN powers are left out
+        """
+        valid = np.isfinite(power)
+        index = np.clip(np.round((angle[valid]-self.angles[0])/self._spacing).astype(int), 0, len(self.angles)-1)
+        x = power[valid]
+        self.count[index] += 1
+        delta = x-self.mean[index]
+        self.mean[index] += delta/self.count[index]
+        self.m2[index] += delta*(x-self.mean[index])
+        self.repeats += 1
+
+    @property
+    def std(self):
+        """
+        SD of the repeats, NaN where fewer than two were averaged
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2/(self.count-1)), np.nan)
+
+    @property
+    def sem(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std/np.sqrt(self.count)
+
+    def largest_rse(self):
+        """
+        :return: largest standard error of any angle relative to the off-resonance (highest mean) power. Relative
+                 to its own mean the bottom of a deep dip would never converge.
+        """
+        if self.repeats < 2 or not np.any(self.count > 1):
+            return np.nan
+        return float(np.nanmax(self.sem)/np.max(np.abs(self.mean)))
+
+    def converged(self, target_rse):
+        """
+        :return: True once every angle has at least two repeats and a standard error below target_rse, see largest_rse
+        """
+        return bool(np.all(self.count > 1)) and self.largest_rse() <= target_rse
+
+    def result(self):
+        """
+        :return: the average as an AveragedResult, angles with no valid reading left out
+        """
+        measured = self.count > 0
+        out = AveragedResult(measured.sum())
+        out.data[:, :measured.sum()] = np.vstack([self.angles, self.mean, self.std, self.sem, self.count])[:, measured]
+        out.n = int(measured.sum())
+        return out
+
+    def to_state(self):
+        return {'repeats': self.repeats, 'count': self.count.tolist(), 'mean': self.mean.tolist(),
+                'm2': self.m2.tolist()}
+
+    def restore(self, state):
+        """
+        Continues from to_state(), e.g. of an interrupted job
+        """
+        self.repeats = state['repeats']
+        self.count[:] = state['count']
+        self.mean[:] = state['mean']
+        self.m2[:] = state['m2']
+
+class ScanWriter:
+    """
+    Streams a ColumnBuffer to disk while the scan runs, so a crash loses at most the last chunk.
+    Rows go to <file>.partial in chunks of chunk_size, with a flush and fsync at least every sync_interval
+    seconds, and close() renames the finished file into place atomically.
+    Formats:
+        csv     - same layout as DataFrame.to_csv, run metadata in a .json file next to it
+        parquet - one row group per chunk, metadata in the schema (needs pyarrow). A crashed .partial is unreadable.
+        hdf5    - one resizable dataset per column, metadata as attributes (needs h5py)
+    The data is read from the buffer's column views, nothing is copied until it is written.
+    With resume=True the rows of an existing .partial (from an interrupted run) are kept in recovered,
+    for the scan to put back into its buffer and continue from. They are written to a new file which then
+    replaces the .partial, so they are on disk the whole time and another crash cannot lose them.
+    With samples=True the raw readings of every point go to <file>_samples.f8 (little endian float64, one point
+    after the other), the Samples column says how many belong to each row, see load_samples.
+    """
+    extensions = {'csv': '.csv', 'parquet': '.parquet', 'hdf5': '.h5'}
+    backends = {'parquet': 'pyarrow', 'hdf5': 'h5py'}
+    chunk_size = 32
+    sync_interval = 5.0
+
+    @classmethod
+    def available_formats(cls):
+        """
+        :return: the formats whose backend is installed, found without importing it
+        """
+        return [fmt for fmt in cls.extensions
+                if fmt not in cls.backends or importlib.util.find_spec(cls.backends[fmt]) is not None]
+
+    @classmethod
+    def check_format(cls, fmt):
+        """
+        :raise ValueError: for an unknown format or one whose backend is not installed
+        """
+        if fmt not in cls.extensions:
+            raise ValueError(f'Unknown file format {fmt}')
+        if fmt not in cls.available_formats():
+            raise ValueError(f'The {fmt} format needs {cls.backends[fmt]}, which is not installed')
+
+    def __init__(self, filename, column_names, fmt='csv', metadata=None, resume=False, samples=False):
+        self.check_format(fmt)
+        self.filename = filename
+        self.partial = filename+'.partial'
+        self.column_names = list(column_names)
+        self.fmt = fmt
+        self.metadata = dict(metadata or {}, started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        self.written = 0
+        self._last_sync = time.monotonic()
+
+        self.recovered = np.empty((0, len(self.column_names)))
+        if resume and os.path.exists(self.partial):
+            try:
+                self.recovered = self._recover()
+            except Exception as e:
+                print(f'Could not read {self.partial}, starting the scan again: {e}')
+            self.metadata['resumed_rows'] = len(self.recovered)
+
+        self._samples = None
+        if samples:
+            self.samples_filename = os.path.splitext(filename)[0]+'_samples.f8'
+            self._samples = open(self.samples_filename+'.partial', 'ab' if len(self.recovered) else 'wb')
+            # drop the readings of rows which were not recovered
+            counts = self.recovered[:, self.column_names.index('Samples')]
+            self._samples.truncate(8*int(counts.sum()))
+
+        if len(self.recovered):
+            temp = self.partial+'.new'
+            self._open(temp)
+            self._write_columns(list(self.recovered.T), len(self.recovered))
+            self._sync()
+            # closed before the rename, Windows cannot replace an open file
+            self._file.close()
+            os.replace(temp, self.partial)
+            self._open(self.partial, append=True)
+        else:
+            self._open(self.partial)
+
+    def _open(self, path, append=False):
+        """
+        :param append: continue a file written by _open before, parquet files cannot be appended to
+        """
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            schema = pa.schema([(name, pa.float64()) for name in self.column_names],
+                               metadata={'spr_run': json.dumps(self.metadata)})
+            self._file = pq.ParquetWriter(path, schema)
+        elif self.fmt == 'hdf5':
+            import h5py
+            self._file = h5py.File(path, 'a' if append else 'w')
+            if not append:
+                for name in self.column_names:
+                    self._file.create_dataset(name, shape=(0,), maxshape=(None,), dtype='f8', chunks=(1024,))
+                self._write_hdf5_metadata()
+        else:
+            self._file = open(path, 'a' if append else 'w', newline='')
+
+    def _recover(self):
+        """
+        Rows of the .partial file, cut back to the last complete one. It is rewritten from the start afterwards.
+        """
+        if self.fmt == 'parquet':
+            # without the footer written by close() the row groups cannot be found
+            print(f'{self.partial} was not closed and cannot be read, starting the scan again')
+            return self.recovered
+        if self.fmt == 'hdf5':
+            import h5py
+            with h5py.File(self.partial, 'r') as f:
+                columns = [f[name][:] for name in self.column_names]
+        else:
+            with open(self.partial, 'rb') as f:
+                text = f.read()
+            if b'\n' not in text:
+                return self.recovered
+            table = pd.read_csv(io.BytesIO(text[:text.rfind(b'\n')+1]), index_col=0)
+            columns = [table[name].to_numpy(dtype=float) for name in self.column_names]
+
+        n = min(len(column) for column in columns)
+        rows = np.array([column[:n] for column in columns]).T.reshape(n, len(columns))
+        return rows[~np.isnan(rows).any(axis=1)]
+
+    def write(self, out, force=False):
+        """
+        Writes the rows of out added since the last call, once a full chunk or the sync interval is reached
+        """
+        pending = len(out)-self.written
+        due = time.monotonic()-self._last_sync > self.sync_interval
+        if pending <= 0 or not (force or due or pending >= self.chunk_size):
+            return
+        self._write_columns([column[self.written:len(out)] for column in out.columns()], len(out))
+        if force or due:
+            self._sync()
+
+    def _write_columns(self, columns, stop):
+        """
+        Appends the rows written to stop, one array per column
+        """
+        if self.fmt == 'parquet':
+            self._file.write_table(self._pa.table(dict(zip(self.column_names, columns))))
+        elif self.fmt == 'hdf5':
+            for name, column in zip(self.column_names, columns):
+                dataset = self._file[name]
+                dataset.resize((stop,))
+                dataset[self.written:] = column
+        else:
+            chunk = pd.DataFrame(dict(zip(self.column_names, columns)), index=range(self.written, stop))
+            chunk.to_csv(self._file, header=self.written == 0)
+        self.written = stop
+
+    def write_samples(self, values):
+        """
+        Appends the raw readings of the row just added, call before write
+        """
+        np.asarray(values, dtype='<f8').tofile(self._samples)
+
+    def _sync(self):
+        if self._samples is not None:
+            self._samples.flush()
+            os.fsync(self._samples.fileno())
+        if self.fmt == 'hdf5':
+            self._file.flush()
+        elif self.fmt == 'csv':
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def _write_hdf5_metadata(self):
+        for key, value in self.metadata.items():
+            self._file.attrs[key] = json.dumps(value)
+
+    def close(self, out, **metadata):
+        """
+        Writes the remaining rows and moves the file to its final name
+        :param metadata: added to the run metadata, e.g. fit results
+        """
+        self.write(out, force=True)
+        self.metadata.update(metadata, finished=time.strftime('%Y-%m-%dT%H:%M:%S'), points=len(out))
+
+        if self.fmt == 'parquet':
+            # the schema metadata is written with the footer
+            self._file.close()
+        elif self.fmt == 'hdf5':
+            self._write_hdf5_metadata()
+            self._file.close()
+        else:
+            if self.written == 0:
+                pd.DataFrame(columns=self.column_names).to_csv(self._file)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            with open(os.path.splitext(self.filename)[0]+'.json', 'w') as f:
+                json.dump(self.metadata, f, indent=1)
+
+        os.replace(self.partial, self.filename)
+        if self._samples is not None:
+            self._samples.flush()
+            os.fsync(self._samples.fileno())
+            self._samples.close()
+            os.replace(self.samples_filename+'.partial', self.samples_filename)
+
+    def abort(self, out=None):
+        """
+        Closes the file but leaves it as .partial, for a scan which did not finish
+        :param out: buffer of the scan, rows not yet written are written first
+        """
+        try:
+            if out is not None:
+                self.write(out, force=True)
+            if self.fmt == 'csv':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._file.close()
+            if self._samples is not None:
+                self._samples.close()
+        except Exception as e:
+            print(f'Could not close {self.partial}: {e}')
+
+def load_scan(filename):
+    """
+    Reads a scan written by ScanWriter (or the older to_csv files) into a DataFrame
+    """
+    if filename.endswith('.parquet') or filename.endswith('.parquet.partial'):
+        return pd.read_parquet(filename)
+    if filename.endswith('.h5') or filename.endswith('.h5.partial'):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return pd.DataFrame({name: f[name][:] for name in f.keys()})
+    return pd.read_csv(filename, index_col=0)
+
+def load_metadata(filename):
+    """
+    Run metadata of a scan written by ScanWriter, empty for older files without any
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        metadata = pq.read_schema(filename).metadata or {}
+        return json.loads(metadata.get(b'spr_run', b'{}'))
+    if filename.endswith('.h5'):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return {key: json.loads(value) for key, value in f.attrs.items()}
+    sidecar = os.path.splitext(filename)[0]+'.json'
+    if not os.path.exists(sidecar):
+        return {}
+    with open(sidecar) as f:
+        return json.load(f)
+
+def load_samples(filename):
+    """
+    Raw readings stored with a scan (ScanWriter with samples=True)
+    :return: list with an array of readings for each row of the scan
+    """
+    counts = load_scan(filename)['Samples'].to_numpy(dtype=int)
+    values = np.fromfile(os.path.splitext(filename)[0]+'_samples.f8', dtype='<f8')
+    return np.split(values[:counts.sum()], np.cumsum(counts)[:-1])
+
+class KineticsWriter:
+    """
+    Preallocated, memory-mapped time series for long fixed-angle runs: Time (seconds since t0 in the metadata)
+    and Power, little endian float64 records in <file>.dat. Samples are copied straight into the mapping, so
+    memory use does not grow with the run, and analysis tools can map the file without copying (load_kinetics),
+    also while it is written. The number of valid samples is kept in <file>.dat.json next to it, rewritten at
+    every sync (not <file>.json, which is the metadata of a csv scan of the same name). close() cuts the file
+    to the samples taken and moves it into place, like ScanWriter.
+    """
+    dtype = np.dtype([('Time', '<f8'), ('Power', '<f8')])
+    sync_interval = 5.0
+
+    def __init__(self, filename, capacity, metadata=None, resume=False):
+        """
+        :param capacity: samples to preallocate
+        :param resume: continue an interrupted run in the same .partial file
+        """
+        self.filename = filename
+        self.partial = filename+'.partial'
+        self.metadata_file = filename+'.json'
+        self.n = 0
+        self.metadata = dict(metadata or {}, t0=time.time(), started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+        if resume and os.path.exists(self.partial) and os.path.exists(self.metadata_file):
+            with open(self.metadata_file) as f:
+                previous = json.load(f)
+            # the time axis goes on from the first start, the interruption shows as a gap
+            self.metadata.update(t0=previous['t0'], started=previous['started'])
+            self.n = min(previous.get('samples', 0), os.path.getsize(self.partial)//self.dtype.itemsize)
+            capacity = max(capacity, self.n)
+            self.data = np.memmap(self.partial, dtype=self.dtype, mode='r+', shape=(capacity,))
+        else:
+            self.data = np.memmap(self.partial, dtype=self.dtype, mode='w+', shape=(capacity,))
+        self.capacity = capacity
+        self._last_sync = time.monotonic()
+        self._write_metadata()
+
+    def append(self, times, power):
+        """
+        :return: number of samples stored, fewer than given once the file is full
+        """
+        n = min(len(power), self.capacity-self.n)
+        self.data['Time'][self.n:self.n+n] = times[:n]
+        self.data['Power'][self.n:self.n+n] = power[:n]
+        self.n += n
+        if time.monotonic()-self._last_sync > self.sync_interval:
+            self.sync()
+        return n
+
+    def sync(self):
+        self.data.flush()
+        self._write_metadata()
+        self._last_sync = time.monotonic()
+
+    def _write_metadata(self):
+        self.metadata['samples'] = self.n
+        temp = self.metadata_file+'.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.metadata, f, indent=1)
+        os.replace(temp, self.metadata_file)
+
+    def close(self, **metadata):
+        self.data.flush()
+        del self.data
+        os.truncate(self.partial, self.n*self.dtype.itemsize)
+        os.replace(self.partial, self.filename)
+        self.metadata.update(metadata, finished=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        self._write_metadata()
+
+    def abort(self):
+        """
+        Keeps the samples so far in the .partial file
+        """
+        try:
+            self.sync()
+        except Exception as e:
+            print(f'Could not sync {self.partial}: {e}')
+
+def load_kinetics(filename):
+    """
+    Samples of a kinetics run (.dat, or its .partial while running), memory-mapped read-only without copying
+    :return: [record array view with fields Time and Power, metadata dict]
+    """
+    base = filename[:-len('.partial')] if filename.endswith('.partial') else filename
+    metadata_file = base+'.json'
+    if not os.path.exists(metadata_file):
+        # runs written before the metadata had its own name
+        metadata_file = os.path.splitext(base)[0]+'.json'
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    if metadata['samples'] == 0:
+        return [np.empty(0, dtype=KineticsWriter.dtype), metadata]
+    data = np.memmap(filename, dtype=KineticsWriter.dtype, mode='r')
+    return [data[:metadata['samples']], metadata]
+
+class Sensorgram(ColumnBuffer):
+    """
+    Fitted dip of every finished scan against wall-clock time (epoch seconds)
+    """
+    __slots__ = ()
+    column_names = ["Time","Dip_angle","Uncertainty","Depth","FWHM"]
+
+class KineticsView(ColumnBuffer):
+    """
+    Block averages of a kinetics run for the live plot: [time, mean power, std power].
+    The number of rows is bounded: when it is full, neighbouring rows are merged and from then on each row
+    averages twice as many polls, so a run of any length fits in the same memory at a coarser time resolution.
+    """
+    __slots__ = ('polls_per_row', '_sums')
+    column_names = ["Time","Power","Std_power"]
+
+    def __init__(self, n_points):
+        super().__init__(n_points)
+        self.polls_per_row = 1
+        self._sums = np.zeros(5)  # polls, samples, sum of time, power and power squared
+
+    def add(self, times, power):
+        """
+        Adds the samples of one poll, a row is appended once polls_per_row polls are collected
+        """
+        self._sums += [1, len(power), times.sum(), power.sum(), np.dot(power, power)]
+        polls, n, sum_t, sum_p, sum_p2 = self._sums
+        if polls < self.polls_per_row:
+            return
+        self._sums[:] = 0
+        if self.n == self.data.shape[1]:
+            self._merge()
+        self.append(sum_t/n, sum_p/n, np.sqrt(max(sum_p2/n-(sum_p/n)**2, 0)))
+
+    def _merge(self):
+        half = self.n//2
+        pairs = self.data[:, :2*half].reshape(len(self.column_names), half, 2)
+        new = np.full(self.data.shape, np.nan)
+        new[0, :half] = pairs[0].mean(axis=1)
+        new[1, :half] = pairs[1].mean(axis=1)
+        # std of the merged block from the two block stds and means (equal sizes)
+        new[2, :half] = np.sqrt((pairs[2]**2).mean(axis=1) + pairs[1].var(axis=1))
+        n = half
+        if self.n % 2:
+            new[:, n] = self.data[:, self.n-1]
+            n += 1
+        # swap in a new array, the render thread may still hold views of the old one
+        self.data = new
+        self.n = n
+        self.polls_per_row *= 2
+
+def decimate_minmax(x, y, max_points):
+    """
+    Reduces a trace to about max_points while keeping every peak and dip: the trace is cut into
+    max_points/2 buckets and the minimum and maximum of each bucket are kept, in their original order.
+    """
+    n = len(y)
+    if n <= max_points:
+        return x, y
+    buckets = max_points//2
+    size = -(-n//buckets)
+    padded = np.concatenate([y, np.full(buckets*size-n, y[-1])]).reshape(buckets, size)
+    offsets = np.arange(buckets)[:, None]*size
+    idx = np.sort(np.stack([padded.argmin(axis=1), padded.argmax(axis=1)], axis=1)+offsets, axis=1).ravel()
+    idx = np.minimum(idx, n-1)
+    return x[idx], y[idx]
+
+class LivePlot:
+    """
+    Plotting layer between the acquisition thread and Dear PyGui. Acquisition only flags new data
+    (update() is O(1) and never touches the GUI), and refresh(), called once per frame from the render
+    loop, sends the current scan if it changed. Long traces are min/max decimated to max_points.
+    Finished scans are kept as overlays by reference and only re-sent when the set of overlays changes.
+    The average of repeated scans is shown with a shaded band of two standard errors.
+    """
+    def __init__(self, max_points=4000, n_overlays=3):
+        self.max_points = max_points
+        self.overlays = deque(maxlen=n_overlays)
+        self.series = None
+        self.overlay_series = []
+        self.x_axis = None
+        self.average_series = None
+        self.band_series = None
+
+        self._lock = threading.Lock()
+        self._scan = None
+        self._sort = False
+        self._limits = None
+        self._dirty = False
+        self._overlays_dirty = False
+        self._average = None
+        self._average_dirty = False
+
+    def attach(self, series, x_axis=None, overlay_series=(), average_series=None, band_series=None):
+        """
+        :param series: line series for the running scan
+        :param overlay_series: one line series per overlay, newest first
+        :param average_series: line series for the average of repeated scans
+        :param band_series: shade series for its confidence band
+        """
+        self.series = series
+        self.x_axis = x_axis
+        self.overlay_series = list(overlay_series)
+        self.average_series = average_series
+        self.band_series = band_series
+
+    def show_average(self, average):
+        """
+        :param average: AveragedResult, replaced by the next call, None to clear the average
+        """
+        with self._lock:
+            self._average = average
+            self._average_dirty = True
+
+    def start_scan(self, out, limits=None, sort=False):
+        """
+        :param out: ColumnBuffer whose first two columns are plotted (x, y)
+        :param limits: x axis range, 'auto' to follow the data (e.g. a time axis), None leaves the axis as it is
+        :param sort: plot in x order, for scans which are not measured monotonically
+        """
+        with self._lock:
+            self._scan = out
+            self._sort = sort
+            self._limits = limits
+            self._dirty = True
+
+    def update(self):
+        self._dirty = True
+
+    def finish_scan(self, overlay=True):
+        """
+        :param overlay: keep the scan as an overlay, False for traces with a different x axis
+        """
+        with self._lock:
+            if overlay and self._scan is not None and len(self._scan):
+                self.overlays.appendleft((self._scan, self._sort))
+                self._overlays_dirty = True
+            self._dirty = True
+
+    def _xy(self, out, sort):
+        x, y = out.columns()[:2]
+        if sort:
+            order = np.argsort(x)
+            x, y = x[order], y[order]
+        return decimate_minmax(x, y, self.max_points)
+
+    def refresh(self):
+        """
+        Pushes changed data to the plot. Call from the render thread only.
+        """
+        if self.series is None or not (self._dirty or self._overlays_dirty or self._average_dirty):
+            return
+        with self._lock:
+            scan, sort, limits = self._scan, self._sort, self._limits
+            if limits != 'auto':
+                self._limits = None
+            overlays = list(self.overlays) if self._overlays_dirty else None
+            average = self._average if self._average_dirty else False
+            self._dirty = self._overlays_dirty = self._average_dirty = False
+
+        if limits is not None and limits != 'auto' and self.x_axis is not None:
+            dpg.set_axis_limits(self.x_axis, limits[0], limits[1])
+        if scan is not None:
+            dpg.set_value(self.series, list(self._xy(scan, sort)))
+        if limits == 'auto' and self.x_axis is not None:
+            dpg.set_axis_limits_auto(self.x_axis)
+            dpg.fit_axis_data(self.x_axis)
+        if overlays is not None:
+            for idx, series in enumerate(self.overlay_series):
+                # the newest overlay is the scan shown as the live trace, so start one further back
+                if idx+1 < len(overlays):
+                    dpg.set_value(series, list(self._xy(*overlays[idx+1])))
+                else:
+                    dpg.set_value(series, [[], []])
+        if average is not False and self.average_series is not None:
+            if average is None:
+                dpg.set_value(self.average_series, [[], []])
+                dpg.set_value(self.band_series, [[], [], []])
+            else:
+                angle, power, std_power, sem = average.columns()[:4]
+                dpg.set_value(self.average_series, [list(angle), list(power)])
+                band = np.nan_to_num(2*sem)
+                dpg.set_value(self.band_series, [list(angle), list(power-band), list(power+band)])
+
+DipFit = namedtuple('DipFit', ['angle', 'fwhm', 'depth', 'uncertainty', 'method'])
+
+def fit_dip(angle, power, std_power=None, method='polynomial'):
+    """
+    Fits the resonance dip of one scan. Everything is vectorised, a 300 point scan takes well under a millisecond.
+    :param std_power: per-point standard deviation, used for the centroid uncertainty when given
+    :param method: 'polynomial' - quadratic through the lower half of the dip
+                   'lorentzian' - Lorentzian linearised as 1/(baseline-P), quadratic in angle
+                   'centroid' - power-weighted centre of the part below half depth
+    :return: DipFit(angle, fwhm, depth, uncertainty, method), angles in degrees, NaN where undetermined.
+             The angle is NaN if there is no dip, the fit fails (e.g. repeated angles only), its centre lies
+             outside the fitted window or the lowest point is the first or last one of the scan: a dip at or
+             beyond the scanned range is neither located by extrapolation nor reported at the edge.
+    """
+    valid = np.isfinite(angle) & np.isfinite(power)
+    order = np.argsort(angle[valid])
+    x = angle[valid][order]
+    y = power[valid][order]
+    if len(x) < 3 or x[0] == x[-1]:
+        # nothing to fit, or all points at one angle
+        return DipFit(np.nan, np.nan, np.nan, np.nan, method)
+
+    i_min = int(np.argmin(y))
+    baseline = np.percentile(y, 90)
+    depth = baseline-y[i_min]
+    if not depth > 0:
+        # flat scan
+        return DipFit(np.nan, np.nan, np.nan, np.nan, method)
+    half_depth = y[i_min]+depth/2
+
+    # contiguous region around the minimum which lies below half depth, at least two points either side
+    above = y > half_depth
+    left = np.nonzero(above[:i_min])[0]
+    right = np.nonzero(above[i_min:])[0]
+    lo = left[-1]+1 if len(left) else 0
+    hi = i_min+right[0] if len(right) else len(x)
+    lo, hi = min(lo, max(i_min-2, 0)), max(hi, min(i_min+3, len(x)))
+
+    fwhm = np.nan
+    if len(left) and len(right):
+        l, r = left[-1], i_min+right[0]
+        x_left = np.interp(half_depth, [y[l+1], y[l]], [x[l+1], x[l]])
+        x_right = np.interp(half_depth, [y[r-1], y[r]], [x[r-1], x[r]])
+        fwhm = x_right-x_left
+
+    centre, uncertainty = x[i_min], np.nan
+    xs, ys = x[lo:hi], y[lo:hi]
+
+    try:
+        if method == 'polynomial' and len(xs) >= 3:
+            if len(xs) > 3:
+                (a, b, c), cov = np.polyfit(xs, ys, 2, cov=True)
+            else:
+                (a, b, c), cov = np.polyfit(xs, ys, 2), None
+            if a > 0:
+                centre = -b/(2*a)
+                if cov is not None:
+                    jac = np.array([b/(2*a**2), -1/(2*a), 0])
+                    uncertainty = np.sqrt(max(jac @ cov @ jac, 0))
+                depth = baseline-(c-b**2/(4*a))
+
+        elif method == 'lorentzian' and len(xs) >= 3:
+            dy = baseline-ys
+            keep = dy > 0
+            if keep.sum() >= 3:
+                # weight by dy**2 so the noisy shoulders of 1/dy do not dominate
+                weights = dy[keep]**2
+                (a, b, c), cov = (np.polyfit(xs[keep], 1/dy[keep], 2, w=weights, cov='unscaled')
+                                  if keep.sum() > 3 else (np.polyfit(xs[keep], 1/dy[keep], 2, w=weights), None))
+                q0 = c-b**2/(4*a)
+                if a > 0 and q0 > 0:
+                    centre = -b/(2*a)
+                    depth = 1/q0
+                    fwhm = 2*np.sqrt(q0/a)
+                    if cov is not None:
+                        residual = 1/dy[keep]-np.polyval([a, b, c], xs[keep])
+                        scale = np.sum(weights*residual**2)/max(keep.sum()-3, 1)
+                        jac = np.array([b/(2*a**2), -1/(2*a), 0])
+                        uncertainty = np.sqrt(max(scale*(jac @ cov @ jac), 0))
+
+        elif method == 'centroid':
+            weights = np.maximum(half_depth-ys, 0)
+            total = weights.sum()
+            if total > 0:
+                centre = np.sum(weights*xs)/total
+                if std_power is not None:
+                    noise = np.median(std_power[np.isfinite(std_power)])
+                else:
+                    # point to point scatter away from the dip
+                    noise = np.std(np.diff(y[above]))/np.sqrt(2) if above.sum() > 2 else np.nan
+                uncertainty = noise*np.sqrt(np.sum((xs-centre)**2))/total
+    except (np.linalg.LinAlgError, ValueError):
+        # singular or rank deficient fit window, e.g. repeated angles only
+        return DipFit(np.nan, np.nan, np.nan, np.nan, method)
+
+    if not xs[0] <= centre <= xs[-1] or i_min in (0, len(x)-1):
+        centre, uncertainty = np.nan, np.nan
+
+    return DipFit(float(centre), float(fwhm), float(depth), float(uncertainty), method)
+
+class DipTracker:
+    """
+    Fits the dip while a scan is running and once it has finished, and keeps the sensorgram of
+    every finished scan. on_update is called from the acquisition thread after each fit.
+    """
+    min_points = 5
+
+    def __init__(self, method='polynomial', on_update=None):
+        self.method = method
+        self.on_update = on_update
+        self.sensorgram = Sensorgram(256)
+        self.live = None
+        self.fit_seconds = 0.0
+
+    def reset(self):
+        self.live = None
+
+    def update(self, out):
+        """
+        Incremental fit of a scan in progress
+        """
+        if len(out) < self.min_points:
+            return None
+        angle, power, std_power = out.columns()[:3]
+        started = time.perf_counter()
+        try:
+            self.live = fit_dip(angle, power, std_power, self.method)
+        except Exception as e:
+            # only for display, it must not stop the measurement
+            print(f"Live dip fit failed: {e!r}")
+            return None
+        self.fit_seconds = time.perf_counter()-started
+        self._notify()
+        return self.live
+
+    def finish(self, out, filename=None):
+        """
+        Final fit of a completed scan, added to the sensorgram and to sensorgram.csv next to the scan file
+        """
+        angle, power, std_power = out.columns()[:3]
+        fit = fit_dip(angle, power, std_power, self.method)
+        print(f"Dip at {np.round(fit.angle,4)} +/- {np.round(fit.uncertainty,4)} deg, depth {fit.depth:.4g}, FWHM {np.round(fit.fwhm,3)} deg")
+        return self.record(fit, filename)
+
+    def record(self, fit, filename=None):
+        """
+        Adds a fit to the sensorgram and to sensorgram.csv next to filename
+        """
+        self.live = fit
+        now = time.time()
+        self.sensorgram.append(now, fit.angle, fit.uncertainty, fit.depth, fit.fwhm)
+
+        if filename is not None:
+            log = os.path.join(os.path.dirname(filename), 'sensorgram.csv')
+            new_log = not os.path.exists(log)
+            with open(log, 'a') as f:
+                if new_log:
+                    f.write(','.join(["File"]+Sensorgram.column_names)+'\n')
+                f.write(f"{os.path.basename(filename)},{now},{fit.angle},{fit.uncertainty},{fit.depth},{fit.fwhm}\n")
+
+        self._notify()
+        return fit
+
+    def _notify(self):
+        if self.on_update is not None:
+            self.on_update()
+
 class QueueElement:
-    def __init__(self, name, func, duration):
+    """
+    One queued job as plain data: the job type (a key of JOB_TYPES) and the keyword arguments of its function,
+    so the queue can be written to disk and read back. state belongs to the job, e.g. the file an unfinished
+    scan is writing, and lets an interrupted job continue where it stopped.
+    """
+    def __init__(self, name, kind, params, duration, features=None, state=None):
         self.name=name
-        self.func=func
+        self.kind=kind
+        self.params=params
         self.duration=duration
+        self.features=features  # job description for the DurationModel
+        self.state=state if state is not None else {}
         
     def execute(self):
-        self.func()
-        
+        JOB_TYPES[self.kind](**self.params, state=self.state)
+
+    def copy(self):
+        """
+        Same job to run again, without the progress of this one
+        """
+        return QueueElement(self.name, self.kind, json.loads(json.dumps(self.params)), self.duration,
+                            json.loads(json.dumps(self.features)))
+
+    def to_dict(self):
+        return {'name': self.name, 'kind': self.kind, 'params': self.params, 'duration': self.duration,
+                'features': self.features, 'state': self.state}
+
+    @classmethod
+    def from_dict(cls, spec):
+        if spec['kind'] not in JOB_TYPES:
+            raise ValueError(f"Unknown job type {spec['kind']}")
+        return cls(spec['name'], spec['kind'], spec['params'], spec.get('duration', 0.0),
+                   spec.get('features'), spec.get('state'))
+
+class QueueFile:
+    """
+    The experiment queue on disk, rewritten on every change. The file is replaced atomically, so after
+    a crash it holds either the old or the new queue. Finished jobs are removed from the queue, so a
+    restored queue starts with the job that was running (or the next one).
+    """
+    def __init__(self, filename):
+        self.filename=filename
+
+    def save(self, jobs):
+        temp=self.filename+'.tmp'
+        with open(temp, 'w') as f:
+            json.dump([element.to_dict() for element in jobs], f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.filename)
+
+    def load(self):
+        """
+        :return: list of QueueElement, empty if there is no saved queue
+        """
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename) as f:
+            return [QueueElement.from_dict(spec) for spec in json.load(f)]
+
+class JobQueue:
+    """
+    The experiment queue: QueueElements in order, shared by the GUI, the QueueExecutor and the QueueFile.
+    Every change goes through a method which holds the lock and then calls each listener with
+    (event, index, elements), event being 'insert' or 'remove', so views only update what changed.
+    total is the sum of the predicted durations, kept up to date with every change.
+    Jobs are found by identity, the head of the queue (the running job) is found at once.
+    """
+    def __init__(self, jobs=(), lock=None):
+        self.lock = lock if lock is not None else threading.RLock()
+        self._jobs = list(jobs)
+        self.total = sum(element.duration for element in self._jobs)
+        self.listeners = []
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, index):
+        return self._jobs[index]
+
+    def __iter__(self):
+        # over a snapshot, other threads may change the queue meanwhile
+        with self.lock:
+            return iter(list(self._jobs))
+
+    def index(self, element):
+        """
+        :return: position of element, None if it is not queued
+        """
+        with self.lock:
+            for index, queued in enumerate(self._jobs):
+                if queued is element:
+                    return index
+        return None
+
+    def insert(self, index, elements):
+        """
+        Inserts a block of jobs before index, None appends them
+        :return: index of the first inserted job
+        """
+        elements = list(elements)
+        with self.lock:
+            index = len(self._jobs) if index is None else max(0, min(index, len(self._jobs)))
+            self._jobs[index:index] = elements
+            self.total += sum(element.duration for element in elements)
+            self._notify('insert', index, elements)
+        return index
+
+    def append(self, element):
+        self.insert(None, [element])
+
+    def repeat(self, start, stop, times, at=None):
+        """
+        Inserts times copies of the jobs start to stop (inclusive), without their progress
+        :param at: position of the copies, None appends them, stop+1 puts them right after the block
+        """
+        with self.lock:
+            block = self._jobs[start:stop+1]
+            return self.insert(at, [element.copy() for idx in range(times) for element in block])
+
+    def delete(self, start, stop=None):
+        """
+        Removes the jobs start to stop (inclusive)
+        :return: the removed jobs
+        """
+        stop = start if stop is None else stop
+        with self.lock:
+            removed = self._jobs[start:stop+1]
+            del self._jobs[start:stop+1]
+            # no rounding residue once the queue is empty
+            self.total = self.total-sum(element.duration for element in removed) if self._jobs else 0.0
+            self._notify('remove', start, removed)
+        return removed
+
+    def remove(self, element):
+        """
+        Removes element by identity
+        :return: False if it was not queued
+        """
+        with self.lock:
+            index = self.index(element)
+            if index is None:
+                return False
+            self.delete(index)
+        return True
+
+    def move(self, index, new_index):
+        with self.lock:
+            new_index = max(0, min(new_index, len(self._jobs)-1))
+            if new_index != index:
+                self.insert(new_index, self.delete(index))
+
+    def clear(self, keep=None):
+        """
+        :param keep: job which stays, e.g. the running one
+        """
+        with self.lock:
+            for index in reversed(range(len(self._jobs))):
+                if self._jobs[index] is not keep:
+                    self.delete(index)
+
+    def update_durations(self, model, start=0):
+        """
+        Re-predicts the durations from job start on with the DurationModel and adds the change to the total
+        """
+        with self.lock:
+            self.total += model.update_durations(self._jobs, start)
+
+    def _notify(self, event, index, elements):
+        for listener in self.listeners:
+            listener(event, index, elements)
+
+class JobAborted(Exception):
+    '''The running job was stopped by an abort-now request'''
+
+class QueueExecutor:
+    """
+    Drains the experiment queue on a background thread so the render loop keeps running.
+    Jobs are taken from the head of the queue one at a time and only removed once finished,
+    so the queue can still be edited (while holding the lock) during a run.
+    """
+    def __init__(self, jobs, lock, on_progress=None, on_started=None, on_finished=None, on_removed=None):
+        self.jobs=jobs
+        self.lock=lock
+        self.on_progress=on_progress    # called from the worker thread, must marshal to the UI itself
+        self.on_started=on_started      # on_started(element)
+        self.on_finished=on_finished    # on_finished(element, seconds), only for jobs which completed
+        self.on_removed=on_removed      # on_removed(element), after a finished job left the queue
+        self.current=None
+        self.progress=0.0               # fraction of the current job done, set by the job itself
+
+        self._thread=None
+        self._resume=threading.Event()
+        self._resume.set()
+        self._abort_after=threading.Event()
+        self._abort_now=threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        """
+        Waits for the run to end.
+        :return: True if no run is in progress
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    def start(self):
+        """
+        Starts draining the queue. Returns False if a run is already in progress.
+        """
+        if self.running:
+            return False
+
+        self._abort_after.clear()
+        self._abort_now.clear()
+        self._resume.set()
+        self._thread=threading.Thread(target=self._run, name='QueueExecutor', daemon=True)
+        self._thread.start()
+        return True
+
+    def pause(self):
+        self._resume.clear()
+        self._notify()
+
+    def resume(self):
+        self._resume.set()
+        self._notify()
+
+    def abort_after_current(self):
+        self._abort_after.set()
+        self._notify()
+
+    def abort_now(self):
+        self._abort_after.set()
+        self._abort_now.set()
+        self._resume.set()  # a paused job has to wake up to see the abort
+        self._notify()
+
+    def checkpoint(self):
+        """
+        Called by jobs between measurement points. Blocks while paused.
+        :raise JobAborted: if abort-now was requested
+        """
+        self._resume.wait()
+        self.check_abort()
+
+    def check_abort(self):
+        """
+        For jobs which cannot stop in the middle, e.g. a fly scan sweep: only abort-now is honoured, a pause
+        waits for the next checkpoint.
+        :raise JobAborted: if abort-now was requested
+        """
+        if self._abort_now.is_set():
+            raise JobAborted()
+
+    def sleep(self, seconds):
+        """
+        time.sleep replacement for jobs, wakes up early on abort-now.
+        """
+        deadline=time.monotonic()+seconds
+        while True:
+            self.checkpoint()
+            remaining=deadline-time.monotonic()
+            self.progress=1-max(remaining, 0)/seconds if seconds > 0 else 1.0
+            if remaining<=0:
+                return
+            self._abort_now.wait(min(remaining, 0.1))
+
+    def status(self):
+        if not self.running:
+            return 'Idle'
+        elif self.paused:
+            return 'Paused'
+        elif self._abort_after.is_set():
+            return 'Stopping after current job'
+        return 'Running'
+
+    def _notify(self):
+        if self.on_progress is not None:
+            self.on_progress()
+
+    def _run(self):
+        while not self._abort_after.is_set():
+            self._resume.wait()
+            if self._abort_after.is_set():
+                break
+
+            with self.lock:
+                if len(self.jobs)==0:
+                    break
+                element=self.jobs[0]
+                self.current=element
+                self.progress=0.0
+            self._notify()
+
+            print(f"Running: {element.name}.")
+            if self.on_started is not None:
+                self.on_started(element)
+            started=time.monotonic()
+            try:
+                element.execute()
+            except JobAborted:
+                # leave the aborted job at the head of the queue so it can be rerun or deleted
+                print(f"Aborted: {element.name}.")
+                break
+            except Exception as e:
+                print(f"Job failed: {element.name}. {e}")
+                break
+            else:
+                if self.on_finished is not None:
+                    self.on_finished(element, time.monotonic()-started)
+                with self.lock:
+                    # by identity, the queue may have been edited while the job ran
+                    self.jobs.remove(element)
+                if self.on_removed is not None:
+                    self.on_removed(element)
+            finally:
+                with self.lock:
+                    self.current=None
+                self._notify()
+
+        with self.lock:
+            remaining=len(self.jobs)
+        print("Queue finished!" if remaining==0 else f"Queue stopped, {remaining} job(s) left.")
+        self._notify()
+
+def run_on_ui(func, *args, **kwargs):
+    """
+    Schedules a call on the render thread. Dear PyGui items should only be touched from there.
+    """
+    ui_calls.put((func, args, kwargs))
+
+def process_ui_calls():
+    """
+    Runs everything scheduled with run_on_ui. Called once per frame from the render loop.
+    """
+    while True:
+        try:
+            func, args, kwargs = ui_calls.get_nowait()
+        except queue.Empty:
+            return
+        lap = phase_timer.start()
+        func(*args, **kwargs)
+        lap('ui')
+
+def publish_point(angle, mean_power, std_power, timestamp=None):
+    """
+    Puts a measured point on the shared memory live feed, if there is one, see SPR_livefeed.py
+    """
+    if live_feed is not None:
+        live_feed.publish(angle, mean_power, std_power, executor.current, timestamp)
+
+def save_queue(*args):
+    """
+    Writes the queue to queue_file, if there is one. Called after every change to the queue or to a job's state.
+    """
+    if queue_file is None:
+        return
+    with queue_lock:
+        try:
+            queue_file.save(experiment_queue)
+        except OSError as e:
+            print(f"Could not save the queue to {queue_file.filename}: {e}")
+
+def install(xps, meter, jobs=(), store=None, timings_file=None, feed=None, on_progress=None, on_dip_update=None):
+    """
+    Sets the globals the jobs run with: the instruments, the queue and its executor, the duration model,
+    the dip tracker, the live plot and the live feed. The GUI, SPR_headless and SPR_benchmark all start here.
+    :param meter: the 2936, becomes nd
+    :param jobs: QueueElements the queue starts with
+    :param store: QueueFile the queue is saved to after every change, None for none, becomes queue_file
+    :param timings_file: history of the DurationModel, None keeps it in memory only
+    :param feed: name of the shared memory live feed, None for none
+    :param on_progress: QueueExecutor callback, called from the worker thread
+    :param on_dip_update: DipTracker callback, called after every live fit
+    """
+    global xps1, nd, queue_file, queue_lock, experiment_queue, duration_model, executor, dip_tracker, live_plot, live_feed
+    xps1 = xps
+    nd = meter
+    queue_file = store
+    queue_lock = threading.RLock()
+    experiment_queue = JobQueue(jobs, queue_lock)
+    duration_model = DurationModel(timings_file)
+    executor = QueueExecutor(experiment_queue, queue_lock, on_progress=on_progress,
+                             on_started=duration_model.job_started, on_finished=duration_model.job_finished,
+                             on_removed=save_queue)
+    dip_tracker = DipTracker(method='polynomial', on_update=on_dip_update)
+    live_plot = LivePlot(max_points=4000, n_overlays=3)
+    live_feed = None
+    if feed is not None:
+        try:
+            live_feed = LiveFeed(feed)
+        except OSError as e:
+            print(f'No live feed for other programs: {e}')
+
+ui_calls = queue.Queue()
+phase_timer = PhaseTimer()
+queue_file = None
+live_feed = None
+
 # ===================================
 
 def xps_home_callback(sender, data):
 
+    if not instruments_free():
+        return
     pos = dpg.get_value(dpg_move_pos)
     xps1.home_group("XY")
     dpg.configure_item(dpg_move, enabled=True)
     dpg.configure_item(dpg_run, enabled=True)
     dpg.set_value(dpg_move_pos, 90)
+    duration_model.last_angle = 90
     rel_pos[0] = 0
     rel_pos_str = f"Position: [{str(rel_pos[0])}]"
     dpg.set_value(dpg_rel_pos_str, rel_pos_str)
 
 def xps_move_callback(sender, data):
 
+    if not instruments_free():
+        return
     pos_rel = dpg.get_value(dpg_move_pos)
     pos_abs = [90-pos_rel]
     
     xps1.move_abs("XY", pos_abs[0])
+    duration_model.last_angle = pos_rel
     rel_pos_str = f"Position: [{str(pos_rel)}]"
     dpg.set_value(dpg_rel_pos_str, rel_pos_str)
     
 def nd_wav_callback(sender, data):
 
+    if not instruments_free():
+        return
     wav = dpg.get_value(dpg_wav_val)
     nd.wavelength=wav
     nd.set_wavelength(wav)
 
+def instruments_free():
+    """
+    The XPS and the 2936 belong to the queue while it runs: a move would shift the scan and a query on the
+    USB handle could take the reply meant for the running job
+    """
+    if executor.running:
+        print("Not while the queue is running, pause does not release the instruments either.")
+        return False
+    return True
+
+def update_instrument_controls():
+    """
+    Disables the motion and power meter buttons while the queue runs. Called from update_executor_status and
+    every second from the render loop, the last status update of a run can arrive before its thread has ended.
+    """
+    free = not executor.running
+    if dpg.get_item_configuration(dpg_home)['enabled'] != free:
+        dpg.configure_item(dpg_home, enabled=free)
+        dpg.configure_item(dpg_wav, enabled=free)
+        # Move only once homed
+        dpg.configure_item(dpg_move, enabled=free and dpg.get_item_configuration(dpg_run)['enabled'])
+
+def nd_latency_callback(sender, data):
+
+    print(nd.latency.report())
+
+def scan_features(exp_range, step, n_points):
+    """
+    Description of a stop-and-go scan for the DurationModel, with the current velocity and buffer settings
+    """
+    velo, accl = xps1.velocity
+    return {'kind': 'step', 'start': exp_range[0], 'end': exp_range[1], 'span': abs(exp_range[1]-exp_range[0]),
+            'step': step, 'n_points': n_points, 'velocity': velo, 'accl': accl,
+            'buff_size': nd.buff_size, 'interval_ms': nd.interval_ms}
+
+def job_features(kind, params):
+    """
+    Description of a queued job for the DurationModel, from the keyword arguments of its function.
+    Arguments that are not given take the defaults of the job function.
+    """
+    params = dict(job_defaults(kind), **params)
+    if kind == 'wait':
+        return {'kind': 'wait', 'seconds': params['wait_time']}
+    velo, accl = xps1.velocity
+    if kind == 'kinetics':
+        return {'kind': 'kinetics', 'start': params['angle'], 'end': params['angle'], 'seconds': params['duration'],
+                'velocity': velo, 'accl': accl}
+
+    exp_range, step = params['exp_range'], params['step']
+    degrees_scanned = abs(exp_range[1]-exp_range[0])
+    features = scan_features(exp_range, step, int(degrees_scanned/step)+1)
+    if kind == 'adaptive':
+        # coarse pass plus roughly two fine passes over the window, the arms finish near the dip
+        features.update(kind='adaptive', end=None, n_points=int(degrees_scanned/max(params['coarse_step'], step))+1
+                        + int(2*params['window']/step))
+    elif kind == 'track':
+        # the arms finish near the dip
+        features.update(kind='track', width=params['width'], bracket_points=params['n_points'],
+                        cycles=params['cycles'], end=None)
+    elif kind == 'fly':
+        features.update(kind='fly', dwell=params['dwell'])
+    elif kind == 'average':
+        # at most repeats scans, an early stop leaves the arms at either end
+        features.update(kind='average', repeats=params['repeats'], end=None)
+        return features
+    elif params.get('settle') is not None:
+        features.update(kind='settled', target_rse=params['settle'].get('target_rse', 2e-4),
+                        max_time=params['settle'].get('max_time', 2.0))
+    if params.get('direction') == 'nearest':
+        features.update(direction='nearest')
+    return features
+
+def job_defaults(kind):
+    """
+    :return: dict of the keyword arguments of the job function which have a default
+    """
+    return {name: parameter.default for name, parameter in inspect.signature(JOB_TYPES[kind]).parameters.items()
+            if parameter.default is not inspect.Parameter.empty and name != 'state'}
+
 def add_exp_to_queue_callback():
     global experiment_queue
     
@@ -343,20 +2326,61 @@ def add_exp_to_queue_callback():
     step = dpg.get_value(dpg_step)
     directory= dpg.get_value(dpg_dir)
     file = dpg.get_value(dpg_file)   
+    mode = dpg.get_value(dpg_scan_mode)
+    dwell = dpg.get_value(dpg_dwell)
+    fmt = dpg.get_value(dpg_save_format)
     
-    # estimate duration
-    # estimate takes 145s for 201 steps ->   0.72 seconds/step
-    degrees_scanned=abs(exp_range[1]-exp_range[0])
-    n_steps=int(degrees_scanned/step)+1
-    duration=(n_steps*0.72/60)+0.5 #minutes, time added for initial positioning
+    params={'exp_range': list(exp_range[0:2]), 'step': step, 'directory': directory, 'file': file, 'fmt': fmt}
 
     # now create element to add to queue
-    message=f'Range: {exp_range[0:2]}, Step: {np.round(step,3)}'
+    if mode == "Adaptive scan":
+        coarse_step=dpg.get_value(dpg_coarse_step)
+        window=dpg.get_value(dpg_window)
+        message=f'Adaptive: {exp_range[0:2]}, Step: {np.round(step,3)}, Coarse: {np.round(coarse_step,3)}, Window: {np.round(window,2)}'
+        kind='adaptive'
+        params.update(coarse_step=coarse_step, window=window)
+    elif mode == "Settled scan":
+        settle={'target_rse': dpg.get_value(dpg_target_rse), 'max_time': dpg.get_value(dpg_max_settle)}
+        message=f'Settled: {exp_range[0:2]}, Step: {np.round(step,3)}, SE: {settle["target_rse"]:.1e}, Max: {np.round(settle["max_time"],2)} s'
+        kind='step'
+        params.update(settle=settle)
+    elif mode == "Dip tracking":
+        track={'width': dpg.get_value(dpg_track_width), 'n_points': dpg.get_value(dpg_track_points),
+               'cycles': dpg.get_value(dpg_track_cycles)}
+        message=f'Track: {exp_range[0:2]}, Step: {np.round(step,3)}, Bracket: {np.round(track["width"],2)} deg x {track["n_points"]}, {track["cycles"]} cycles'
+        kind='track'
+        params.update(track)
+    elif mode == "Averaged scan":
+        repeats=dpg.get_value(dpg_avg_repeats)
+        target_rse=dpg.get_value(dpg_avg_target) or None
+        message=f'Average: {exp_range[0:2]}, Step: {np.round(step,3)}, {repeats} repeats'
+        if target_rse is not None:
+            message+=f' or SE {target_rse:.1e}'
+        kind='average'
+        params.update(repeats=repeats, target_rse=target_rse)
+    elif mode == "Fly scan":
+        message=f'Fly: {exp_range[0:2]}, Step: {np.round(step,3)}, Dwell: {np.round(dwell,3)} s'
+        kind='fly'
+        params.update(dwell=dwell)
+    else:
+        message=f'Range: {exp_range[0:2]}, Step: {np.round(step,3)}'
+        kind='step'
+        if dpg.get_value(dpg_host_stats):
+            params.update(host_stats={'reject': 5.0, 'keep_samples': dpg.get_value(dpg_keep_samples)})
+            message+=', host statistics' + (' + samples' if params['host_stats']['keep_samples'] else '')
+    if kind == 'average' and dpg.get_value(dpg_serpentine):
+        print("Averaged scans are not run serpentine, every repeat goes forward.")
+    if kind in ('step', 'fly') and dpg.get_value(dpg_serpentine):
+        # start at the end nearest the arms, consecutive scans then go back and forth without a return move
+        params.update(direction='nearest')
+        message+=', serpentine'
     print(f'ADDED TO QUEUE: {message}')
+    features=job_features(kind, params)
+    duration=duration_model.predict(features)
     
-    element=QueueElement(message, lambda: experiment(exp_range, step, directory, file), duration)
-    experiment_queue+=[element]
-    show_queue_callback()
+    element=QueueElement(message, kind, params, duration, features)
+    experiment_queue.append(element)
+    save_queue()
 
 def add_wait_to_queue_callback():
     global experiment_queue
@@ -368,58 +2392,95 @@ def add_wait_to_queue_callback():
     message=(f'Wait: {wait_time} seconds')
     print(f'ADDED TO QUEUE: {message}')
     
-    element=QueueElement(message, lambda: wait(wait_time), wait_time/60)
-    experiment_queue+=[element]
-    show_queue_callback()
+    element=QueueElement(message, 'wait', {'wait_time': wait_time}, wait_time/60, {'kind': 'wait', 'seconds': wait_time})
+    experiment_queue.append(element)
+    save_queue()
+
+def add_kinetics_to_queue_callback():
+    global experiment_queue
+
+    # Read information from GUI
+    angle=dpg.get_value(dpg_kin_angle)
+    seconds=60*dpg.get_value(dpg_kin_minutes)
+    interval_ms=dpg.get_value(dpg_kin_interval)
+    directory=dpg.get_value(dpg_dir)
+    file=dpg.get_value(dpg_file)
+
+    message=f'Kinetics: {np.round(angle,3)} deg, {np.round(seconds/60,1)} min, {np.round(interval_ms,2)} ms/sample'
+    print(f'ADDED TO QUEUE: {message}')
+    params={'angle': angle, 'duration': seconds, 'directory': directory, 'file': file, 'interval_ms': interval_ms}
+    features=job_features('kinetics', params)
+
+    element=QueueElement(message, 'kinetics', params, duration_model.predict(features), features)
+    experiment_queue.append(element)
+    save_queue()
 
 def clear_queue_callback():
     global experiment_queue
-    experiment_queue=[]
+    # the running job stays until it finishes
+    experiment_queue.clear(keep=executor.current)
+    save_queue()
     print('QUEUE CLEARED.')
-    show_queue_callback()
+
+def selected_rows():
+    """
+    :return: [first, last] row of the Index/To inputs, None if they are outside the queue
+    """
+    start=dpg.get_value(dpg_copy_row)
+    stop=max(dpg.get_value(dpg_copy_to), start)
+    if start < 0 or stop >= len(experiment_queue):
+        print("Index too high.")
+        return None
+    return [start, stop]
 
 def copy_element_callback():
-    from copy import deepcopy
     global experiment_queue
     
-    # Read information from GUI
-    copy_index=dpg.get_value(dpg_copy_row)
-    
-    if copy_index <=len(experiment_queue):
-        # copy element with this index
-        element=experiment_queue[copy_index]
-        experiment_queue.append(deepcopy(element)) 
-        show_queue_callback()
-    else:
-        print("Index too high.")
+    rows=selected_rows()
+    if rows is not None:
+        # copies of the rows at the end of the queue
+        experiment_queue.repeat(*rows, times=dpg.get_value(dpg_copy_times))
+        save_queue()
+
+def repeat_element_callback():
+    global experiment_queue
+
+    rows=selected_rows()
+    if rows is not None:
+        # copies right after the rows, e.g. a scan and a wait repeated for a kinetics protocol
+        experiment_queue.repeat(*rows, times=dpg.get_value(dpg_copy_times), at=rows[1]+1)
+        save_queue()
+
+def move_element_callback(sender, data, offset):
+    global experiment_queue
+
+    rows=selected_rows()
+    if rows is not None:
+        experiment_queue.move(rows[0], rows[0]+offset)
+        dpg.set_value(dpg_copy_row, max(0, min(rows[0]+offset, len(experiment_queue)-1)))
+        save_queue()
 
 def delete_element_callback():
     global experiment_queue
     
-    # Read information from GUI
-    delete_index=dpg.get_value(dpg_copy_row)
-    
-    # delete element with this index
-    if delete_index <=len(experiment_queue):
-        experiment_queue.pop(delete_index)
-        show_queue_callback()
-    else:
-        print("Index too high.")    
+    rows=selected_rows()
+    if rows is None:
+        return
+    with queue_lock:
+        if any(element is executor.current for element in experiment_queue[rows[0]:rows[1]+1]):
+            print("Cannot delete the running job, use Abort Now first.")
+            return
+        experiment_queue.delete(*rows)
+    save_queue()
 
 def run_queue_callback():
     global experiment_queue
     
-    # This a blocking function. Will cause problems if we wish to abort the experiment or continue adding to queue.
+    # Jobs run on the executor thread, the GUI stays responsive and the queue can still be edited.
     if len(experiment_queue)>=1:
-        for idx, element in enumerate(experiment_queue):
-            print(f"Running: {element.name}.")
-            element.execute()
-            experiment_queue[idx].duration=0.00
-            show_queue_callback()
-
-        print("Queue finished!")
-        experiment_queue=[]
-        show_queue_callback()
+        if not executor.start():
+            print("Queue is already running.")
+        update_instrument_controls()
     else:
         MainWindow_width = dpg.get_item_width(dpg_main)
         MainWindow_height = dpg.get_item_height(dpg_main)
@@ -434,107 +2495,761 @@ def run_queue_callback():
         ModalWindow_height = dpg.get_item_height(modalwindow)
         dpg.set_item_pos(modalwindow, [int((MainWindow_width/2 - ModalWindow_width/2)), int((MainWindow_height/2 - ModalWindow_height/2))])
 
-def show_queue_callback():
-    global experiment_queue
+def pause_queue_callback():
+    if executor.paused:
+        executor.resume()
+    else:
+        executor.pause()
 
-    dpg.delete_item('QueueTable', children_only=False)
-    duration_sum=0
+def abort_after_current_callback():
+    executor.abort_after_current()
 
-    with dpg.table(label='Queue',tag='QueueTable',parent=group1):                            # Adds the headers
-        dpg.add_table_column(label='Index',width_fixed=True)   
-        dpg.add_table_column(label='Name')
-        dpg.add_table_column(label='Runtime [min]')
-        
-        for count, element in enumerate(experiment_queue):                   
-            with dpg.table_row():
-                dpg.add_text(f'{count}')
-                dpg.add_text(f'{element.name}')
-                dpg.add_text(f'{np.round(element.duration,3)}')
-                duration_sum+=element.duration
-
-        # add final 'summary' row
-        with dpg.table_row():
-            dpg.add_text('')
-            dpg.add_text('Total Time Remaining->')
-            dpg.add_text(f'{np.round(duration_sum,3)}')
-
-def experiment(exp_range,step,directory,file):
+def abort_now_callback():
+    executor.abort_now()
+
+def update_executor_status():
+    dpg.set_value(dpg_queue_status, f"Queue: {executor.status()}")
+    dpg.configure_item(dpg_pause, label="Resume" if executor.paused else "Pause")
+    update_instrument_controls()
+
+def update_dip_plots():
+    fit = dip_tracker.live
+    if fit is not None and np.isfinite(fit.angle):
+        dpg.set_value(dip_marker, [[fit.angle]])
+        dpg.set_value(dpg_dip_str, f"Dip: {np.round(fit.angle,3)} +/- {np.round(fit.uncertainty,3)} deg, FWHM {np.round(fit.fwhm,2)} deg")
+    else:
+        dpg.set_value(dip_marker, [[]])
+
+    t, dip_angle, _, _, _ = dip_tracker.sensorgram.columns()
+    if len(t):
+        dpg.set_value(sensorgram_series, [(t-t[0])/60, dip_angle])
+        dpg.fit_axis_data(sens_x)
+        dpg.fit_axis_data(sens_y)
+
+class QueueTable:
+    """
+    Dear PyGui table of a JobQueue. The queue only marks the table as changed, sync() then brings the rows
+    in line on the render thread: rows of removed jobs are deleted, rows of new jobs created in place and moved
+    jobs' rows moved, and only texts which differ from what is shown are set. A long queue costs nothing
+    per frame and little per change.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.dirty = True
+        self.first_changed = 0  # first job whose duration may have changed since the last sync, None for none
+        self.order = []     # jobs in the order of the rows
+        self.rows = {}      # id(job) -> [row, [index, name, runtime] text items, texts shown]
+        with dpg.table(label='Queue') as self.table:
+            dpg.add_table_column(label='Index', width_fixed=True)
+            dpg.add_table_column(label='Name')
+            dpg.add_table_column(label='Runtime [min]')
+            with dpg.table_row() as self.summary:
+                dpg.add_text('')
+                dpg.add_text('Total Time Remaining->')
+                self.total = dpg.add_text('0.0')
+        jobs.listeners.append(self.changed)
+
+    def changed(self, event=None, index=None, elements=None):
+        """
+        Listener of the JobQueue, called with its lock held from any thread. Without an index (progress of the
+        running job) only the texts are refreshed.
+        """
+        if index is not None:
+            self.first_changed = index if self.first_changed is None else min(self.first_changed, index)
+        self.dirty = True
+
+    def sync(self):
+        if not self.dirty:
+            return
+        with self.jobs.lock:
+            self.dirty = False
+            start, self.first_changed = self.first_changed, None
+        # each job's estimate depends on where the previous one leaves the arms, so an insert, move or delete
+        # can change the ones after it, but not those before. A finished job is removed at index 0, so the
+        # timings it taught the model reach every job.
+        if start is not None:
+            self.jobs.update_durations(duration_model, start)
+        snapshot = list(self.jobs)
+        current = executor.current
+
+        queued = {id(element) for element in snapshot}
+        for element in self.order:
+            if id(element) not in queued:
+                dpg.delete_item(self.rows.pop(id(element))[0])
+        shown = [element for element in self.order if id(element) in queued]
+
+        # walk the queue and the rows together, rows which are out of place are moved or created before
+        # the first row not yet placed
+        placed = set()
+        position = 0
+        for element in snapshot:
+            while position < len(shown) and id(shown[position]) in placed:
+                position += 1
+            if position < len(shown) and shown[position] is element:
+                position += 1
+            else:
+                before = self.rows[id(shown[position])][0] if position < len(shown) else self.summary
+                if id(element) in self.rows:
+                    dpg.move_item(self.rows[id(element)][0], parent=self.table, before=before)
+                else:
+                    with dpg.table_row(parent=self.table, before=before) as row:
+                        texts = [dpg.add_text('') for column in range(3)]
+                    self.rows[id(element)] = [row, texts, ['', '', '']]
+            placed.add(id(element))
+        self.order = snapshot
+
+        for count, element in enumerate(snapshot):
+            row, texts, shown_texts = self.rows[id(element)]
+            values = [f'{count}', element.name + (' (running)' if element is current else ''),
+                      f'{np.round(element.duration,3)}']
+            for column in range(3):
+                if values[column] != shown_texts[column]:
+                    dpg.set_value(texts[column], values[column])
+                    shown_texts[column] = values[column]
+        self.update_total()
+
+    def update_total(self):
+        """
+        Counts the running job down in the summary row, called periodically from the render loop
+        """
+        current = executor.current
+        remaining = self.jobs.total
+        if current is not None and self.jobs.index(current) is not None:
+            remaining -= current.duration*executor.progress
+        dpg.set_value(self.total, f'{np.round(remaining,3)}')
+
+# every file a writer creates next to <file>_<n>: the data in any format, the .partial while it runs, the .json
+# metadata of csv scans and of kinetics runs and the raw readings. The number is only free if none of them exists,
+# whichever writer made them, so a kinetics run cannot take the metadata of a scan with the same name.
+SIBLING_SUFFIXES = tuple(extension+end for extension in ('.csv', '.parquet', '.h5', '.dat', '.dat.json', '_samples.f8')
+                         for end in ('', '.partial')) + ('.json',)
+
+def unique_filename(directory, file, extension='.csv'):
     # Generate filename
     file=os.path.join(directory,file)
 
     # check that this filename doesn't already exist, and if it does then append a number to its title
+    # (any sibling file of that name counts as existing, see SIBLING_SUFFIXES)
     file_counter=1
-    temp_filename=file+'_'+str(file_counter)+'.csv'
+    temp_filename=file+'_'+str(file_counter)+extension
     
     print(f"Path {temp_filename} exists: {os.path.exists(temp_filename)}")
 
-    while os.path.exists(temp_filename):
+    while any(os.path.exists(file+'_'+str(file_counter)+suffix) for suffix in SIBLING_SUFFIXES):
         file_counter+=1
-        temp_filename=file+'_'+str(file_counter)+'.csv'
+        temp_filename=file+'_'+str(file_counter)+extension
 
     print(f"{temp_filename} chosen")
+    return temp_filename
+
+PointStats = namedtuple('PointStats', ['mean', 'std', 'median', 'robust_std', 'n', 'rejected'])
+
+def robust_stats(samples, reject=5.0):
+    """
+    Statistics of the raw readings of a point, along the last axis so that many points can be done at once.
+    The robust SD is 1.4826 times the median absolute deviation, and readings further than reject robust
+    SDs from the median are left out of mean and std (e.g. spikes, or the tail of a move).
+    :param reject: None keeps every reading
+    :return: PointStats
+    """
+    samples = np.asarray(samples, dtype=float)
+    median = np.median(samples, axis=-1)
+    deviation = np.abs(samples-median[..., None])
+    robust_std = 1.4826*np.median(deviation, axis=-1)
+    if reject is None:
+        keep = np.ones(samples.shape, dtype=bool)
+    else:
+        keep = deviation <= reject*robust_std[..., None]
+    n = keep.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(keep, samples, 0).sum(axis=-1)/n
+        std = np.sqrt(np.where(keep, (samples-mean[..., None])**2, 0).sum(axis=-1)/(n-1))
+    return PointStats(mean, std, median, robust_std, n, samples.shape[-1]-n)
+
+def bin_samples(angles, power, centres):
+    """
+    Averages continuously recorded samples onto an angle grid
+    :param angles: angle of every sample
+    :param power: power of every sample
+    :param centres: evenly spaced grid, each bin extends half a step either side
+    :return: [mean, std, count] per grid point, NaN where a bin received no samples
+    """
+    if len(centres) > 1:
+        spacing = centres[1]-centres[0]
+        idx = np.clip(np.round((angles-centres[0])/spacing).astype(int), 0, len(centres)-1)
+        inside = np.abs(angles-centres[idx]) <= abs(spacing)/2
+    else:
+        idx = np.zeros(len(angles), dtype=int)
+        inside = np.ones(len(angles), dtype=bool)
+    idx, power = idx[inside], power[inside]
+
+    count = np.bincount(idx, minlength=len(centres))
+    total = np.bincount(idx, weights=power, minlength=len(centres))
+    total_sq = np.bincount(idx, weights=power**2, minlength=len(centres))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+        std = np.sqrt(np.maximum(total_sq/count - mean**2, 0))
+    return [mean, std, count]
+
+def locate_dip(angle, power):
+    """
+    Quick estimate of the resonance from a (coarse) scan
+    :return: [dip angle, full width at half depth]. The width falls back to the scanned span if a side of the dip is missing
+    """
+    fit = fit_dip(angle, power)
+    width = fit.fwhm if np.isfinite(fit.fwhm) else np.nanmax(angle)-np.nanmin(angle)
+    return [fit.angle, float(width)]
+
+def scan_direction(exp_range, direction, state=None):
+    """
+    :param direction: 'forward' from exp_range[0] to exp_range[1], 'reverse' the other way, or 'nearest' to start
+                      at whichever end is closer to the arms, so that back-to-back scans go back and forth
+                      without a return move
+    :param state: job state, the direction chosen on the first run is kept for a resumed scan
+    :return: 'forward' or 'reverse'
+    """
+    if state is not None and state.get('direction'):
+        return state['direction']
+    if direction == 'nearest':
+        here = 90-xps1.position("XY")
+        direction = 'reverse' if abs(here-exp_range[1]) < abs(here-exp_range[0]) else 'forward'
+    if state is not None:
+        state['direction'] = direction
+    return direction
+
+def run_metadata(mode, exp_range, step, **extra):
+    """
+    Settings stored with every scan file
+    """
+    return dict(mode=mode, exp_range=list(exp_range), step=step, wavelength=nd.wavelength,
+                velocity=list(xps1.velocity), buff_size=nd.buff_size, interval_ms=nd.interval_ms,
+                simulated=bool(xps1.simulated or nd.simulated), **extra)
+
+def open_writer(directory, file, fmt, column_names, metadata, state=None, resume=True, samples=False):
+    """
+    :param state: state of the queued job. Its file is remembered there, and if the job was interrupted
+                  before, the same file is opened again with the rows measured so far in writer.recovered
+    :param resume: False to start the remembered file again from the beginning
+    :param samples: also store the raw readings, see ScanWriter
+    """
+    if state is not None and state.get('filename'):
+        print(f"Continuing {state['filename']}")
+        return ScanWriter(state['filename'], column_names, fmt, metadata, resume=resume, samples=samples)
+
+    writer = ScanWriter(unique_filename(directory, file, ScanWriter.extensions[fmt]), column_names, fmt, metadata,
+                        samples=samples)
+    if state is not None:
+        state['filename'] = writer.filename
+        save_queue()
+    return writer
+
+def restore_rows(writer, out):
+    """
+    Puts the rows recovered from an interrupted run back into out
+    """
+    for row in writer.recovered:
+        out.append(*row)
+    if len(writer.recovered):
+        print(f"{len(writer.recovered)} points recovered from {writer.partial}")
+
+def close_writer(writer, out):
+    """
+    Final dip fit, then the file is completed with the fit in its metadata
+    """
+    fit = dip_tracker.finish(out, writer.filename)
+    lap = phase_timer.start()
+    writer.close(out, dip=fit._asdict())
+    lap('save')
+    print(f"{writer.filename} saved")
+    return fit
+
+def measure_angles(rel_angles, out, writer=None, extra=(), settle=None, host_stats=None, progress=(0.0, 1.0)):
+    """
+    Stop-and-go measurement at each relative angle, appended to out and streamed to writer
+    :param extra: values of any columns after Angle, Power, Std_power
+    :param settle: keyword arguments of Newport_2936.read_settled to measure each point with it (the samples
+                   and settling time are appended after extra), None reads the ring buffer
+    :param host_stats: to download the ring buffer and compute the statistics with robust_stats instead of PM:STAT,
+                       dict with reject (see robust_stats) and keep_samples (store the readings with the writer)
+    :param progress: job progress at the first and after the last angle, for jobs which measure in several calls
+    """
+    for count, rel in enumerate(rel_angles):
+        executor.checkpoint()
+        lap = phase_timer.start()
+        
+        xps1.move_abs("XY", 90-rel)
+        duration_model.last_angle = rel
+        lap('motion')
+        if settle is not None:
+            [mean_power, std_power, *point] = nd.read_settled(**settle)
+        elif host_stats is not None:
+            readings = nd.read_samples()
+            stats = robust_stats(readings, host_stats.get('reject', 5.0))
+            [mean_power, std_power] = [stats.mean, stats.std]
+            point = (stats.median, stats.robust_std, len(readings), stats.rejected)
+        else:
+            [mean_power, std_power] = nd.read_buffer()
+            point = ()
+        lap('read')
+        out.append(rel, mean_power, std_power, *extra, *point)
+        publish_point(rel, mean_power, std_power)
+        if writer is not None:
+            if host_stats is not None and host_stats.get('keep_samples'):
+                writer.write_samples(readings)
+            writer.write(out)
+        lap('store')
+        dip_tracker.update(out)
+        lap('fit')
+        live_plot.update()
+        lap('plot')
+        duration_model.record_step(lap.total('step'))
+        executor.progress = progress[0]+(progress[1]-progress[0])*(count+1)/len(rel_angles)
+
+def experiment(exp_range,step,directory,file,fmt='csv',settle=None,host_stats=None,direction='forward',state=None):
+    """
+    :param direction: 'forward', 'reverse' or 'nearest', see scan_direction. It is stored in the file metadata
+                      so that hysteresis between the two directions can be corrected.
+    :param settle: keyword arguments of Newport_2936.read_settled, to wait for settling and average each
+                   point to a noise target instead of reading the ring buffer
+    :param host_stats: download the readings of each point and compute robust statistics, see measure_angles
+    :param state: job state from the queue, an interrupted scan is continued at the first angle not yet measured
+    """
     steps = int((exp_range[1] - exp_range[0])/step)+1
     rel_range_arr = np.linspace(exp_range[0], exp_range[1], steps)
-    abs_range_arr = np.linspace(90-exp_range[0], 90-exp_range[1], steps)
-
-    dpg.set_axis_limits(pow_x, exp_range[0], exp_range[1])
-
-    df_columns=["Angle","Power","Std_power"]
-    out=pd.DataFrame(columns=df_columns)
-    position = []
-    pow = []
-    pos = []
-
-    for i in abs_range_arr:
-        
-        xps1.move_abs("XY", i)
-        [mean_power, std_power] = nd.read_buffer()
-        out.loc[len(out)]=[float(90-i), float(mean_power), float(std_power)]
-        position += [90-i]
-        pow += [float(mean_power)]
-        pos += [float(90-i)]
-        
-        dpg.set_value(pow_series, [pos, pow])
-        
-    position = np.array(position)
+    direction = scan_direction(exp_range, direction, state)
+    if direction == 'reverse':
+        rel_range_arr = rel_range_arr[::-1]
+
+    if settle is not None:
+        out=SettledResult(steps)
+        metadata=run_metadata('settled', exp_range, step, settle=settle, direction=direction)
+    elif host_stats is not None:
+        out=RobustResult(steps)
+        metadata=run_metadata('step', exp_range, step, host_stats=host_stats, direction=direction)
+    else:
+        out=ScanResult(steps)
+        metadata=run_metadata('step', exp_range, step, direction=direction)
+    keep_samples=host_stats is not None and host_stats.get('keep_samples', False)
+    writer=open_writer(directory, file, fmt, out.column_names, metadata, state, samples=keep_samples)
+    restore_rows(writer, out)
+    done=np.isclose(rel_range_arr[:, None], out.columns()[0][None, :], atol=step/10).any(axis=1)
+    live_plot.start_scan(out, exp_range)
+    dip_tracker.reset()
+    try:
+        measure_angles(rel_range_arr[~done], out, writer, settle=settle, host_stats=host_stats)
+    except BaseException:
+        writer.abort(out)
+        raise
+    finally:
+        live_plot.finish_scan()
+        if settle is not None:
+            nd.configure_ring_buffer()
     
-    out.to_csv(temp_filename,mode='a',header=True)
-    dpg.set_value(pow_series, [pos, pow])
+    return close_writer(writer, out)
+
+def averaged_experiment(exp_range, step, directory, file, repeats=10, target_rse=None, min_repeats=3, fmt='csv',
+                        direction='forward', state=None):
+    """
+    Repeated step scans averaged as they are measured: each finished repeat updates a RunningAverage of the
+    power at every angle, and the average with its confidence band is shown live. Only the average is saved,
+    one file with the mean, SD and standard error per angle.
+    :param repeats: scans at most
+    :param target_rse: stop early once the standard error of every angle is below this fraction of the
+                       off-resonance power, after at least min_repeats scans. None always measures all repeats.
+    :param direction: of every repeat, 'forward' or 'reverse'. Not 'nearest': the dip shifts with the direction
+                      (see experiment), repeats going back and forth would widen the average.
+    :param state: job state from the queue, an interrupted job continues with the repeats already averaged,
+                  the repeat that was interrupted is measured again
+    """
+    if direction not in ('forward', 'reverse'):
+        raise ValueError(f"averaged scans run in one direction, 'forward' or 'reverse', not {direction!r}")
+    steps = int((exp_range[1] - exp_range[0])/step)+1
+    rel_range_arr = np.linspace(exp_range[0], exp_range[1], steps)
+    average = RunningAverage(rel_range_arr)
+    began = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if state is not None and state.get('average'):
+        average.restore(state['average'])
+        began = state.get('began', began)
+        print(f"Continuing with {average.repeats} repeat(s) averaged")
+    dip_tracker.reset()
+    live_plot.show_average(average.result() if average.repeats else None)
+
+    converged = False
+    while average.repeats < repeats:
+        if target_rse is not None and average.repeats >= max(min_repeats, 2) and average.converged(target_rse):
+            converged = True
+            print(f"Standard error below {target_rse:.1e} of the power at every angle after {average.repeats} repeats")
+            break
+        angles = rel_range_arr if direction == 'forward' else rel_range_arr[::-1]
+        out = ScanResult(steps)
+        live_plot.start_scan(out, exp_range)
+        try:
+            measure_angles(angles, out, progress=(average.repeats/repeats, (average.repeats+1)/repeats))
+        finally:
+            live_plot.finish_scan()
+
+        angle, power = out.columns()[:2]
+        average.add(angle, power)
+        result = average.result()
+        live_plot.show_average(result)
+        dip_tracker.update(result)
+        if state is not None:
+            state.update(average=average.to_state(), began=began)
+            save_queue()
+        print(f"Repeat {average.repeats}/{repeats}: largest rel. SE {average.largest_rse():.2e}")
+
+    out = average.result()
+    writer = open_writer(directory, file, fmt, out.column_names,
+                         run_metadata('average', exp_range, step, repeats=repeats, target_rse=target_rse,
+                                      repeats_averaged=average.repeats, converged=converged, direction=direction,
+                                      averaging_started=began),
+                         state, resume=False)
+    return close_writer(writer, out)
+
+def adaptive_experiment(exp_range, step, directory, file, coarse_step=1.0, window=4.0, refine_factor=4, max_passes=4, tolerance=None, fmt='csv', state=None):
+    """
+    Coarse-to-fine scan. A coarse pass covers the whole range, then each refinement pass divides the step
+    by refine_factor (down to the fine step) and only measures inside a window around the estimated dip.
+    Angles already measured are not repeated, so the output grid is non-uniform. Rows are written in
+    measurement order with a Pass column.
+    :param window: minimum width of the refinement window in degrees, widened to twice the dip width
+    :param tolerance: stop once the finest pass moves the dip estimate by less than this (default: one fine step)
+    :param max_passes: refinement passes at most, after the coarse pass
+    :param state: job state from the queue. An interrupted scan is continued by running the passes again
+                  on the recovered points, which skips every angle already measured.
+    """
+    tolerance = step if tolerance is None else tolerance
+
+    # every pass lies on the fine grid, so repeats can be found by index rather than float comparison
+    n_fine = int((exp_range[1] - exp_range[0])/step)+1
+    fine_grid = np.linspace(exp_range[0], exp_range[1], n_fine)
+    measured = np.zeros(n_fine, dtype=bool)
+
+    pass_step = max(step, coarse_step)
+    out = AdaptiveResult(int(abs(exp_range[1]-exp_range[0])/pass_step) + 1 + int(max_passes*window/step))
+    writer = open_writer(directory, file, fmt, out.column_names,
+                         run_metadata('adaptive', exp_range, step, coarse_step=coarse_step, window=window), state)
+    restore_rows(writer, out)
+    measured[np.clip(np.round((out.columns()[0]-exp_range[0])/step).astype(int), 0, n_fine-1)] = True
+    stride = max(int(round(pass_step/step)), 1)
+    indices = np.arange(0, n_fine, stride)
+    centre = None
+    live_plot.start_scan(out, exp_range, sort=True)
+    dip_tracker.reset()
 
-def wait(wait_time):
-    time.sleep(wait_time)
+    try:
+        for pass_number in range(max_passes+1):
+            indices = indices[~measured[indices]]
+            measure_angles(fine_grid[indices], out, writer, extra=(pass_number,))
+            measured[indices] = True
+
+            angle, power = out.columns()[:2]
+            previous = centre
+            centre, width = locate_dip(angle, power)
+            print(f"Pass {pass_number}: step {np.round(pass_step,3)}, {len(indices)} points, dip at {np.round(centre,3)} (width {np.round(width,3)})")
+
+            if pass_step <= step and previous is not None and abs(centre-previous) < tolerance:
+                break
+
+            pass_step = max(step, pass_step/refine_factor)
+            stride = max(int(round(pass_step/step)), 1)
+            half_window = max(window, 2*width)/2
+            lo = np.searchsorted(fine_grid, centre-half_window)
+            hi = np.searchsorted(fine_grid, centre+half_window, side='right')
+            indices = np.arange(lo, hi, stride)
+            if not np.any(~measured[indices]):
+                if pass_step <= step:
+                    break
+                continue
+    except BaseException:
+        writer.abort(out)
+        raise
+    finally:
+        live_plot.finish_scan()
+
+    close_writer(writer, out)
+
+def fly_scan(exp_range, step, directory, file, dwell=0.1, fmt='csv', direction='forward', state=None):
+    """
+    Continuous scan: the arms sweep the range at constant velocity while the 2936 data store records,
+    then the samples are mapped to angle with the arm positions logged during the sweep and averaged
+    onto the same grid as the step scan.
+    :param dwell: seconds of travel per step, sets the sweep velocity
+    :param fmt: file format, see ScanWriter
+    :param direction: sweep direction, 'forward', 'reverse' or 'nearest' (see scan_direction), stored in the metadata
+    :param state: job state from the queue. The samples are only in the 2936 until the sweep ends,
+                  so an interrupted fly scan is repeated in full (into the same file).
+    """
+    steps = int((exp_range[1] - exp_range[0])/step)+1
+    rel_range_arr = np.linspace(exp_range[0], exp_range[1], steps)
+
+    velocity = step/dwell
+    sweep_time = abs(exp_range[1]-exp_range[0])/velocity
+    n_samples = sweep_time*1000/nd.interval_ms*1.2 + 1000  # margin for acceleration and host timing
+    if n_samples > nd.max_ds_size:
+        print(f"Sweep needs {int(n_samples)} samples, data store holds {nd.max_ds_size}. End of the range may be missing.")
+
+    direction = scan_direction(exp_range, direction, state)
+    first, last = exp_range[0:2] if direction == 'forward' else exp_range[1::-1]
+    writer = open_writer(directory, file, fmt, ScanResult.column_names,
+                         run_metadata('fly', exp_range, step, dwell=dwell, direction=direction), state, resume=False)
+    xps1.move_abs("XY", 90-first)
+    scan_velocity = xps1.velocity
+    xps1.set_velocity(velocity, scan_velocity[1])
+
+    move = None
+    times = []
+    positions = []
+    try:
+        # a pause has to come before the sweep, the arms keep moving and a gap in the logged positions
+        # would put the samples of the pause at the wrong angles
+        executor.checkpoint()
+        lap = phase_timer.start()
+        started = nd.start_capture(n_samples)
+        move = xps1.start_move_abs("XY", 90-last)
+        while move.is_alive():
+            executor.check_abort()
+            times += [time.perf_counter()]
+            positions += [90-xps1.position("XY")]
+        times += [time.perf_counter()]
+        positions += [90-xps1.position("XY")]
+        lap('sweep')
+
+        power = nd.read_data_store()
+        lap('download')
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        if move is not None:
+            move.join()
+            duration_model.last_angle = last
+        xps1.set_velocity(*scan_velocity)
+        nd.configure_ring_buffer()
+
+    # the data store fills at a fixed interval from the moment it was enabled
+    sample_times = started + np.arange(len(power))*nd.interval_ms/1000
+    during_sweep = sample_times <= times[-1]
+    angles = np.interp(sample_times[during_sweep], times, positions)
+    mean, std, count = bin_samples(angles, power[during_sweep], rel_range_arr)
+
+    out=ScanResult(steps)
+    for angle, mean_power, std_power, n in zip(rel_range_arr, mean, std, count):
+        if n > 0:
+            out.append(angle, mean_power, std_power)
+            publish_point(angle, mean_power, std_power)
+    lap('bin')
+    live_plot.start_scan(out, exp_range)
+    live_plot.finish_scan()
+
+    close_writer(writer, out)
+
+def kinetics(angle, duration, directory, file, interval_ms=None, poll=0.5, state=None):
+    """
+    Fixed-angle kinetics: parks the arms at angle and records the power continuously for duration seconds.
+    The 2936 data store runs as a one-shot capture which is read as it fills and re-armed when full (the
+    few ms this takes are the only gaps), and every sample goes to a KineticsWriter file with its time.
+    The live plot shows block averages over each poll.
+    :param interval_ms: time between readings, default that of the meter (nd.interval_ms)
+    :param poll: seconds between data store reads
+    :param state: job state from the queue, an interrupted run continues in the same file
+    :raise CommandError: if a capture stops filling, no new samples well after it should have been full
+    """
+    interval_ms = nd.interval_ms if interval_ms is None else interval_ms
+    capacity = int(duration*1000/interval_ms)+1
+    metadata = dict(mode='kinetics', angle=angle, duration=duration, interval_ms=interval_ms,
+                    wavelength=nd.wavelength, simulated=bool(xps1.simulated or nd.simulated),
+                    dtype=KineticsWriter.dtype.descr)
+
+    if state is not None and state.get('filename'):
+        print(f"Continuing {state['filename']}")
+        writer = KineticsWriter(state['filename'], capacity, metadata, resume=True)
+    else:
+        writer = KineticsWriter(unique_filename(directory, file, '.dat'), capacity, metadata)
+        if state is not None:
+            state['filename'] = writer.filename
+            save_queue()
+
+    view = KineticsView(4096)
+    xps1.move_abs("XY", 90-angle)
+    duration_model.last_angle = angle
+    live_plot.start_scan(view, 'auto')
+
+    # host clock to the t0 of the file
+    t0_offset = time.time()-time.perf_counter()-writer.metadata['t0']
+    captures = 0
+    try:
+        while writer.n < writer.capacity:
+            size = min(writer.capacity-writer.n, nd.max_ds_size)
+            started = nd.start_capture(size, interval_ms)
+            captures += 1
+            read = 0
+            # the capture keeps filling during a pause, so the end does not move with one
+            deadline = started+size*interval_ms/1000+max(5.0, 10*poll)
+            while read < size:
+                executor.checkpoint()
+                # near the end of a capture only wait until it is full, so the next one starts without a long gap
+                time.sleep(min(poll, max(started+size*interval_ms/1000-time.perf_counter(), 0.001)))
+                lap = phase_timer.start()
+                power = nd.read_new(read)
+                lap('read')
+                if len(power) == 0:
+                    if time.perf_counter() > deadline:
+                        raise CommandError(f'The data store stopped filling at {read} of {size} samples')
+                    continue
+                times = started + t0_offset + (read+np.arange(len(power)))*interval_ms/1000
+                read += len(power)
+                writer.append(times, power)
+                publish_point(angle, float(np.mean(power)), float(np.std(power)))
+                lap('store')
+                view.add(times, power)
+                live_plot.update()
+                lap('plot')
+                executor.progress = writer.n/writer.capacity
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        live_plot.finish_scan(overlay=False)
+        nd.configure_ring_buffer()
+
+    lap = phase_timer.start()
+    writer.close(captures=captures)
+    lap('save')
+    print(f"{writer.filename} saved, {writer.n} samples")
+
+def track_dip(exp_range, step, directory, file, width=1.0, n_points=7, cycles=100, settle=None, fmt='csv', state=None):
+    """
+    Dip tracking: one step scan over exp_range locates the dip, then every cycle measures only n_points angles
+    across a bracket of width degrees around it, fits the dip and re-centres the bracket on the fit. The bracket
+    is measured in alternating directions so no cycle starts with a return move. Each cycle's fit goes to the
+    sensorgram (and sensorgram.csv), the points to the tracking file with their cycle.
+    The points are measured with Newport_2936.read_settled: the ring buffer still holds readings from the move,
+    which pulls each point towards the previous angle and would shift the fit with the direction.
+    :param width: bracket width in degrees, best around half the FWHM of the dip
+    :param settle: keyword arguments of read_settled, by default capped at 0.5 s per point
+    :param state: job state from the queue, an interrupted run continues from the last cycle in its file
+    """
+    settle = dict(target_rse=2e-4, max_time=0.5) if settle is None else settle
+    track = TrackResult(cycles*n_points)
+    writer = open_writer(directory, file, fmt, track.column_names,
+                         run_metadata('track', exp_range, step, width=width, n_points=n_points, cycles=cycles), state)
+    restore_rows(writer, track)
+
+    first_cycle = 0
+    centre = np.nan
+    if len(track):
+        # continue from the fit of the last cycle in the file
+        angle, power, std_power, cycle, _ = track.columns()
+        last = cycle == cycle[-1]
+        centre = fit_dip(angle[last], power[last], std_power[last], dip_tracker.method).angle
+        first_cycle = int(cycle[-1])+1
+    offsets = np.linspace(-width/2, width/2, n_points)
+    lo, hi = min(exp_range[0:2])+width/2, max(exp_range[0:2])-width/2
+    try:
+        # inside the try, an aborted or failed locating scan also closes the tracking file
+        if not np.isfinite(centre):
+            fit = experiment(exp_range, step, directory, file+'_locate', fmt)
+            centre = fit.angle
+        if not np.isfinite(centre):
+            raise ValueError('No dip found in the locating scan, cannot track it')
+
+        for cycle in range(first_cycle, cycles):
+            centre = float(np.clip(centre, lo, hi))
+            angles = centre+(offsets if cycle % 2 == 0 else offsets[::-1])
+            out = SettledResult(n_points)
+            started = time.time()
+            live_plot.start_scan(out, [centre-width, centre+width], sort=True)
+            dip_tracker.reset()
+            measure_angles(angles, out, settle=settle)
+            live_plot.finish_scan()
+
+            angle, power, std_power = out.columns()[:3]
+            for row in zip(angle, power, std_power):
+                track.append(*row, cycle, started)
+            writer.write(track)
+
+            fit = fit_dip(angle, power, std_power, dip_tracker.method)
+            dip_tracker.record(fit, writer.filename)
+            if np.isfinite(fit.angle) and abs(fit.angle-centre) < width:
+                centre = fit.angle
+            else:
+                # the dip left the bracket or the fit failed, follow the lowest point
+                centre = angle[np.argmin(power)]
+            executor.progress = (cycle+1-first_cycle)/(cycles-first_cycle)
+    except BaseException:
+        writer.abort(track)
+        raise
+    finally:
+        nd.configure_ring_buffer()
+
+    lap = phase_timer.start()
+    writer.close(track, centre=centre)
+    lap('save')
+    print(f"{writer.filename} saved, dip finally at {np.round(centre,4)} deg")
+
+def wait(wait_time, state=None):
+    # an interrupted wait is simply waited again
+    executor.sleep(wait_time)
+
+# job functions by QueueElement.kind, each takes its params as keywords and the job state as state
+JOB_TYPES = {'step': experiment, 'average': averaged_experiment, 'adaptive': adaptive_experiment, 'fly': fly_scan,
+             'kinetics': kinetics, 'track': track_dip, 'wait': wait}
 
 # ===================================
 
 if __name__ == '__main__':
-    try:
-        nd = Newport_2936(interval_ms=1)
-        xps1 = Newport_XPS("XY")
-        xps1.xps.set_velocity(stage="XY.X",velo=5,accl=4)
-        xps1.xps.set_velocity(stage="XY.Y",velo=5,accl=4)
-        
-        if nd.status == 'Connected':
+    rel_pos = [np.nan]
+    rel_pos_str = f"Position: [{str(rel_pos[0])}]"
+
+    # the simulator only when asked for, simulated data must never end up in experiment files unnoticed
+    simulate = '--simulate' in sys.argv or os.environ.get('SPR_SIMULATE', '0') not in ('', '0')
+    if simulate:
+        print('Using the simulated XPS and 2936 (SPR_simulator.py).')
+        from SPR_simulator import Simulated_XPS, Simulated_2936
+
+        xps1 = Simulated_XPS("XY")
+        xps1.set_velocity(velo=5,accl=4)
+        nd = Simulated_2936(xps1, interval_ms=1)
+    else:
+        try:
+            nd = Newport_2936(interval_ms=1)
+            if nd.status != 'Connected':
+                raise ConnectionError('cannot connect to the 2936')
+            xps1 = Newport_XPS("XY")
+            xps1.set_velocity(velo=5,accl=4)
+
             print('Serial number is ' + str(nd.serial_number))
             print('Model name is ' + str(nd.model_number))
 
             # Print the IDN of the newport detector.
-            print('Connected to ' + nd.ask('*IDN?'))  
-        else:
-            nd.status != 'Connected'
-            print('Cannot connect.')
-    except:
-        print('Problem with connection. Opening as dummy instead.')
-
-        rel_pos = [np.nan]
-        rel_pos_str = f"Position: [{str(rel_pos[0])}]"
+            print('Connected to ' + nd.ask('*IDN?'))
+        except Exception as e:
+            print(f'Problem with connection ({e!r}). Check the instruments, or start with --simulate '
+                  f'(or SPR_SIMULATE=1) to use the simulated ones.')
+            sys.exit(1)
     
     live_pow = []
     live_time = []
 
-    experiment_queue=[]
+    here=os.path.dirname(os.path.abspath(__file__))
+    queue_file=QueueFile(os.path.join(here, 'experiment_queue.json'))
+    try:
+        jobs=queue_file.load()
+    except (OSError, ValueError, KeyError) as e:
+        print(f'Could not restore the queue from {queue_file.filename}: {e}')
+        jobs=[]
+    install(xps1, nd, jobs, queue_file, os.path.join(here, 'job_timings.jsonl'), feed=DEFAULT_NAME,
+            on_progress=lambda: (queue_table.changed(), run_on_ui(update_executor_status)),
+            on_dip_update=lambda: run_on_ui(update_dip_plots))
+    if experiment_queue:
+        print(f'Restored {len(experiment_queue)} job(s) from {queue_file.filename}. Home the stage and run the queue to continue.')
+    for element in experiment_queue:
+        if element.params.get('fmt', 'csv') not in ScanWriter.available_formats():
+            print(f"Restored job '{element.name}' saves {element.params['fmt']} files, which cannot be written here. Remove it before running the queue.")
 
     dpg.create_context()
-    dpg.create_viewport()
+    dpg.create_viewport(title='SPR control - SIMULATED instruments' if simulate else 'SPR control')
     dpg.setup_dearpygui()
 
     with dpg.window(label="Example Window") as dpg_main:
@@ -545,6 +3260,18 @@ if __name__ == '__main__':
                 dpg.add_theme_style(dpg.mvPlotStyleVar_Marker, dpg.mvPlotMarker_Square, category=dpg.mvThemeCat_Plots)
                 dpg.add_theme_style(dpg.mvPlotStyleVar_MarkerSize, 4, category=dpg.mvThemeCat_Plots)
 
+        with dpg.theme() as dpg_overlay_theme:
+            with dpg.theme_component(dpg.mvLineSeries):
+                dpg.add_theme_color(dpg.mvPlotCol_Line, (150, 150, 150, 120), category=dpg.mvThemeCat_Plots)
+
+        with dpg.theme() as dpg_average_theme:
+            with dpg.theme_component(dpg.mvLineSeries):
+                dpg.add_theme_color(dpg.mvPlotCol_Line, (230, 140, 40), category=dpg.mvThemeCat_Plots)
+
+        with dpg.theme() as dpg_band_theme:
+            with dpg.theme_component(dpg.mvShadeSeries):
+                dpg.add_theme_color(dpg.mvPlotCol_Fill, (230, 140, 40, 60), category=dpg.mvThemeCat_Plots)
+
         with dpg.group(horizontal=True) as group1:
             with dpg.group(label="Controls"):
                 dpg.add_text("Motion Controls")
@@ -560,15 +3287,31 @@ if __name__ == '__main__':
                 dpg.add_text("Power Meter Controls")
                 dpg_wav_val = dpg.add_input_int(default_value=633, width=200)
                 dpg_wav = dpg.add_button(label="Set Wavelength", callback=nd_wav_callback, width=200)
+                dpg.add_button(label="Print Reply Latency", callback=nd_latency_callback, width=200)
                 
                 dpg.add_text("Experiment Controls")
                 dpg_range = dpg.add_input_intx(label="Range", size=2, default_value=[30, 60], max_value=90, min_value=30, max_clamped=True, min_clamped=True, width=200)
                 dpg_step = dpg.add_input_float(label="Precision", width=200, default_value=0.10)
+                dpg_scan_mode = dpg.add_combo(["Step scan", "Averaged scan", "Settled scan", "Fly scan", "Adaptive scan", "Dip tracking"], label="Scan mode", default_value="Step scan", width=200)
+                dpg_avg_repeats = dpg.add_input_int(label="Averaged: repeats", width=200, default_value=10, min_value=1, min_clamped=True)
+                dpg_avg_target = dpg.add_input_float(label="Averaged: stop at rel. SE (0 off)", width=200, default_value=0.0, format="%.1e", min_value=0.0, min_clamped=True)
+                dpg_coarse_step = dpg.add_input_float(label="Adaptive coarse step", width=200, default_value=1.0)
+                dpg_window = dpg.add_input_float(label="Adaptive window [deg]", width=200, default_value=4.0)
+                dpg_dwell = dpg.add_input_float(label="Fly dwell [s/step]", width=200, default_value=0.10, min_value=0.01, min_clamped=True)
+                dpg_target_rse = dpg.add_input_float(label="Settled: target rel. SE", width=200, default_value=2e-4, format="%.1e", min_value=1e-7, min_clamped=True)
+                dpg_max_settle = dpg.add_input_float(label="Settled: max s/point", width=200, default_value=2.0, min_value=0.1, min_clamped=True)
+                dpg_track_width = dpg.add_input_float(label="Tracking: bracket [deg]", width=200, default_value=1.0, min_value=0.05, min_clamped=True)
+                dpg_track_points = dpg.add_input_int(label="Tracking: points", width=200, default_value=7, min_value=3, min_clamped=True)
+                dpg_track_cycles = dpg.add_input_int(label="Tracking: cycles", width=200, default_value=100, min_value=1, min_clamped=True)
+                dpg_host_stats = dpg.add_checkbox(label="Step: statistics from raw readings")
+                dpg_keep_samples = dpg.add_checkbox(label="Step: keep raw readings")
+                dpg_serpentine = dpg.add_checkbox(label="Step/fly: start at nearest end (serpentine)")
                 
                 dpg.add_text("Save Location:")
 
                 dpg_dir = dpg.add_input_text(label="Save directory", default_value=os.path.abspath(os.curdir), width=200)
                 dpg_file = dpg.add_input_text(label="File Name", default_value="experiment", width=200)
+                dpg_save_format = dpg.add_combo(ScanWriter.available_formats(), label="File format", default_value="csv", width=200)
 
                 dpg.add_text("")
                 dpg.add_button(label="Queue Experimental Run",callback=add_exp_to_queue_callback,width=200)
@@ -577,44 +3320,79 @@ if __name__ == '__main__':
                 dpg.add_text("Wait timer (seconds):")
                 dpg_wait_length = dpg.add_input_int(default_value=300, width=200)
                 dpg.add_button(label="Queue Wait",callback=add_wait_to_queue_callback,width=200)
+
+                dpg.add_text("")
+                dpg.add_text("Kinetics at a fixed angle:")
+                dpg_kin_angle = dpg.add_input_float(label="Angle [deg]", width=200, default_value=44.0, min_value=30, max_value=90, min_clamped=True, max_clamped=True)
+                dpg_kin_minutes = dpg.add_input_float(label="Duration [min]", width=200, default_value=60.0, min_value=0.1, min_clamped=True)
+                dpg_kin_interval = dpg.add_input_float(label="Sample interval [ms]", width=200, default_value=1.0, min_value=0.1, min_clamped=True)
+                dpg.add_button(label="Queue Kinetics",callback=add_kinetics_to_queue_callback,width=200)
                 
                 dpg.add_text("")
                 dpg.add_text("Queue manipulation:")
                 dpg_copy_row = dpg.add_input_int(label="Index",default_value=0, width=200)
+                dpg_copy_to = dpg.add_input_int(label="To (rows)",default_value=0, width=200)
+                dpg_copy_times = dpg.add_input_int(label="Times",default_value=1, min_value=1, min_clamped=True, width=200)
                 with dpg.group(horizontal=True):
-                    dpg.add_button(label="Copy Row",callback=copy_element_callback,width=100)
-                    dpg.add_button(label="Delete Row",callback=delete_element_callback,width=100)
+                    dpg.add_button(label="Copy Rows",callback=copy_element_callback,width=100)
+                    dpg.add_button(label="Repeat Rows",callback=repeat_element_callback,width=100)
+                with dpg.group(horizontal=True):
+                    dpg.add_button(label="Up",callback=move_element_callback,user_data=-1,width=48)
+                    dpg.add_button(label="Down",callback=move_element_callback,user_data=1,width=48)
+                    dpg.add_button(label="Delete Rows",callback=delete_element_callback,width=100)
             
                 dpg.add_button(label="Clear Queue", callback=clear_queue_callback, width=200)
                 dpg.add_text("")
                 
                 dpg_run=dpg.add_button(label="Run Queue", callback=run_queue_callback,enabled=False, width=200)
+                with dpg.group(horizontal=True):
+                    dpg_pause=dpg.add_button(label="Pause", callback=pause_queue_callback, width=100)
+                    dpg.add_button(label="Abort Now", callback=abort_now_callback, width=100)
+                dpg.add_button(label="Abort After Current", callback=abort_after_current_callback, width=200)
+                dpg_queue_status=dpg.add_text("Queue: Idle")
                 
             with dpg.plot(label="Experiment", height=700, width=700) as dpg_plot:
                 pow_x = dpg.add_plot_axis(dpg.mvXAxis, label="Angle")
                 pow_y = dpg.add_plot_axis(dpg.mvYAxis, label="Power [W]")
+                overlay_series = [dpg.add_line_series([], [], parent=pow_y, label=f"Scan -{idx+1}") for idx in range(3)]
+                for series in overlay_series:
+                    dpg.bind_item_theme(series, dpg_overlay_theme)
+                band_series = dpg.add_shade_series([], [], y2=[], parent=pow_y, label="Average +/- 2 SE")
+                dpg.bind_item_theme(band_series, dpg_band_theme)
+                average_series = dpg.add_line_series([], [], parent=pow_y, label="Average")
+                dpg.bind_item_theme(average_series, dpg_average_theme)
                 pow_series = dpg.add_line_series([], [], parent=pow_y)
+                live_plot.attach(pow_series, pow_x, overlay_series, average_series, band_series)
+                dip_marker = dpg.add_inf_line_series([], parent=pow_y)
                 dpg.set_axis_limits(pow_x, 30, 60)
                 dpg.bind_item_theme(dpg_plot, dpg_plot_theme)
+
+            with dpg.group():
+                dpg_dip_str = dpg.add_text("Dip: -")
+                with dpg.plot(label="Sensorgram", height=300, width=500) as dpg_sensorgram:
+                    sens_x = dpg.add_plot_axis(dpg.mvXAxis, label="Time [min]")
+                    sens_y = dpg.add_plot_axis(dpg.mvYAxis, label="Dip angle [deg]")
+                    sensorgram_series = dpg.add_line_series([], [], parent=sens_y)
+                    dpg.bind_item_theme(dpg_sensorgram, dpg_plot_theme)
                 
-            with dpg.table(label='Queue',tag='QueueTable'):                            # Adds the headers
-                dpg.add_table_column(label='Index',width_fixed=True)   
-                dpg.add_table_column(label='Name')
-                dpg.add_table_column(label='Runtime')
-                
-                # Add a filler first row
-                
-                with dpg.table_row():
-                    dpg.add_text('-')
-                    dpg.add_text('-')
-                    dpg.add_text('-')
+            queue_table=QueueTable(experiment_queue)
 
     dpg.show_viewport()
     dpg.maximize_viewport()
     dpg.set_primary_window(dpg_main, True)
 
+    last_countdown=0
     while dpg.is_dearpygui_running():
+        process_ui_calls()
+        live_plot.refresh()
+        queue_table.sync()
+        if time.monotonic()-last_countdown > 1:
+            queue_table.update_total()
+            update_instrument_controls()
+            last_countdown=time.monotonic()
         dpg.render_dearpygui_frame()
 
     dpg.destroy_context()
+    if live_feed is not None:
+        live_feed.close()
 
@@ -0,0 +1,168 @@
+"""
+Batch analysis of saved scans.
+
+Finds the scan files in a save directory, fits the dip of each one in a pool of worker processes and writes
+one summary table with a row per scan (file, timestamp, dip angle, depth, FWHM, ...). The table is also the
+cache: a file is only read again if its size or modification time changed, and refitted only if its
+content hash changed too, so re-runs over a growing directory only process the new scans.
+
+    python SPR_analysis.py data/
+    python SPR_analysis.py data/ --recursive --workers 8
+    python SPR_analysis.py data/ --method lorentzian --output lorentzian.csv
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import Run_SPR_v5 as spr
+
+SCAN_EXTENSIONS = tuple(spr.ScanWriter.extensions.values())
+SUMMARY_FILE = 'scan_summary.csv'
+COLUMNS = ['timestamp', 'mode', 'direction', 'points', 'angle', 'uncertainty', 'depth', 'fwhm', 'method',
+           'size', 'mtime_ns', 'sha1', 'error']
+
+def find_scans(directory, recursive=False, exclude=()):
+    """
+    :param exclude: file names to leave out, e.g. the summary table itself
+    :return: paths relative to directory, sorted
+    """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if name.endswith(SCAN_EXTENSIONS) and name != 'sensorgram.csv' and name not in exclude:
+                found.append(os.path.relpath(os.path.join(root, name), directory))
+        if not recursive:
+            break
+    return sorted(found)
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def analyse_file(filename, method, known_hash=None):
+    """
+    Runs in the worker processes
+    :param known_hash: sha1 from the cache, the fit is skipped if the content has not changed
+    :return: dict with the COLUMNS of the summary, only size, mtime_ns and sha1 if the hash matched
+    """
+    stat = os.stat(filename)
+    row = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_hash(filename), 'method': method}
+    if row['sha1'] == known_hash:
+        return row
+
+    try:
+        metadata = spr.load_metadata(filename)
+        scan = spr.load_scan(filename)
+    except Exception as e:
+        return dict(row, error=f'unreadable: {e}')
+    row.update(mode=metadata.get('mode'), direction=metadata.get('direction'), points=len(scan),
+               timestamp=metadata.get('finished', metadata.get('started',
+                                      time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stat.st_mtime)))))
+    if 'Angle' not in scan or 'Power' not in scan:
+        return dict(row, error='no Angle and Power columns')
+    if 'Cycle' in scan:
+        return dict(row, error='dip tracking run, the fit of every cycle is in sensorgram.csv')
+
+    std_power = scan['Std_power'].to_numpy(dtype=float) if 'Std_power' in scan else None
+    try:
+        fit = spr.fit_dip(scan['Angle'].to_numpy(dtype=float), scan['Power'].to_numpy(dtype=float), std_power, method)
+    except Exception as e:
+        # one bad file must not stop the batch
+        return dict(row, error=f'fit failed: {e!r}')
+    row.update(angle=fit.angle, uncertainty=fit.uncertainty, depth=fit.depth, fwhm=fit.fwhm, error='')
+    return row
+
+def _analyse(task):
+    return analyse_file(*task)
+
+def load_summary(filename):
+    """
+    :return: DataFrame indexed by file, empty if there is no summary yet
+    """
+    if not os.path.exists(filename):
+        return pd.DataFrame(columns=COLUMNS, index=pd.Index([], name='file'))
+    return pd.read_csv(filename, index_col='file', keep_default_na=False, na_values=[''])
+
+def summarise(directory, summary_file=None, method='polynomial', recursive=False, workers=None, refit=False):
+    """
+    Fits every new or changed scan in directory and updates the summary table
+    :param summary_file: defaults to scan_summary.csv in directory
+    :param workers: processes, None for one per core
+    :param refit: ignore the cache
+    :return: the summary as a DataFrame indexed by file, sorted by timestamp
+    """
+    summary_file = summary_file or os.path.join(directory, SUMMARY_FILE)
+    cached = load_summary(summary_file)
+    if refit:
+        cached = cached.iloc[0:0]
+    files = find_scans(directory, recursive, exclude=[os.path.basename(summary_file)])
+
+    rows = {}
+    tasks = []
+    for name in files:
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        if name in cached.index and cached.at[name, 'method'] == method:
+            previous = cached.loc[name].to_dict()
+            if previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+                rows[name] = previous
+                continue
+            tasks.append((name, (path, method, previous['sha1'])))
+        else:
+            tasks.append((name, (path, method, None)))
+
+    started = time.perf_counter()
+    if workers == 1 or len(tasks) < 2:
+        results = [analyse_file(*task) for name, task in tasks]
+    else:
+        # a few chunks per worker, so one slow file does not hold up the rest
+        chunksize = max(1, len(tasks)//(4*(workers or os.cpu_count() or 1)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_analyse, [task for name, task in tasks], chunksize=chunksize))
+
+    refitted = 0
+    for (name, task), row in zip(tasks, results):
+        if 'error' in row:
+            refitted += 1
+            rows[name] = row
+        else:
+            # only the modification time changed, keep the fit
+            rows[name] = dict(cached.loc[name].to_dict(), **row)
+    print(f'{len(files)} scans, {len(files)-len(tasks)} unchanged, {len(tasks)-refitted} touched, '
+          f'{refitted} fitted in {time.perf_counter()-started:.2f} s')
+
+    summary = pd.DataFrame.from_dict(rows, orient='index', columns=COLUMNS)
+    summary.index.name = 'file'
+    summary = summary.sort_values('timestamp', kind='stable')
+    temp = summary_file+'.tmp'
+    summary.to_csv(temp)
+    os.replace(temp, summary_file)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help='save directory of the scans')
+    parser.add_argument('--output', help=f'summary table, default {SUMMARY_FILE} in the directory')
+    parser.add_argument('--method', choices=['polynomial', 'lorentzian', 'centroid'], default='polynomial')
+    parser.add_argument('--recursive', action='store_true', help='include subdirectories')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per core')
+    parser.add_argument('--refit', action='store_true', help='ignore the cached results')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f'{args.directory} is not a directory')
+        sys.exit(2)
+    summary = summarise(args.directory, args.output, args.method, args.recursive, args.workers, args.refit)
+    failed = summary[summary['error'].fillna('') != '']
+    for name, error in failed['error'].items():
+        print(f'  {name}: {error}')
+    print(f"Summary of {len(summary)} scans written to {args.output or os.path.join(args.directory, SUMMARY_FILE)}")
@@ -0,0 +1,177 @@
+"""
+Acquisition benchmark for the SPR control software.
+
+Runs standard scan profiles through the same acquisition functions as the GUI and reports where the
+time goes per step (motion, read, store, fit, plot, save) and per frame (ui, refresh), the achieved points per second and the
+memory growth. Results can be written as JSON and compared against an earlier run to catch regressions.
+
+    python SPR_benchmark.py                                 # all profiles on the simulator
+    python SPR_benchmark.py --profiles fine --json new.json --compare baseline.json
+    python SPR_benchmark.py --backend hardware              # the real XPS and 2936
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import dearpygui.dearpygui as dpg
+
+import Run_SPR_v5 as spr
+
+# exp_range/step as in the GUI, repeats are queued back to back like a scan protocol,
+# kinetics is the fixed-angle job (data store captures streamed to a KineticsWriter file)
+PROFILES = {
+    'coarse': dict(mode='step', exp_range=[30, 60], step=1.0, repeats=1),
+    'fine': dict(mode='step', exp_range=[40, 50], step=0.05, repeats=1),
+    'fly': dict(mode='fly', exp_range=[40, 50], step=0.05, dwell=0.05, repeats=1),
+    'repeated': dict(mode='step', exp_range=[42, 46], step=0.1, repeats=20),
+    'kinetics': dict(mode='kinetics', angle=44.0, duration=60, repeats=1),
+}
+
+def make_backend(name, latency=None):
+    """
+    :param name: 'sim' for SPR_simulator, 'hardware' for the instruments
+    :param latency: command latency in seconds for the simulated instruments, None keeps their default
+    :return: [xps, power meter]
+    """
+    if name == 'hardware':
+        nd = spr.Newport_2936(interval_ms=1)
+        xps = spr.Newport_XPS("XY")
+    else:
+        from SPR_simulator import Simulated_XPS, Simulated_2936
+        settings = {} if latency is None else {'command_latency': latency}
+        xps = Simulated_XPS("XY", **settings)
+        nd = Simulated_2936(xps, interval_ms=1, **settings)
+    xps.set_velocity(velo=5, accl=4)
+    return [xps, nd]
+
+def install(xps, nd):
+    """
+    Points the acquisition globals of Run_SPR_v5 at the backend and at a hidden plot, as __main__ does for the GUI.
+    Nothing is saved: no queue file, the timings stay in memory and there is no live feed.
+    """
+    spr.install(xps, nd)
+    # pandas is imported on first use, which would otherwise land in the first timed store
+    spr.pd.DataFrame
+
+    dpg.create_context()
+    with dpg.window():
+        with dpg.plot():
+            pow_x = dpg.add_plot_axis(dpg.mvXAxis)
+            pow_y = dpg.add_plot_axis(dpg.mvYAxis)
+            overlays = [dpg.add_line_series([], [], parent=pow_y) for idx in range(3)]
+            spr.live_plot.attach(dpg.add_line_series([], [], parent=pow_y), pow_x, overlays)
+
+def ui_loop(stop, fps=60):
+    """
+    Stands in for the render loop, drains run_on_ui calls once per frame
+    """
+    while not stop.is_set():
+        spr.process_ui_calls()
+        lap = spr.phase_timer.start()
+        spr.live_plot.refresh()
+        lap('refresh')
+        time.sleep(1/fps)
+    spr.process_ui_calls()
+    spr.live_plot.refresh()
+
+def run_profile(name, profile, directory):
+    spr.phase_timer.reset()
+    spr.nd.latency = spr.LatencyHistogram()
+    stop = threading.Event()
+    ui = threading.Thread(target=ui_loop, args=(stop,), daemon=True)
+    ui.start()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    points = 0
+    for repeat in range(profile['repeats']):
+        if profile['mode'] == 'kinetics':
+            spr.kinetics(profile['angle'], profile['duration'], directory, name)
+            points += int(profile['duration']*1000/spr.nd.interval_ms)+1
+            continue
+        if profile['mode'] == 'fly':
+            spr.fly_scan(profile['exp_range'], profile['step'], directory, name, profile['dwell'])
+        else:
+            spr.experiment(profile['exp_range'], profile['step'], directory, name)
+        points += int((profile['exp_range'][1]-profile['exp_range'][0])/profile['step'])+1
+    elapsed = time.perf_counter()-started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stop.set()
+    ui.join()
+    return {
+        'profile': name,
+        'settings': profile,
+        'points': points,
+        'elapsed_s': elapsed,
+        'points_per_s': points/elapsed,
+        'memory_growth_kb': (current-before)/1024,
+        'memory_peak_kb': peak/1024,
+        'phases': spr.phase_timer.summary(),
+        'queries': {command: {'n': int(counts.sum()), 'p50_ms': spr.nd.latency.percentile(command, 50),
+                              'p99_ms': spr.nd.latency.percentile(command, 99)}
+                    for command, counts in spr.nd.latency.counts.items()},
+    }
+
+def print_result(result):
+    print(f"\n{result['profile']}: {result['points']} points in {result['elapsed_s']:.1f} s "
+          f"-> {result['points_per_s']:.2f} points/s, memory +{result['memory_growth_kb']:.0f} kB "
+          f"(peak {result['memory_peak_kb']:.0f} kB)")
+    print(f"  {'phase':<10}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'total s':>10}")
+    for phase, stats in result['phases'].items():
+        print(f"  {phase:<10}{stats['n']:>7}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}"
+              f"{stats['p99_ms']:>10.3f}{stats['total_s']:>10.2f}")
+
+def compare(results, baseline_file, tolerance):
+    """
+    :return: True if no profile lost more than tolerance (fraction) of its baseline points/s
+    """
+    with open(baseline_file) as f:
+        baseline = {result['profile']: result for result in json.load(f)['results']}
+
+    ok = True
+    print(f"\nComparison with {baseline_file}:")
+    for result in results:
+        if result['profile'] not in baseline:
+            continue
+        old = baseline[result['profile']]['points_per_s']
+        change = result['points_per_s']/old-1
+        regressed = change < -tolerance
+        ok &= not regressed
+        print(f"  {result['profile']:<10}{old:>8.2f} -> {result['points_per_s']:.2f} points/s ({100*change:+.1f} %)"
+              + ("  REGRESSION" if regressed else ""))
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backend', choices=['sim', 'hardware'], default='sim')
+    parser.add_argument('--profiles', nargs='+', choices=list(PROFILES), default=list(PROFILES))
+    parser.add_argument('--latency', type=float, default=None, help='simulated command latency [s]')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='earlier --json output to compare points/s against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed points/s loss before failing')
+    args = parser.parse_args()
+
+    install(*make_backend(args.backend, args.latency))
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.profiles:
+            results.append(run_profile(name, PROFILES[name], directory))
+            print_result(results[-1])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'backend': args.backend, 'python': platform.python_version(), 'time': time.time(),
+                       'results': results}, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,216 @@
+"""
+Headless queue runner for the SPR control software.
+
+Runs a job file through the same queue and acquisition code as the GUI, without opening a window, and writes
+the same scan, kinetics and sensorgram files. The remaining queue is saved next to the job file after every
+job, so an interrupted run can be continued with --resume.
+
+    python SPR_headless.py jobs.json
+    python SPR_headless.py jobs.yaml --simulate     # YAML job files need PyYAML
+    python SPR_headless.py jobs.json --dry-run      # list the jobs with their estimated duration
+    python SPR_headless.py jobs.json --resume       # continue an interrupted run
+
+A job file holds a list of jobs, or a dict with "defaults" and "jobs". Each job gives its kind (a key of
+JOB_TYPES) and the keyword arguments of that job function, optionally a name and a repeat count:
+
+    {"defaults": {"directory": "data", "fmt": "csv"},
+     "jobs": [{"kind": "step", "exp_range": [40, 50], "step": 0.1, "file": "baseline", "repeat": 3},
+              {"kind": "wait", "wait_time": 300},
+              {"kind": "kinetics", "angle": 44.0, "duration": 1800, "file": "binding"}]}
+
+Defaults are only passed to jobs whose function takes that argument.
+"""
+
+import time
+started = time.perf_counter()
+
+import argparse
+import inspect
+import json
+import os
+import sys
+
+import Run_SPR_v5 as spr
+import SPR_livefeed
+
+imported = time.perf_counter()
+
+def load_jobs(filename):
+    """
+    :return: list of QueueElement, without features until the instruments are connected
+    :raise ValueError: for unknown job kinds, unknown or missing arguments, file formats not installed here
+    """
+    with open(filename) as f:
+        if filename.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('YAML job files need PyYAML (pip install pyyaml), JSON works without it')
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    defaults = spec.get('defaults', {})
+
+    jobs = []
+    for number, job in enumerate(spec['jobs']):
+        job = dict(job)
+        kind = job.pop('kind', None)
+        if kind not in spr.JOB_TYPES:
+            raise ValueError(f"job {number}: unknown kind {kind!r}, expected one of {', '.join(spr.JOB_TYPES)}")
+        name = job.pop('name', None)
+        repeat = job.pop('repeat', 1)
+
+        accepted = {key: parameter for key, parameter in inspect.signature(spr.JOB_TYPES[kind]).parameters.items()
+                    if key != 'state'}
+        unknown = [key for key in job if key not in accepted]
+        if unknown:
+            raise ValueError(f"job {number} ({kind}): unknown argument(s) {', '.join(unknown)}")
+        params = {key: value for key, value in defaults.items() if key in accepted}
+        params.update(job)
+        missing = [key for key, parameter in accepted.items()
+                   if parameter.default is inspect.Parameter.empty and key not in params]
+        if missing:
+            raise ValueError(f"job {number} ({kind}): missing argument(s) {', '.join(missing)}")
+        if 'fmt' in params:
+            try:
+                spr.ScanWriter.check_format(params['fmt'])
+            except ValueError as e:
+                raise ValueError(f"job {number} ({kind}): {e}")
+        if kind == 'average' and params.get('direction', 'forward') not in ('forward', 'reverse'):
+            raise ValueError(f"job {number} ({kind}): direction must be 'forward' or 'reverse', repeats in both "
+                             f"directions would mix the shifted dips")
+
+        if name is None:
+            name = f"{kind}: " + ', '.join(f'{key}={value}' for key, value in job.items() if key != 'directory')
+        for idx in range(repeat):
+            jobs.append(spr.QueueElement(name, kind, json.loads(json.dumps(params)), 0.0))
+    return jobs
+
+def connect(simulate, xps_host='192.168.254.254', device_id=None):
+    """
+    Unlike the GUI there is no fallback to the simulator, an unattended run should not record simulated data
+    :param xps_host: IP address of the XPS
+    :param device_id: USB device id of the 2936, None for the first one
+    :return: [xps, power meter]
+    """
+    if simulate:
+        from SPR_simulator import Simulated_XPS, Simulated_2936
+        xps = Simulated_XPS("XY", verbose=False)
+        nd = Simulated_2936(xps, interval_ms=1)
+    else:
+        nd = spr.Newport_2936(interval_ms=1, device_id=device_id)
+        if nd.status != 'Connected':
+            raise ConnectionError('cannot connect to the 2936')
+        xps = spr.Newport_XPS("XY", verbose=False, host=xps_host)
+    xps.set_velocity(velo=5, accl=4)
+    return [xps, nd]
+
+def install(xps, nd, jobs, queue_file, timings_file='job_timings.jsonl', feed=SPR_livefeed.DEFAULT_NAME):
+    """
+    Run_SPR_v5.install without the render thread callbacks
+    :param timings_file: history of the DurationModel, next to Run_SPR_v5.py
+    :param feed: name of the shared memory live feed, None for none
+    """
+    spr.install(xps, nd, jobs, queue_file, os.path.join(os.path.dirname(os.path.abspath(spr.__file__)), timings_file),
+                feed=feed)
+
+def estimate(jobs):
+    """
+    Describes the jobs for the DurationModel (jobs from a job file have no features yet) and predicts their durations
+    """
+    for element in jobs:
+        if element.features is None:
+            element.features = spr.job_features(element.kind, element.params)
+    spr.experiment_queue.update_durations(spr.duration_model)
+
+def queue_status():
+    """
+    Progress of the installed queue
+    :return: dict with status, the running job and its progress, jobs left, estimated minutes left and the last dip
+    """
+    with spr.queue_lock:
+        jobs_left = len(spr.experiment_queue)
+        minutes_left = spr.experiment_queue.total
+        current = spr.executor.current
+        progress = spr.executor.progress
+        if current is not None and spr.experiment_queue.index(current) is not None:
+            minutes_left -= current.duration*progress
+    sensorgram = spr.dip_tracker.sensorgram.columns()
+    return {'status': spr.executor.status(), 'job': current.name if current is not None else None,
+            'progress': progress if current is not None else 0.0, 'jobs_left': jobs_left,
+            'minutes_left': minutes_left,
+            'dip': float(sensorgram[1][-1]) if len(sensorgram[1]) else None}
+
+def run_queue(queue_file, on_status=None, status_interval=1.0):
+    """
+    Runs the installed queue until it is empty, stopped by a failed job or interrupted with Ctrl+C
+    :param on_status: called with queue_status() every status_interval seconds while the queue runs
+    :return: number of jobs left
+    """
+    spr.save_queue()
+    spr.executor.start()
+    try:
+        # sleep rather than join, an interrupted Thread.join can leave the thread marked as stopped
+        while spr.executor.running:
+            time.sleep(status_interval)
+            if on_status is not None:
+                on_status(queue_status())
+    except KeyboardInterrupt:
+        print('Interrupted, stopping the running job.')
+        spr.executor.abort_now()
+        spr.executor.join()
+
+    with spr.queue_lock:
+        remaining = len(spr.experiment_queue)
+    if remaining == 0:
+        os.remove(queue_file.filename)
+    return remaining
+
+def print_jobs(jobs):
+    print(f"  {'#':>3}  {'min':>8}  name")
+    for count, element in enumerate(jobs):
+        print(f"  {count:>3}  {element.duration:>8.2f}  {element.name}")
+    print(f"  total {sum(element.duration for element in jobs):.1f} min")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('jobs', help='JSON or YAML job file')
+    parser.add_argument('--simulate', action='store_true', help='use the simulated XPS and 2936')
+    parser.add_argument('--dry-run', action='store_true', help='only list the jobs, implies --simulate')
+    parser.add_argument('--resume', action='store_true', help='continue the queue left by an interrupted run')
+    parser.add_argument('--feed', default=SPR_livefeed.DEFAULT_NAME, help='name of the live feed, see SPR_livefeed.py')
+    args = parser.parse_args()
+
+    queue_file = spr.QueueFile(os.path.splitext(args.jobs)[0]+'.queue.json')
+    try:
+        jobs = queue_file.load() if args.resume else load_jobs(args.jobs)
+    except (OSError, ValueError, KeyError) as e:
+        print(f'Could not read {queue_file.filename if args.resume else args.jobs}: {e}')
+        sys.exit(2)
+    if not jobs:
+        print('Nothing to run.')
+        sys.exit(0)
+    loaded = time.perf_counter()
+
+    try:
+        xps, nd = connect(args.simulate or args.dry_run)
+    except Exception as e:
+        print(f'Problem with connection ({e!r}).')
+        sys.exit(2)
+    connected = time.perf_counter()
+    print(f'Startup {loaded-started:.2f} s (imports {imported-started:.2f} s), instruments {connected-loaded:.2f} s')
+
+    install(xps, nd, jobs, queue_file, feed=None if args.dry_run else args.feed)
+    estimate(jobs)
+    print_jobs(jobs)
+    if args.dry_run:
+        sys.exit(0)
+
+    remaining = run_queue(queue_file, status_interval=0.5)
+    if spr.live_feed is not None:
+        spr.live_feed.close()
+    if remaining:
+        print(f'{remaining} job(s) left, continue with --resume.')
+        sys.exit(1)
@@ -0,0 +1,228 @@
+"""
+Live feed of measured points through shared memory.
+
+The acquisition code publishes every point (time, angle, mean power, SD and the queue job it belongs to) into a
+ring buffer in a named multiprocessing.shared_memory block. Other processes on the same PC attach with
+LiveFeedReader and follow the run as it happens, without sockets and without slowing the acquisition down:
+publishing is one record written into the buffer and a counter update.
+
+    python SPR_livefeed.py                # print points as they arrive
+    python SPR_livefeed.py spr_live_bench1
+
+    reader = LiveFeedReader()
+    while reader.wait(timeout=60):
+        for point in reader.read():
+            print(point['angle'], point['power'])
+
+The layout is a 256 byte header (magic, capacity, count of points written, job number and name, process id
+of the writer) followed by capacity records of RECORD_DTYPE. Each record is a seqlock: the writer marks it
+invalid, fills it, then writes its seq and raises the count. A reader copies the records and then reads their
+seq from shared memory again, a record which was invalid or rewritten during the copy is dropped and counted as
+lost instead of being returned half-written.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = b'SPRFEED2'
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('capacity', '<u8'), ('count', '<u8'), ('job', '<u8'), ('pid', '<u8'),
+                         ('job_name', 'S216')])
+RECORD_DTYPE = np.dtype([('seq', '<u8'), ('time', '<f8'), ('angle', '<f8'), ('power', '<f8'), ('std_power', '<f8'),
+                         ('job', '<u8')])
+DEFAULT_NAME = 'spr_live'
+INVALID = np.uint64(2**64-1)    # seq of a record being written
+
+_created = set()    # feeds written by this process
+
+def _attach(name):
+    """
+    Opens an existing block without handing it to the resource tracker, which would otherwise unlink it
+    when the reader exits (Python < 3.13 on POSIX)
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    if sys.platform != 'win32' and name not in _created:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def _writer_gone(shm):
+    """
+    Whether the process which wrote a feed has exited, so the block was left behind. Only POSIX keeps a block
+    after its last handle is closed, on Windows an existing feed always belongs to a running process.
+    """
+    if sys.platform == 'win32' or shm.size < HEADER_DTYPE.itemsize:
+        return False
+    header = np.ndarray((), dtype=HEADER_DTYPE, buffer=shm.buf)
+    pid = int(header['pid'])
+    del header
+    if pid == 0:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+class LiveFeed:
+    """
+    Writer side, owned by the acquisition process. Jobs are numbered from 1 in the order they publish their
+    first point, 0 is for points published outside the queue.
+    """
+    def __init__(self, name=DEFAULT_NAME, capacity=65536):
+        """
+        :param name: of the shared memory block, one per bench
+        :param capacity: points kept, older ones are overwritten
+        :raise FileExistsError: if another running process writes a feed of that name
+        """
+        size = HEADER_DTYPE.itemsize + capacity*RECORD_DTYPE.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            existing = shared_memory.SharedMemory(name)
+            gone = _writer_gone(existing)
+            existing.close()
+            if not gone:
+                raise FileExistsError(f'live feed {name} is in use by another program, give this one another name')
+            # left behind by a process that did not close it, take it over
+            existing.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _created.add(name)
+        self.name = name
+        self.capacity = capacity
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        self.records = np.ndarray((capacity,), dtype=RECORD_DTYPE, buffer=self.shm.buf, offset=HEADER_DTYPE.itemsize)
+        self.header['capacity'] = capacity
+        self.header['count'] = 0
+        self.header['job'] = 0
+        self.header['pid'] = os.getpid()
+        self.header['magic'] = MAGIC
+        self._job_element = None
+
+    def publish(self, angle, power, std_power, job=None, timestamp=None):
+        """
+        :param job: the running QueueElement, a new one starts the next job number
+        :param timestamp: epoch seconds, default now
+        """
+        if job is not self._job_element:
+            self._job_element = job
+            self.header['job_name'] = (job.name if job is not None else '').encode()[:HEADER_DTYPE['job_name'].itemsize]
+            self.header['job'] += 1
+        seq = int(self.header['count'])
+        slot = seq % self.capacity
+        self.records['seq'][slot] = INVALID
+        self.records[slot] = (INVALID, time.time() if timestamp is None else timestamp, angle, power, std_power,
+                              self.header['job'])
+        self.records['seq'][slot] = seq
+        self.header['count'] = seq+1
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.name)
+
+class LiveFeedReader:
+    """
+    Reader side, any number of them can follow one feed
+    """
+    def __init__(self, name=DEFAULT_NAME, from_start=False):
+        """
+        :param from_start: also return the points still in the buffer, otherwise only new ones
+        :raise FileNotFoundError: if no feed of that name is running
+        """
+        self.shm = _attach(name)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        if self.header['magic'] != MAGIC:
+            raise ValueError(f'{name} is not an SPR live feed')
+        self.capacity = int(self.header['capacity'])
+        self.records = np.ndarray((self.capacity,), dtype=RECORD_DTYPE, buffer=self.shm.buf,
+                                  offset=HEADER_DTYPE.itemsize)
+        count = int(self.header['count'])
+        self.next = max(count-self.capacity, 0) if from_start else count
+        self.lost = 0   # points overwritten before they were read
+
+    @property
+    def available(self):
+        return int(self.header['count'])-self.next
+
+    @property
+    def job(self):
+        """
+        [number, name] of the job that published last
+        """
+        return [int(self.header['job']), self.header['job_name'].item().decode(errors='replace')]
+
+    def view(self):
+        """
+        The whole ring buffer without copying, in slot order. Check seq, the writer keeps going.
+        """
+        return self.records
+
+    def read(self):
+        """
+        :return: copy of the points published since the last read, oldest first, as a RECORD_DTYPE array
+        """
+        count = int(self.header['count'])
+        if count-self.next > self.capacity:
+            self.lost += count-self.capacity-self.next
+            self.next = count-self.capacity
+        seq = np.arange(self.next, count, dtype=np.uint64)
+        slots = seq % self.capacity
+        points = self.records[slots]
+        # the seq in shared memory after the copy, a record which changed meanwhile is not the one copied
+        valid = (points['seq'] == seq) & (self.records['seq'][slots] == seq)
+        self.lost += int((~valid).sum())
+        self.next = count
+        return points[valid]
+
+    def wait(self, timeout=None, poll=(0.0005, 0.02)):
+        """
+        Blocks until new points are published. The count in the header is polled, starting fast and backing off.
+        :param poll: first and longest wait between checks, in seconds
+        :return: False if the timeout passed first
+        """
+        deadline = None if timeout is None else time.monotonic()+timeout
+        interval = poll[0]
+        while self.available <= 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+            interval = min(2*interval, poll[1])
+        return True
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_NAME
+    try:
+        reader = LiveFeedReader(name)
+    except FileNotFoundError:
+        print(f'No live feed {name} running')
+        sys.exit(1)
+    print(f"{'time':<10}{'job':>5}{'angle':>10}{'power':>14}{'SD':>12}")
+    job = None
+    try:
+        while True:
+            if not reader.wait(timeout=1.0):
+                continue
+            for point in reader.read():
+                if point['job'] != job:
+                    job = point['job']
+                    print(f'--- job {job}: {reader.job[1]}')
+                print(f"{time.strftime('%H:%M:%S', time.localtime(point['time'])):<10}{point['job']:>5}"
+                      f"{point['angle']:>10.3f}{point['power']:>14.6g}{point['std_power']:>12.3g}")
+            if reader.lost:
+                print(f'({reader.lost} points lost, the reader fell behind)')
+                reader.lost = 0
+    except KeyboardInterrupt:
+        reader.close()
@@ -0,0 +1,410 @@
+"""
+Simulated Newport XPS motion controller and Newport 2936 power meter.
+
+Simulated_XPS and Simulated_2936 are drop-in replacements for Newport_XPS and Newport_2936 which run
+on any machine. The simulation sits below the instrument classes (the NewportXPS object and the
+usbdll.dll function table are replaced), so every query still goes through the real SCPI code path
+and its timing. The reflected power follows a prism coupled SPR reflectance curve evaluated at the
+simulated arm position.
+"""
+
+import numpy as np
+import time
+import threading
+from ctypes import memmove
+
+from Run_SPR_v5 import Newport_XPS, Newport_2936
+
+class SPRModel:
+    """
+    TM reflectance of a prism / layer / semi-infinite medium stack.
+    kretschmann: prism | metal film | sample
+    otto:        prism | sample gap | metal
+    Angles are internal angles of incidence in degrees (the relative angle shown in the GUI).
+    """
+    def __init__(self, geometry='kretschmann', n_prism=1.515, eps_metal=-11.6+1.2j, metal_thickness=50e-9,
+                 n_sample=1.0, gap=600e-9, wavelength=633e-9, drift_per_hour=0.0, incident_power=1e-3):
+        """
+        :param eps_metal: complex permittivity of the metal at the wavelength (gold at 633 nm by default)
+        :param gap: sample gap thickness for the Otto geometry
+        :param drift_per_hour: change of the sample refractive index per hour, moves the dip for tracking tests
+        :param incident_power: power in W reaching the detector at full reflection
+        """
+        self.geometry = geometry
+        self.n_prism = n_prism
+        self.eps_metal = eps_metal
+        self.metal_thickness = metal_thickness
+        self.n_sample = n_sample
+        self.gap = gap
+        self.wavelength = wavelength
+        self.drift_per_hour = drift_per_hour
+        self.incident_power = incident_power
+        self.t0 = time.perf_counter()
+
+    def sample_index(self, t):
+        return self.n_sample + self.drift_per_hour*(t-self.t0)/3600
+
+    def reflectance(self, angle, t=None):
+        """
+        :param angle: array of incidence angles in degrees
+        :param t: array (or scalar) of time.perf_counter times, for the drifting sample index
+        """
+        angle = np.asarray(angle, dtype=float)
+        t = time.perf_counter() if t is None else t
+        eps_sample = self.sample_index(np.asarray(t, dtype=float))**2 + 0j
+        eps_prism = self.n_prism**2
+        if self.geometry == 'otto':
+            eps_layer, eps_last, thickness = eps_sample, self.eps_metal, self.gap
+        else:
+            eps_layer, eps_last, thickness = self.eps_metal, eps_sample, self.metal_thickness
+
+        # normal wavevector components in units of k0, the branch with Im >= 0 decays into the stack
+        kx2 = eps_prism*np.sin(np.radians(angle))**2
+        kz1 = np.sqrt(eps_prism-kx2+0j)
+        kz2 = np.sqrt(eps_layer-kx2+0j)
+        kz3 = np.sqrt(eps_last-kx2+0j)
+
+        r12 = (eps_layer*kz1-eps_prism*kz2)/(eps_layer*kz1+eps_prism*kz2)
+        r23 = (eps_last*kz2-eps_layer*kz3)/(eps_last*kz2+eps_layer*kz3)
+        phase = np.exp(2j*kz2*2*np.pi/self.wavelength*thickness)
+        r = (r12+r23*phase)/(1+r12*r23*phase)
+        return np.abs(r)**2
+
+    def power(self, angle, t=None):
+        return self.incident_power*self.reflectance(angle, t)
+
+class SimulatedNewportXPS:
+    """
+    Stand-in for newportxps.NewportXPS with one group whose axes move together.
+    Moves follow a trapezoidal velocity profile and block for the travel plus settle time, like
+    GroupMoveAbsolute. Past moves are kept, so the position at any earlier time can be looked up.
+    """
+    def __init__(self, group='XY', velocity=20.0, acceleration=80.0, settle_time=0.05, command_latency=0.002,
+                 host='simulated', port=5001, timeout=1):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.group = group
+        self.groups = {group: {'category': 'MultipleAxes', 'positioners': ['X', 'Y']}}
+        self.stages = {f'{group}.X': {'stagetype': 'simulated'}, f'{group}.Y': {'stagetype': 'simulated'}}
+        self.velocity = {stage: velocity for stage in self.stages}
+        self.acceleration = {stage: acceleration for stage in self.stages}
+        self.settle_time = settle_time
+        self.command_latency = command_latency
+
+        self._lock = threading.Lock()
+        self._home = 0.0
+        self._moves = []    # (start time, start position, end position, velocity, acceleration, duration)
+        self._initial = 0.0
+        self._xps = _SimulatedXPSLib(self)
+
+    def _latency(self):
+        if self.command_latency > 0:
+            time.sleep(self.command_latency)
+
+    def status_report(self):
+        return f'Simulated XPS, group {self.group}, position {self.position_at(time.perf_counter()):.4f}'
+
+    def kill_group(self, group=None):
+        self._latency()
+
+    def initialize_group(self, group=None):
+        self._latency()
+
+    def set_velocity(self, stage, velo, accl=None):
+        self._latency()
+        self.velocity[stage] = velo
+        if accl is not None:
+            self.acceleration[stage] = accl
+
+    def get_stage_position(self, stage):
+        self._latency()
+        return self.position_at(time.perf_counter())
+
+    def home_group(self, group=None):
+        self._move_to(self._home)
+
+    def move_group(self, group=None, **kws):
+        self._move_to(float(list(kws.values())[0]))
+
+    def _move_to(self, target):
+        self._latency()
+        stage = f'{self.group}.X'
+        with self._lock:
+            now = time.perf_counter()
+            start = self.position_at(now)
+            velo, accl = self.velocity[stage], self.acceleration[stage]
+            duration = self._profile_duration(abs(target-start), velo, accl)
+            self._moves.append((now, start, target, velo, accl, duration))
+            del self._moves[:-64]
+        time.sleep(duration+self.settle_time)
+
+    @staticmethod
+    def _profile_duration(distance, velo, accl):
+        if distance*accl < velo**2:
+            return 2*np.sqrt(distance/accl)   # triangular profile, never reaches velo
+        return velo/accl + distance/velo
+
+    def position_at(self, times):
+        """
+        Group position at the given time.perf_counter times (scalar or array)
+        """
+        times = np.asarray(times, dtype=float)
+        moves = list(self._moves)
+        position = np.full(times.shape, moves[0][1] if moves else self._initial)
+        starts = np.array([move[0] for move in moves])
+        which = np.searchsorted(starts, times, side='right')-1
+        for idx in np.unique(which[which >= 0]):
+            t_start, p0, p1, velo, accl, duration = moves[idx]
+            mask = which == idx
+            tau = np.clip(times[mask]-t_start, 0, duration)
+            distance = abs(p1-p0)
+            peak = min(velo, np.sqrt(distance*accl))
+            t_acc = peak/accl
+            travelled = np.where(tau < t_acc, 0.5*accl*tau**2,
+                                 np.where(tau < duration-t_acc, 0.5*accl*t_acc**2 + peak*(tau-t_acc),
+                                          distance-0.5*accl*(duration-tau)**2))
+            position[mask] = p0 + np.sign(p1-p0)*np.clip(travelled, 0, distance)
+        return position if position.ndim else float(position)
+
+class _SimulatedXPSLib:
+    """
+    The few XPS_C8 socket calls used directly by Newport_XPS.start_move_abs
+    """
+    def __init__(self, xps):
+        self.xps = xps
+
+    def TCP_ConnectToServer(self, host, port, timeout):
+        return 1
+
+    def TCP_CloseSocket(self, socket_id):
+        return 0
+
+    def GroupMoveAbsolute(self, socket_id, group, positions):
+        self.xps._move_to(float(positions[0]))
+        return [0, '']
+
+class Simulated_XPS(Newport_XPS):
+    """
+    Newport_XPS running on SimulatedNewportXPS
+    """
+    simulated = True
+
+    def __init__(self, group, velocity=20.0, acceleration=80.0, settle_time=0.05, command_latency=0.002, verbose=True):
+        self._sim_settings = dict(group=group, velocity=velocity, acceleration=acceleration,
+                                  settle_time=settle_time, command_latency=command_latency)
+        super().__init__(group, verbose)
+
+    def _connect(self):
+        return SimulatedNewportXPS(**self._sim_settings)
+
+class SimulatedUSB:
+    """
+    Replacement for the usbdll.dll function table with a small 2936 SCPI interpreter.
+    The data store is generated lazily: samples exist at fixed intervals from the moment it was enabled
+    and are only computed when a query needs them, so memory and cost follow the buffer size.
+    """
+    def __init__(self, stage, model, noise=0.002, command_latency=0.003, byte_time=1e-6,
+                 model_number=2936, serial_number=12345):
+        """
+        :param stage: SimulatedNewportXPS providing the arm angle (relative angle = 90 - position)
+        :param noise: relative standard deviation of every reading
+        :param command_latency: time until a reply is ready, plus byte_time per reply byte
+        """
+        self.stage = stage
+        self.model = model
+        self.noise = noise
+        self.command_latency = command_latency
+        self.byte_time = byte_time
+        self.model_number = model_number
+        self.serial_number = serial_number
+        self.rng = np.random.default_rng()
+
+        self.wavelength = 633
+        self.filter = 0
+        self.ds_ring = True
+        self.ds_interval = 10   # units of 0.1 ms
+        self.ds_size = 1000
+        self.ds_enabled_at = None
+        self.ds_stopped_at = None
+        self.ds_first = 0       # index of the oldest sample in ds_values
+        self.ds_values = np.empty(0)
+
+        self._reply = b''
+        self._ready_at = 0.0
+
+    # --- usbdll.dll functions
+
+    def newp_usb_init_system(self):
+        return 0
+
+    def newp_usb_uninit_system(self):
+        return 0
+
+    def newp_usb_open_devices(self, product_id, use_usb_address, num_devices):
+        num_devices._obj.value = 1
+        return 0
+
+    def GetInstrumentList(self, instruments, models, serials, count):
+        instruments._obj.value = 1
+        models._obj.value = self.model_number
+        serials._obj.value = self.serial_number
+        count._obj.value = 1
+        return 0
+
+    def newp_usb_send_ascii(self, device_id, command, length):
+        text = command._obj.value.decode('ascii')
+        replies = []
+        for part in text.split(';'):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                reply = self._execute(part)
+            except (ValueError, KeyError, IndexError):
+                return 1
+            if reply is not None:
+                replies.append(reply)
+        if replies:
+            self._reply = (','.join(replies)+'\r\n').encode('ascii')
+            self._ready_at = time.perf_counter()+self.command_latency+len(self._reply)*self.byte_time
+        return 0
+
+    def newp_usb_get_ascii(self, device_id, response, length, read_bytes):
+        # nothing (yet) to read is an empty but successful read
+        n = 0
+        if self._reply and time.perf_counter() >= self._ready_at:
+            n = min(len(self._reply), length.value-1)
+            memmove(response._obj, self._reply[:n], n)
+            self._reply = self._reply[n:]
+        read_bytes._obj.value = n
+        return 0
+
+    # --- instrument
+
+    def _execute(self, command):
+        """
+        :return: reply text for queries, None for settings
+        :raise KeyError: unknown command
+        """
+        header, _, argument = command.partition(' ')
+        header = header.upper()
+        argument = argument.strip()
+
+        if header == '*IDN?':
+            return f'NEWPORT {self.model_number} simulated SN{self.serial_number}'
+        if header == 'PM:MIN:LAMBDA?':
+            return '400'
+        if header == 'PM:MAX:LAMBDA?':
+            return '1100'
+        if header == 'PM:LAMBDA?':
+            return str(self.wavelength)
+        if header == 'PM:LAMBDA':
+            self.wavelength = int(argument)
+            return None
+        if header == 'PM:FILT':
+            self.filter = int(argument)
+            return None
+        if header == 'PM:FILT?':
+            return str(self.filter)
+        if header == 'PM:POWER?':
+            now = time.perf_counter()
+            return self._format(self._readings(np.array([now]))[0])
+
+        if header == 'PM:DS:BUF':
+            self.ds_ring = int(argument) == 1
+            return None
+        if header == 'PM:DS:INT':
+            self.ds_interval = int(argument)
+            return None
+        if header == 'PM:DS:SIZE':
+            self.ds_size = int(argument)
+            return None
+        if header == 'PM:DS:EN':
+            if int(argument) == 1:
+                self._clear()
+                self.ds_enabled_at = time.perf_counter()
+            elif self.ds_enabled_at is not None and self.ds_stopped_at is None:
+                self._update()
+                self.ds_stopped_at = time.perf_counter()
+            return None
+        if header == 'PM:DS:EN?':
+            return '1' if self.ds_enabled_at is not None and self.ds_stopped_at is None else '0'
+        if header in ('PM:DS:CL', 'PM:DS:CLEAR'):
+            self._clear()
+            return None
+        if header == 'PM:DS:COUNT?':
+            return str(len(self._update()))
+        if header == 'PM:DS:GET?':
+            values = self._update()
+            selection = argument.strip('"')
+            if selection.startswith('+'):
+                values = values[:int(selection[1:])]
+            elif selection.startswith('-'):
+                values = values[-int(selection[1:]):]
+            else:
+                first, _, last = selection.partition('-')
+                values = values[int(first)-1:int(last or first)]
+            lines = ['Header', 'End of Header'] + [self._format(value) for value in values] + ['End of Data']
+            return '\r\n'.join(lines)
+        if header == 'PM:STAT:MEAN?':
+            return self._format(np.mean(self._update()))
+        if header == 'PM:STAT:SDEV?':
+            return self._format(np.std(self._update(), ddof=1))
+        raise KeyError(header)
+
+    @staticmethod
+    def _format(value):
+        return f'{value:.6E}'
+
+    def _readings(self, times):
+        angle = 90-self.stage.position_at(times)
+        power = self.model.power(angle, times)
+        return power*(1+self.noise*self.rng.standard_normal(len(times)))
+
+    def _clear(self):
+        self.ds_enabled_at = None
+        self.ds_stopped_at = None
+        self.ds_first = 0
+        self.ds_values = np.empty(0)
+
+    def _update(self):
+        """
+        Generates the samples taken since the last query and applies ring or one-shot buffer rules
+        :return: stored values, oldest first
+        """
+        if self.ds_enabled_at is None:
+            return self.ds_values
+        dt = self.ds_interval*1e-4
+        until = self.ds_stopped_at if self.ds_stopped_at is not None else time.perf_counter()
+        total = int((until-self.ds_enabled_at)/dt)+1
+        if not self.ds_ring:
+            total = min(total, self.ds_size)
+
+        have = self.ds_first+len(self.ds_values)
+        if total > have:
+            oldest = max(self.ds_first, total-self.ds_size)
+            first_new = max(have, oldest)
+            times = self.ds_enabled_at+np.arange(first_new, total)*dt
+            self.ds_values = np.concatenate([self.ds_values[oldest-self.ds_first:], self._readings(times)])
+            self.ds_first = total-len(self.ds_values)
+        return self.ds_values
+
+class Simulated_2936(Newport_2936):
+    """
+    Newport_2936 talking to SimulatedUSB instead of usbdll.dll
+    """
+    simulated = True
+
+    def __init__(self, stage, interval_ms=1, buff_size=1000, wavelength=633, model=None, noise=0.002,
+                 command_latency=0.003):
+        """
+        :param stage: Simulated_XPS whose arm position sets the angle of incidence
+        :param model: SPRModel, a gold Kretschmann stack in air by default
+        """
+        self.usb = SimulatedUSB(stage.xps, model if model is not None else SPRModel(), noise=noise,
+                                command_latency=command_latency)
+        super().__init__(interval_ms=interval_ms, buff_size=buff_size, wavelength=wavelength)
+
+    def _load_library(self):
+        self.LIBNAME = 'simulated'
+        self.lib = self.usb
+        self.product_id = 0xCEC7
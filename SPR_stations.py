@@ -0,0 +1,206 @@
+"""
+Runs several SPR benches from one scheduler.
+
+A station bundles an XPS, a 2936 and a job file (see SPR_headless.py). Every station runs its queue in a worker
+process of its own, with the same acquisition code as the GUI. The acquisition code keeps its instruments in
+module globals, so one process per bench gives each its own, and a slow reply on one bench cannot hold up the
+others. The scheduler prints a combined status and ETA of all benches.
+
+    python SPR_stations.py stations.json
+    python SPR_stations.py stations.json --resume   # continue after an interruption
+
+    {"stations": [{"name": "bench1", "jobs": "bench1_jobs.json", "xps_host": "192.168.254.254", "device_id": 1},
+                  {"name": "bench2", "jobs": "bench2_jobs.json", "xps_host": "192.168.254.253", "device_id": 2},
+                  {"name": "sim", "jobs": "test_jobs.json", "simulate": true}]}
+
+Each station keeps its remaining queue in <jobs>.<name>.queue.json and its job timings in
+job_timings_<name>.jsonl, since the benches do not run at the same speed. Its points are published on the
+live feed spr_live_<name>.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import Run_SPR_v5 as spr
+import SPR_headless as headless
+
+class Station:
+    """
+    One bench: motion controller, power meter and job queue
+    """
+    def __init__(self, name, jobs, xps_host='192.168.254.254', device_id=None, simulate=False):
+        """
+        :param jobs: job file, see SPR_headless.py
+        :param xps_host: IP address of the XPS
+        :param device_id: USB device id of the 2936, None for the first one the driver lists
+        :param simulate: use the simulated instruments
+        """
+        self.name = name
+        self.jobs = jobs
+        self.xps_host = xps_host
+        self.device_id = device_id
+        self.simulate = simulate
+        self.process = None
+
+    @property
+    def feed(self):
+        """
+        Name of the station's shared memory live feed, see SPR_livefeed.py
+        """
+        return f'spr_live_{self.name}'
+
+    @property
+    def queue_file(self):
+        return os.path.splitext(self.jobs)[0]+f'.{self.name}.queue.json'
+
+    def start(self, status_queue, resume=False, status_interval=1.0):
+        """
+        Runs the queue in a worker process which puts (name, status dict) on status_queue
+        """
+        self.process = multiprocessing.Process(target=run_station, args=(self, status_queue, resume, status_interval),
+                                               name=f'Station {self.name}')
+        self.process.start()
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.is_alive()
+
+class StationOutput:
+    """
+    Prefixes every line a station prints with its name, the worker processes share the console.
+    Text is held back until its line is complete (print writes the newline separately), then the complete
+    lines go out with their prefixes in one write and are flushed, so lines of parallel stations do not mix.
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.prefix = f'[{name}] '
+        self._partial = ''
+
+    def write(self, text):
+        self._partial += text
+        if '\n' in self._partial:
+            lines, _, self._partial = self._partial.rpartition('\n')
+            self.stream.write(''.join(self.prefix+line+'\n' for line in lines.split('\n')))
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        # an unfinished line goes out as it is, e.g. before the process ends
+        if self._partial:
+            self.stream.write(self.prefix+self._partial)
+            self._partial = ''
+        self.stream.flush()
+
+def run_station(station, status_queue, resume, status_interval):
+    """
+    Worker process of one station
+    """
+    sys.stdout = StationOutput(sys.stdout, station.name)
+    queue_file = spr.QueueFile(station.queue_file)
+    try:
+        jobs = queue_file.load() if resume else headless.load_jobs(station.jobs)
+        xps, nd = headless.connect(station.simulate, station.xps_host, station.device_id)
+    except Exception as e:
+        print(f'Could not start: {e}')
+        status_queue.put((station.name, {'status': 'Failed to start'}))
+        return
+
+    headless.install(xps, nd, jobs, queue_file, timings_file=f'job_timings_{station.name}.jsonl',
+                     feed=station.feed)
+    headless.estimate(jobs)
+    try:
+        remaining = headless.run_queue(queue_file, lambda status: status_queue.put((station.name, status)),
+                                       status_interval)
+    except KeyboardInterrupt:
+        # Ctrl+C reaches every worker, a second one while stopping ends up here
+        remaining = None
+    if spr.live_feed is not None:
+        spr.live_feed.close()
+    status = headless.queue_status()
+    status['status'] = 'Finished' if remaining == 0 else 'Stopped'
+    status_queue.put((station.name, status))
+
+def load_stations(filename):
+    """
+    :return: list of Station
+    """
+    with open(filename) as f:
+        spec = json.load(f)
+    stations = [Station(**settings) for settings in spec['stations']]
+    names = [station.name for station in stations]
+    if len(set(names)) != len(names):
+        raise ValueError('station names must be unique')
+    return stations
+
+def print_status(latest):
+    print(f"\n{time.strftime('%H:%M:%S')}  {'station':<12}{'status':<28}{'left':>5}{'ETA min':>9}{'dip':>9}  job")
+    for name, status in latest.items():
+        left = status.get('jobs_left')
+        minutes = status.get('minutes_left')
+        dip = status.get('dip')
+        job = status.get('job')
+        print(f"{'':10}{name:<12}{status['status']:<28}{'' if left is None else left:>5}"
+              f"{'' if minutes is None else f'{minutes:.1f}':>9}{'' if dip is None else f'{dip:.3f}':>9}"
+              + (f"  {job} ({100*status['progress']:.0f} %)" if job else ''))
+    pending = [status['minutes_left'] for status in latest.values()
+               if status['status'] not in ('Finished', 'Stopped', 'Failed to start') and 'minutes_left' in status]
+    if pending:
+        print(f"{'':10}all stations done in about {max(pending):.1f} min")
+
+def run_stations(stations, resume=False, report_interval=10.0):
+    """
+    Starts every station and prints the combined status every report_interval seconds until all have stopped
+    :return: dict of the last status of every station
+    """
+    status_queue = multiprocessing.Queue()
+    latest = {station.name: {'status': 'Starting'} for station in stations}
+    for station in stations:
+        station.start(status_queue, resume)
+
+    def drain(timeout):
+        deadline = time.monotonic()+timeout
+        while True:
+            try:
+                name, status = status_queue.get(timeout=max(deadline-time.monotonic(), 0))
+            except queue.Empty:
+                return
+            latest[name] = status
+
+    try:
+        while any(station.running for station in stations):
+            drain(report_interval)
+            if any(station.running for station in stations):
+                print_status(latest)
+    except KeyboardInterrupt:
+        # the workers got the interrupt as well and stop their running jobs
+        print('Interrupted, waiting for the stations to stop.')
+        for station in stations:
+            station.process.join()
+    drain(0.5)
+    for station in stations:
+        # a worker which died without reporting, e.g. killed or crashed in the driver
+        if latest[station.name]['status'] not in ('Finished', 'Stopped', 'Failed to start'):
+            latest[station.name] = {'status': f'Exited with code {station.process.exitcode}'}
+    print_status(latest)
+    return latest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('stations', help='JSON station file')
+    parser.add_argument('--resume', action='store_true', help='continue the queues left by an interrupted run')
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between status reports')
+    args = parser.parse_args()
+
+    try:
+        stations = load_stations(args.stations)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f'Could not read {args.stations}: {e}')
+        sys.exit(2)
+    latest = run_stations(stations, args.resume, args.interval)
+    if any(status['status'] != 'Finished' for status in latest.values()):
+        sys.exit(1)
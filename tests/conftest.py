@@ -0,0 +1,31 @@
+"""
+Shared fixtures: the simulated instruments installed into Run_SPR_v5, and a Dear PyGui context without a viewport.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Run_SPR_v5 as spr
+from SPR_simulator import Simulated_XPS, Simulated_2936
+
+@pytest.fixture
+def instruments():
+    """
+    Simulated XPS and 2936 set as the globals of Run_SPR_v5, with an empty queue and nothing saved
+    """
+    xps = Simulated_XPS("XY", verbose=False)
+    xps.set_velocity(velo=5, accl=4)
+    nd = Simulated_2936(xps, interval_ms=1)
+    spr.install(xps, nd)
+    spr.duration_model.last_angle = 90
+    return xps, nd
+
+@pytest.fixture
+def gui():
+    spr.dpg.create_context()
+    yield spr.dpg
+    spr.dpg.destroy_context()
@@ -0,0 +1,75 @@
+"""
+fit_dip on reflectance curves of the simulator's SPR model: a dip inside the scan, one cut off by the scan range
+and scans without a usable dip
+"""
+
+import numpy as np
+import pytest
+
+import Run_SPR_v5 as spr
+from SPR_simulator import SPRModel
+
+METHODS = ['polynomial', 'lorentzian', 'centroid']
+
+@pytest.fixture(scope='module')
+def model():
+    return SPRModel()
+
+@pytest.fixture(scope='module')
+def resonance(model):
+    angle = np.arange(40, 48, 0.001)
+    return angle[np.argmin(model.power(angle))]
+
+@pytest.mark.parametrize('method', METHODS)
+def test_dip_inside_the_scan(model, resonance, method):
+    angle = np.arange(40, 48, 0.05)
+    fit = spr.fit_dip(angle, model.power(angle), method=method)
+    assert fit.method == method
+    assert abs(fit.angle-resonance) < 0.2
+    assert fit.depth > 0
+    assert 0.5 < fit.fwhm < 3
+
+def test_noisy_dip_has_an_uncertainty(model, resonance):
+    rng = np.random.default_rng(0)
+    angle = np.arange(40, 48, 0.05)
+    power = model.power(angle)*(1+0.002*rng.standard_normal(len(angle)))
+    fit = spr.fit_dip(angle, power, np.full(len(angle), 2e-6))
+    assert abs(fit.angle-resonance) < 0.2
+    assert 0 < fit.uncertainty < 0.2
+
+def test_unsorted_scan_with_gaps(model, resonance):
+    angle = np.arange(40, 48, 0.05)[::-1].copy()
+    power = model.power(angle)
+    power[::7] = np.nan
+    assert abs(spr.fit_dip(angle, power).angle-resonance) < 0.2
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('scanned', [(44.5, 50), (38, 43.3)])
+def test_dip_outside_the_scan(model, method, scanned):
+    angle = np.arange(*scanned, 0.05)
+    fit = spr.fit_dip(angle, model.power(angle), method=method)
+    assert np.isnan(fit.angle)
+    assert np.isnan(fit.uncertainty)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_flat_scan(method):
+    angle = np.linspace(40, 48, 50)
+    fit = spr.fit_dip(angle, np.full(50, 1e-3), method=method)
+    assert np.isnan(fit.angle)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_repeated_angle(model, method):
+    # e.g. a fixed angle logged as a scan
+    angle = np.full(20, 44.0)
+    power = model.power(angle)*(1+0.01*np.random.default_rng(1).standard_normal(20))
+    fit = spr.fit_dip(angle, power, method=method)
+    assert np.isnan(fit.angle)
+
+@pytest.mark.parametrize('n', [0, 1, 2])
+def test_too_few_points(model, n):
+    angle = np.linspace(43, 45, n)
+    assert np.isnan(spr.fit_dip(angle, model.power(angle)).angle)
+
+def test_all_nan_scan():
+    angle = np.linspace(40, 48, 30)
+    assert np.isnan(spr.fit_dip(angle, np.full(30, np.nan)).angle)
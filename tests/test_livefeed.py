@@ -0,0 +1,64 @@
+"""
+Counting of the points a LiveFeedReader misses, by falling behind or by reading a record while it is rewritten
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from SPR_livefeed import LiveFeed, LiveFeedReader, INVALID
+
+@pytest.fixture
+def feed():
+    feed = LiveFeed(f'spr_test_{os.getpid()}', capacity=16)
+    yield feed
+    feed.close()
+
+def publish(feed, n, first=0):
+    for idx in range(first, first+n):
+        feed.publish(float(idx), 1e-3, 1e-6, timestamp=float(idx))
+
+def test_reader_keeps_up(feed):
+    reader = LiveFeedReader(feed.name)
+    publish(feed, 10)
+    points = reader.read()
+    np.testing.assert_array_equal(points['angle'], np.arange(10))
+    publish(feed, 10, first=10)
+    np.testing.assert_array_equal(reader.read()['angle'], np.arange(10, 20))
+    assert reader.lost == 0
+    assert reader.available == 0
+    reader.close()
+
+def test_overwritten_points_are_lost(feed):
+    reader = LiveFeedReader(feed.name)
+    publish(feed, 40)
+    points = reader.read()
+    # only the last capacity points are still in the ring buffer
+    np.testing.assert_array_equal(points['angle'], np.arange(24, 40))
+    assert reader.lost == 24
+    publish(feed, 5, first=40)
+    assert len(reader.read()) == 5
+    assert reader.lost == 24
+    reader.close()
+
+def test_record_being_written_is_lost(feed):
+    reader = LiveFeedReader(feed.name)
+    publish(feed, 6)
+    # the writer marks a slot invalid while it rewrites it
+    feed.records['seq'][3] = INVALID
+    points = reader.read()
+    np.testing.assert_array_equal(points['angle'], [0, 1, 2, 4, 5])
+    assert reader.lost == 1
+    reader.close()
+
+def test_from_start(feed):
+    publish(feed, 20)
+    reader = LiveFeedReader(feed.name, from_start=True)
+    np.testing.assert_array_equal(reader.read()['angle'], np.arange(4, 20))
+    assert reader.lost == 0
+    reader.close()
+
+def test_second_writer_is_refused(feed):
+    with pytest.raises(FileExistsError):
+        LiveFeed(feed.name)
@@ -0,0 +1,82 @@
+"""
+JobQueue edits shown by a QueueTable: row order, row texts and the total of the predicted durations
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+import Run_SPR_v5 as spr
+
+def scan_job(rng):
+    params = {'exp_range': [rng.uniform(35, 45), rng.uniform(45, 55)], 'step': rng.choice([0.05, 0.1, 0.5]),
+              'directory': 'data', 'file': 'scan', 'direction': rng.choice(['forward', 'nearest'])}
+    return spr.QueueElement('scan', 'step', params, 0.0, spr.job_features('step', params))
+
+def wait_job(rng):
+    seconds = rng.randint(1, 600)
+    return spr.QueueElement('wait', 'wait', {'wait_time': seconds}, seconds/60, {'kind': 'wait', 'seconds': seconds})
+
+def random_edit(jobs, rng):
+    edit = rng.random()
+    if edit < 0.35 or len(jobs) < 2:
+        jobs.insert(rng.randrange(len(jobs)+1), [rng.choice([scan_job, wait_job])(rng) for idx in range(rng.randint(1, 3))])
+    elif edit < 0.55:
+        start = rng.randrange(len(jobs))
+        jobs.delete(start, min(start+rng.randint(0, 2), len(jobs)-1))
+    elif edit < 0.75:
+        jobs.move(rng.randrange(len(jobs)), rng.randrange(len(jobs)))
+    elif edit < 0.95:
+        start = rng.randrange(len(jobs))
+        jobs.repeat(start, start, rng.randint(1, 2), at=rng.choice([None, start+1]))
+    else:
+        jobs.clear()
+
+def check_table(table, jobs, dpg):
+    assert [id(element) for element in table.order] == [id(element) for element in jobs]
+    rows = [table.rows[id(element)][0] for element in jobs]
+    assert dpg.get_item_children(table.table, 1) == rows+[table.summary]
+    for count, element in enumerate(jobs):
+        texts = table.rows[id(element)][1]
+        assert dpg.get_value(texts[0]) == str(count)
+        assert dpg.get_value(texts[2]) == f'{np.round(element.duration,3)}'
+
+@pytest.mark.parametrize('seed', range(5))
+def test_table_follows_random_edits(instruments, gui, seed):
+    rng = random.Random(seed)
+    jobs = spr.experiment_queue
+    with gui.window():
+        table = spr.QueueTable(jobs)
+    for edit in range(150):
+        random_edit(jobs, rng)
+        if rng.random() < 0.3:
+            table.sync()
+            check_table(table, jobs, gui)
+    table.sync()
+    check_table(table, jobs, gui)
+
+    # the incrementally kept total and durations match predicting the whole queue again
+    synced = [element.duration for element in jobs]
+    assert spr.duration_model.update_durations(list(jobs)) == pytest.approx(0.0, abs=1e-9)
+    assert [element.duration for element in jobs] == pytest.approx(synced)
+    assert jobs.total == pytest.approx(sum(synced), abs=1e-9)
+    assert gui.get_value(table.total) == f'{np.round(jobs.total,3)}'
+
+def test_total_of_an_emptied_queue_is_zero(instruments):
+    rng = random.Random(0)
+    jobs = spr.experiment_queue
+    jobs.insert(None, [scan_job(rng) for idx in range(20)])
+    jobs.update_durations(spr.duration_model)
+    assert jobs.total > 0
+    jobs.clear()
+    assert jobs.total == 0.0
+
+def test_clear_keeps_the_running_job(instruments):
+    rng = random.Random(0)
+    jobs = spr.experiment_queue
+    jobs.insert(None, [wait_job(rng) for idx in range(5)])
+    running = jobs[2]
+    jobs.clear(keep=running)
+    assert list(jobs) == [running]
+    assert jobs.total == pytest.approx(running.duration)
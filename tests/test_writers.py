@@ -0,0 +1,127 @@
+"""
+Resuming interrupted ScanWriter and KineticsWriter files, and the names of the files written next to them
+"""
+
+import json
+import os
+
+import numpy as np
+
+import Run_SPR_v5 as spr
+
+def scan_rows(n, start=0):
+    angle = 40+0.1*np.arange(start, start+n)
+    return np.column_stack([angle, np.cos(angle), np.full(n, 1e-6)])
+
+def test_scan_writer_resumes_complete_rows(tmp_path):
+    filename = str(tmp_path/'scan_1.csv')
+    out = spr.ScanResult(50)
+    writer = spr.ScanWriter(filename, out.column_names, 'csv', {'mode': 'step'})
+    for row in scan_rows(40):
+        out.append(*row)
+        writer.write(out)
+    writer.write(out, force=True)
+    # crash in the middle of a row: the handle goes away without close() or abort()
+    writer._file.write('40,44.0,0.5')
+    writer._file.close()
+    assert not os.path.exists(filename)
+
+    writer = spr.ScanWriter(filename, out.column_names, 'csv', {'mode': 'step'}, resume=True)
+    np.testing.assert_allclose(writer.recovered, scan_rows(40))
+    assert writer.metadata['resumed_rows'] == 40
+
+    resumed = spr.ScanResult(50)
+    spr.restore_rows(writer, resumed)
+    for row in scan_rows(10, start=40):
+        resumed.append(*row)
+        writer.write(resumed)
+    writer.close(resumed)
+
+    scan = spr.load_scan(filename)
+    np.testing.assert_allclose(scan[out.column_names].to_numpy(), scan_rows(50))
+    np.testing.assert_array_equal(scan.index, np.arange(50))
+    assert spr.load_metadata(filename)['points'] == 50
+    assert not os.path.exists(filename+'.partial')
+    assert not os.path.exists(filename+'.partial.new')
+
+def test_scan_writer_without_resume_starts_again(tmp_path):
+    filename = str(tmp_path/'scan_1.csv')
+    out = spr.ScanResult(10)
+    writer = spr.ScanWriter(filename, out.column_names)
+    for row in scan_rows(5):
+        out.append(*row)
+    writer.abort(out)
+
+    writer = spr.ScanWriter(filename, out.column_names)
+    assert len(writer.recovered) == 0
+    writer.close(spr.ScanResult(1))
+    assert len(spr.load_scan(filename)) == 0
+
+def test_kinetics_writer_resumes_synced_samples(tmp_path):
+    filename = str(tmp_path/'kin_1.dat')
+    writer = spr.KineticsWriter(filename, 1000, {'mode': 'kinetics'})
+    times = np.arange(300)*1e-3
+    assert writer.append(times[:200], np.sin(times[:200])) == 200
+    writer.sync()
+    t0 = writer.metadata['t0']
+    # samples after the last sync are not counted in the metadata and are lost with the crash
+    writer.append(times[200:250], np.sin(times[200:250]))
+    writer.data.flush()
+    del writer
+
+    writer = spr.KineticsWriter(filename, 1000, {'mode': 'kinetics'}, resume=True)
+    assert writer.n == 200
+    assert writer.metadata['t0'] == t0
+    writer.append(times[200:300], np.sin(times[200:300]))
+    writer.close()
+
+    data, metadata = spr.load_kinetics(filename)
+    assert metadata['samples'] == len(data) == 300
+    assert metadata['t0'] == t0
+    np.testing.assert_allclose(data['Time'], times)
+    np.testing.assert_allclose(data['Power'], np.sin(times))
+    assert os.path.getsize(filename) == 300*spr.KineticsWriter.dtype.itemsize
+
+def test_kinetics_writer_stops_at_capacity(tmp_path):
+    writer = spr.KineticsWriter(str(tmp_path/'kin_1.dat'), 100)
+    assert writer.append(np.zeros(150), np.ones(150)) == 100
+    assert writer.append(np.zeros(10), np.ones(10)) == 0
+    writer.close()
+
+def test_kinetics_metadata_does_not_replace_scan_metadata(tmp_path):
+    directory = str(tmp_path)
+    scan_file = spr.unique_filename(directory, 'exp', '.csv')
+    out = spr.ScanResult(5)
+    for row in scan_rows(5):
+        out.append(*row)
+    writer = spr.ScanWriter(scan_file, out.column_names, metadata={'mode': 'step'})
+    writer.close(out)
+
+    kinetics_file = spr.unique_filename(directory, 'exp', '.dat')
+    assert os.path.basename(kinetics_file) == 'exp_2.dat'
+    writer = spr.KineticsWriter(kinetics_file, 10, {'mode': 'kinetics'})
+    writer.append(np.arange(3.0), np.ones(3))
+    writer.close()
+
+    assert writer.metadata_file == kinetics_file+'.json'
+    assert spr.load_metadata(scan_file)['mode'] == 'step'
+    assert spr.load_kinetics(kinetics_file)[1]['mode'] == 'kinetics'
+
+def test_unique_filename_skips_numbers_with_any_sibling(tmp_path):
+    directory = str(tmp_path)
+    for name in ('exp_1.csv', 'exp_2.json', 'exp_3.dat.partial', 'exp_4_samples.f8'):
+        (tmp_path/name).write_text('')
+    assert os.path.basename(spr.unique_filename(directory, 'exp', '.csv')) == 'exp_5.csv'
+    assert os.path.basename(spr.unique_filename(directory, 'other', '.h5')) == 'other_1.h5'
+
+def test_load_kinetics_reads_older_metadata_name(tmp_path):
+    filename = str(tmp_path/'kin_1.dat')
+    writer = spr.KineticsWriter(filename, 10)
+    writer.append(np.arange(4.0), np.ones(4))
+    writer.close()
+    os.replace(filename+'.json', str(tmp_path/'kin_1.json'))
+
+    data, metadata = spr.load_kinetics(filename)
+    assert len(data) == metadata['samples'] == 4
+    with open(tmp_path/'kin_1.json') as f:
+        assert json.load(f)['samples'] == 4